@@ -0,0 +1,113 @@
+"""
+On-disk catalogue of fitted materials. The rmk+1 parameters fitted by Material.impedance_from_alpha() are kept
+in one .npz record per material, keyed by a hash of its band absorption data, absorber type and air properties,
+so a material that was already fitted once never pays for the optimization again.
+"""
+
+import os
+import hashlib
+import numpy as np
+
+
+class MaterialCatalogue():
+    '''
+    Fitted materials, kept in a folder.
+    Inputs:
+        path - folder of the records (it is created if it does not exist).
+
+    Each record holds the rmk+1 parameters of a material and the admittances already derived from them,
+    one for each frequency vector they were requested for.
+    '''
+
+    def __init__(self, path="material_cache"):
+
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    @staticmethod
+    def key(bands, alpha, absorber_type, rho0, c0):
+        '''
+        Returns the key of a material.
+        Inputs:
+            bands - center frequencies of the octave or third-octave bands.
+            alpha - statistical absorption coefficients in these bands.
+            absorber_type - type of absorber used to constrain the fit (see Material.impedance_from_alpha()).
+            rho0, c0 - air density and sound speed.
+        '''
+
+        data = hashlib.sha1()
+        data.update(np.asarray(bands, dtype=np.float64).tobytes())
+        data.update(np.asarray(alpha, dtype=np.float64).tobytes())
+        data.update(str(absorber_type).encode())
+        data.update(np.asarray([rho0, c0], dtype=np.float64).tobytes())
+
+        return data.hexdigest()
+
+    def record_path(self, key):
+        return os.path.join(self.path, "mat_%s.npz" % key[:16])
+
+    def contains(self, key):
+        return os.path.exists(self.record_path(key))
+
+    def keys(self):
+        '''
+        Returns the (short) keys of the materials in the catalogue.
+        '''
+
+        return sorted(name[4:-4] for name in os.listdir(self.path)
+                      if name.startswith("mat_") and name.endswith(".npz") and not name.endswith("_tmp.npz"))
+
+    def add(self, key, rmk1, absorber_type="", bands=[], alpha=[], converged=True):
+        '''
+        Adds (or replaces) the fitted rmk+1 parameters of a material. The band data is kept for reference only.
+        converged tells whether the fit reached its validation cost (see Material.impedance_from_alpha()).
+        '''
+
+        self._write(key, {"rmk1": np.asarray(rmk1, dtype=np.float64), "absorber_type": np.asarray(str(absorber_type)),
+                          "bands": np.asarray(bands, dtype=np.float64), "alpha": np.asarray(alpha, dtype=np.float64), 
+                          "converged": np.asarray(bool(converged))})
+
+    def rmk1(self, key):
+        '''
+        Returns the fitted rmk+1 parameters of a material.
+        '''
+
+        with np.load(self.record_path(key)) as record:
+            return record["rmk1"]
+
+    def converged(self, key):
+        '''
+        Returns True if the fit of a material reached its validation cost.
+        '''
+
+        with np.load(self.record_path(key)) as record:
+            return bool(record["converged"]) if "converged" in record.files else True
+
+    def admittance(self, key, freq_vec):
+        '''
+        Returns the admittance of a material at the frequencies of freq_vec. It is derived from the rmk+1
+        parameters the first time a frequency vector is requested and kept in the record afterwards.
+        '''
+
+        from sea.materials import rmk1_impedance
+
+        freq_vec = np.asarray(freq_vec, dtype=np.float64)
+        name = "admittance_%s" % hashlib.sha1(freq_vec.tobytes()).hexdigest()[:16]
+
+        with np.load(self.record_path(key)) as record:
+            record = {item: record[item] for item in record.files}
+
+        if name not in record:
+            zs, _ = rmk1_impedance(record["rmk1"], 2*np.pi*freq_vec)
+            record[name] = 1/np.conj(zs)
+            self._write(key, record)
+
+        return record[name]
+
+    def _write(self, key, record):
+
+        # Written to a temporary file first, so parallel rooms never read a truncated record:
+        path = self.record_path(key)
+        tmp_path = path[:-4] + "_%s_tmp.npz" % os.getpid()
+        np.savez(tmp_path, **record)
+        os.replace(tmp_path, path)
@@ -3,7 +3,8 @@ import scipy
 import scipy.io
 import pickle
 
-from scipy.special import lpmv, spherical_jn, spherical_yn
+from scipy.special import spherical_jn, spherical_yn
+from sea import spherical_harmonics as sh
 
 class Directivity:
     
@@ -110,17 +111,18 @@ class Directivity:
             y_nm, dy_dbeta, dy_dalpha = spherical_harmonic_all(self.sh_order, alpha,beta);
             
             
+            # Order n of each spherical harmonic (ordered as sub2indSH):
+            sh_order_of_column = np.repeat(np.arange(self.sh_order+1), 2*np.arange(self.sh_order+1)+1)
+            
             # Loop over frequency:
             self.sh_coefficients = []
             i = 0
             for fi, f in enumerate (f_list):
                 if f == self.freq_vec[i]:
                     
-                    # Calculate spherical Hankel functions: 
-                    hnOut = np.zeros(((self.sh_order+1)**2, 1), dtype = np.complex128);
-                    for n in np.arange(self.sh_order+1):
-                        for m in np.arange(-n, n + 1):
-                            hnOut[sub2indSH(m,n),0] = spherical_hankel_out(n, self.measurement_radius*2*np.pi*f/self.c0)
+                    # Calculate spherical Hankel functions (all orders at once): 
+                    h, dhdz = sh.spherical_hankel_out_all(self.sh_order, self.measurement_radius*2*np.pi*f/self.c0)
+                    hnOut = h[sh_order_of_column].reshape(((self.sh_order+1)**2, 1))
                 
                     # Calculate b_nm coefficients via a mode-matching approach (Eq. 9 in paper):
                     sh_coefficients_f = np.matmul(y_nm.conj().T, np.transpose(np.divide(np.multiply(w, phi_meas[:,fi]), hnOut)))
@@ -170,12 +172,10 @@ class Directivity:
             # Pre-calculate spherical harmonic functions:
             y_nm, dy_dbeta, dy_dalpha = spherical_harmonic_all(self.sh_order, alpha, beta)
             
-            # Pre-calculate spherical Hankel functions:
-            hnOut = np.zeros(((self.sh_order+1)**2, np.size(f_list)), dtype = np.complex128)
-            for fi, f in enumerate(f_list):
-                for n in np.arange(self.sh_order + 1):
-                    for m in np.arange(-n, n + 1):
-                        hnOut[sub2indSH(m,n),fi] = spherical_hankel_out(n, self.measurement_radius*2*np.pi*f/self.c0)
+            # Pre-calculate spherical Hankel functions (all orders and frequencies at once):
+            sh_order_of_column = np.repeat(np.arange(self.sh_order+1), 2*np.arange(self.sh_order+1)+1)
+            h, dhdz = sh.spherical_hankel_out_all(self.sh_order, self.measurement_radius*2*np.pi*np.asarray(f_list)/self.c0)
+            hnOut = h[:, sh_order_of_column].T
                 
             
                 
@@ -268,80 +268,23 @@ def sub2indSH (m,n):
 def spherical_harmonic_all (max_order, alpha, beta):
     
     """
-    (y, dy_dbeta, dy_dalpha) = spherical_harmonic_all(max_order, alpha, sinbeta, cosbeta)
+    (y, dy_dbeta, dy_dalpha) = spherical_harmonic_all(max_order, alpha, beta)
     	
     Computes a Spherical Harmonic function and it's angular derivatives for
-    all (m,n) up to the given maximum order. The algorithm is equivalent to that
-    implemented in SphericalHarmonic, but this version avoids repeated calls
-    to lpmv, since that is very time consuming.
+    all (m,n) up to the given maximum order, with the polar angle given directly.
+    See sea.spherical_harmonics.spherical_harmonic_all.
     	
-    Arguments - these should all be scalars:
-    r is radius
+    Arguments:
     alpha is azimuth angle (angle in radians from the positive x axis, with
     rotation around the positive z axis according to the right-hand screw rule)
-    beta is polar angle, but it is specified as two arrays of its cos and sin values. 
+    beta is polar angle (one element per point, as alpha). 
     max_order is maximum Spherical Harmonic order and should be a non-negative real integer scalar
     	
     Returned data will be vectors of length (max_order+1)^2.
     
     """
     
-    cosbeta = np.cos(beta)
-    sinbeta = np.sin(beta)
-
-    # Preallocate output arrays:
-    y =  np.zeros((np.size(alpha),(max_order+1)**2), np.complex128)
-    dy_dbeta = np.zeros((np.size(alpha),(max_order+1)**2), np.complex128)
-    dy_dalpha = np.zeros((np.size(alpha),(max_order+1)**2), np.complex128)
-    
-    #% Loop over n and calculate spherical harmonic functions y_nm
-    for n in range(max_order+1):
-    
-        # Compute Legendre function and its derivatives for all m:
-        p_n = lpmv(range(0,n+1), n, cosbeta)
-        #print (np.shape(p_n))
-        #shape_p_n = np.shape(p_n)
-        #p_n = p_n.reshape((shape_p_n[1], shape_p_n[0]))
-        
-        for m in range(-n, n+1):
-    
-            # Legendre function its derivatives for |m|:
-            p_nm = p_n[:, np.absolute(m)]
-            p_nm = p_nm.reshape((np.size(p_nm), ))
-
-            if n==0:
-                dPmn_dbeta = 0
-            elif m==0:
-                dPmn_dbeta = p_n[:,1]
-            elif abs(m)<n:
-                dPmn_dbeta = 0.5*p_n[:,abs(m)+1] - 0.5*(n+abs(m))*(n-abs(m)+1)*p_n[:,abs(m)-1];
-                dPmn_dbeta = dPmn_dbeta.reshape((np.size(dPmn_dbeta), ))
-            elif (abs(m)==1) and (n==1):
-                dPmn_dbeta = -cosbeta
-                dPmn_dbeta = dPmn_dbeta.reshape((np.size(dPmn_dbeta), ))
-            #elif sinbeta<=np.finfo(float).eps:
-                #dPmn_dbeta = 0
-            else:
-                dPmn_dbeta = -abs(m)*cosbeta.reshape((np.size(cosbeta), ))*p_nm/sinbeta.reshape((np.size(sinbeta), )) - (n+abs(m))*(n-abs(m)+1)*p_n[:,abs(m)-1]
-                dPmn_dbeta = dPmn_dbeta.reshape((np.size(dPmn_dbeta), ))
-            
-            #print (dPmn_dbeta)
-            #print (np.shape(dPmn_dbeta))
-            # Compute scaling term, including sign factor:
-            scaling_term = ((-1)**m) * np.sqrt((2 * n + 1) / (4 * np.pi * np.prod(np.float64(range(n-abs(m)+1, n+abs(m)+1)))))
-    
-            # Compute exponential term:
-            exp_term = np.exp(1j*m*alpha)
-            exp_term = exp_term.reshape((np.size(exp_term), ))
-            
-            # Put it all together:
-            i = sub2indSH(m,n)
-            #y[:,i] = np.multiply (exp_term, p_nm)
-            y[:,i] = scaling_term * exp_term * p_nm
-            dy_dbeta[:,i] = scaling_term * exp_term * dPmn_dbeta
-            dy_dalpha[:,i] = y[:,i] * 1j * m
-            
-    return y, dy_dbeta, dy_dalpha
+    return sh.spherical_harmonic_all(max_order, alpha, np.sin(beta), np.cos(beta))
 
 
 def spherical_hankel_out (n, z):
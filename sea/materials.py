@@ -1,9 +1,10 @@
 import numpy as np
 from matplotlib import pylab as plt
 import  scipy.integrate
-from scipy import interpolate
 from scipy.optimize import minimize
-from random import uniform
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 class Material():
     
@@ -66,6 +67,19 @@ class Material():
         self.absorber_type = "rigid"
     
     
+    def _porous_layer(self, flow_resistivity, thickness, theta):
+        
+        """
+            Keeps the properties of the porous layer of an absorber on the material (flow resistivity, thickness, 
+            angle of incidence and characteristic sound speed, density, impedance and wave number), as porous() does.
+        """
+        
+        self.flow_resistivity = flow_resistivity
+        self.thickness = thickness
+        self.theta = theta
+        self.characteristic_c, self.characteristic_rho, self.characteristic_impedance, self.characteristic_k = porous_characteristics(self.flow_resistivity, self.freq, self.rho0, self.c0)
+        
+        
     def porous(self, parameters, theta=0):
 
         """
@@ -85,25 +99,9 @@ class Material():
         self.thickness = parameters[1]
         self.theta = theta
 
-        c1=0.0978
-        c2=0.7
-        c3=0.189
-        c4=0.595
-        c5=0.0571
-        c6=0.754
-        c7=0.087
-        c8=0.723
-
-        X = self.freq*self.rho0/self.flow_resistivity
-        self.characteristic_c = self.c0/(1+c1*np.power(X,-c2) -1j*c3*np.power(X,-c4))
-        self.characteristic_rho = (self.rho0*self.c0/self.characteristic_c)*(1+c5*np.power(X,-c6)-1j*c7*np.power(X,-c8))
-
-        self.characteristic_impedance = self.characteristic_rho*self.characteristic_c
-        self.characteristic_k = self.w/self.characteristic_c
+        self._porous_layer(self.flow_resistivity, self.thickness, self.theta)
 
-        theta_t = np.arctan(self.characteristic_c*np.sin(self.theta)/self.c0)
-
-        self.surface_impedance = -1j*(self.characteristic_impedance)/(np.cos(theta_t))/np.tan((self.characteristic_k)*np.cos(theta_t)*self.thickness) 
+        self.surface_impedance = porous_impedance(parameters, self.freq, self.theta, self.rho0, self.c0)
         
         self.normalized_surface_impedance = self.surface_impedance/(self.rho0*self.c0)
         #self.admittance = 1/self.normalized_surface_impedance
@@ -129,6 +127,9 @@ class Material():
                 d_air -> depth of the air cavity]
 
             theta -> angle of incidence
+
+            The properties of its porous layer (flow_resistivity, thickness, theta and the characteristic_c, characteristic_rho, 
+            characteristic_impedance and characteristic_k of the porous absorber) are kept on the material, as porous() does.
         """
         
         if self.freq.size == 0:
@@ -139,14 +140,9 @@ class Material():
         self.air_cavity_depth = parameters[2]
         self.theta = theta
        
-        self.porous([self.flow_resistivity, self.thickness], self.theta)
+        self._porous_layer(self.flow_resistivity, self.thickness, self.theta)
 
-        theta_t_1 = np.arctan(self.characteristic_c*np.sin(self.theta)/self.c0)
-        theta_t_2 = np.arctan(self.c0*np.sin(theta_t_1)/self.characteristic_c)
-
-        air_surf_imp = -1j*(self.rho0*self.c0)/(np.cos(theta_t_2))/np.tan((self.w/self.c0)*np.cos(theta_t_2)*self.air_cavity_depth)
-
-        self.surface_impedance = double_layer(air_surf_imp, self.characteristic_impedance, self.characteristic_c, self.characteristic_k, self.thickness, self.c0, self.theta)
+        self.surface_impedance = porous_with_air_cavity_impedance(parameters, self.freq, self.theta, self.rho0, self.c0)
 
         self.normalized_surface_impedance = self.surface_impedance/(self.rho0*self.c0)
         #self.admittance = 1/self.normalized_surface_impedance
@@ -172,6 +168,9 @@ class Material():
 
             theta -> angle of incidence. Here, it is assumed to be 0 degrees. It is considered an argument just 
                      to facilitate the interaction with another methods
+
+            The properties of its porous layer (flow_resistivity, thickness, theta and the characteristic_c, characteristic_rho, 
+            characteristic_impedance and characteristic_k of the porous absorber) are kept on the material, as porous() does.
         """
 
         if self.freq.size == 0:
@@ -182,11 +181,9 @@ class Material():
         self.flow_resistivity = parameters[2]
         self.porous_layer_thickness = parameters[3]
 
-        self.porous([self.flow_resistivity, self.porous_layer_thickness], 0)
-
-        z_si = double_layer(self.surface_impedance, self.rho0*self.c0, self.c0, self.k0, (self.cavity_depth - self.porous_layer_thickness), self.c0, 0)
+        self._porous_layer(self.flow_resistivity, self.porous_layer_thickness, 0)
 
-        self.surface_impedance = 1j*self.w*self.mass_per_unit_area + z_si
+        self.surface_impedance = membrane_impedance(parameters, self.freq, 0, self.rho0, self.c0)
         
         self.normalized_surface_impedance = self.surface_impedance/(self.rho0*self.c0)
         #self.admittance = 1/self.normalized_surface_impedance
@@ -268,6 +265,8 @@ class Material():
             theta -> angle of incidence. Here, it is assumed to be 0 degrees. It is considered an argument just 
                      to facilitate the interaction with another functions
 
+            The properties of its porous layer (flow_resistivity, thickness, theta and the characteristic_c, characteristic_rho, 
+            characteristic_impedance and characteristic_k of the porous absorber) are kept on the material, as porous() does.
         """
         
         if self.freq.size == 0:
@@ -280,20 +279,9 @@ class Material():
         self.flow_resistivity = parameters[4]
         self.porous_layer_thickness = parameters[5]
 
-        #m = self.rho0*self.perforation_rate*(self.panel_thickness + 1.7*self.openings_radius)       # superficial density of the gas in each perfuration
-        m = self.rho0*(self.panel_thickness + 1.7*self.openings_radius)/self.perforation_rate       # superficial density of the gas in each perfuration
-        z_t = 1j*self.w*m                 # impedance of a single opening
-        #z_t = 1j*self.w*(self.panel_thickness + 1.7*self.openings_radius)/(self.perforation_rate)                # impedance of a single opening
-        
-        # cavity impedance 
-        self.porous([self.flow_resistivity, self.porous_layer_thickness], 0)
-
-        z_sar = -1j*(self.rho0*self.c0) * 1/(np.tan((self.w/self.c0)*(self.cavity_depth-self.porous_layer_thickness)))
-        
-        z_si = (-1j*z_sar*self.characteristic_impedance*1/(np.tan(self.characteristic_k*(self.porous_layer_thickness))) + (self.characteristic_impedance)**2) / (z_sar - 1j*self.characteristic_impedance*1/(np.tan(self.characteristic_k*(self.porous_layer_thickness))))
+        self._porous_layer(self.flow_resistivity, self.porous_layer_thickness, 0)
 
-        # The total impedance is the sum:
-        self.surface_impedance = z_t + z_si
+        self.surface_impedance = perforated_panel_impedance(parameters, self.freq, 0, self.rho0, self.c0)
         
         self.normalized_surface_impedance = self.surface_impedance/(self.rho0*self.c0)
         #self.admittance = 1/self.normalized_surface_impedance
@@ -377,16 +365,9 @@ class Material():
         self.air_cavity_depth = parameters[3]
         self.air_dynamic_viscosity = mi0       
 
-        s_2 = (self.rho0*self.w*self.openings_radius**2) / (self.air_dynamic_viscosity) 
-        
-        z_t = ((32*self.air_dynamic_viscosity*self.panel_thickness)/(4*self.openings_radius**2) * (1+s_2/32)**0.5 \
-                + 1j*self.w*self.rho0*self.panel_thickness*(1 + (9+s_2/2)**(-0.5)))/(self.rho0*self.c0)
-        
-        z_e = (((self.rho0*self.air_dynamic_viscosity*self.w)/2)**0.5 + 1j*1.7*self.rho0*self.w*self.openings_radius)/(self.rho0*self.c0)
-        
-        self.normalized_surface_impedance = (z_t+z_e)/self.perforation_rate - 1j*1/(np.tan((self.k0)*self.air_cavity_depth))
+        self.surface_impedance = microperforated_panel_impedance(parameters, self.freq, 0, self.rho0, self.c0, mi0=self.air_dynamic_viscosity)
+        self.normalized_surface_impedance = self.surface_impedance/(self.rho0*self.c0)
         
-        self.surface_impedance = self.normalized_surface_impedance*(self.rho0*self.c0)
         #self.admittance = 1/self.normalized_surface_impedance
         self.admittance = np.conj(1/self.normalized_surface_impedance)
         
@@ -395,10 +376,17 @@ class Material():
         self.absorber_type = "microperforated panel"  
         
     
-    def impedance2alpha(self, method="thomasson", a=11**0.5, b=11**0.5, **kwargs):
+    def impedance2alpha(self, method="thomasson", a=11**0.5, b=11**0.5, integration="gauss", n_points=32, **kwargs):
 
         """
         Computes absorption coeffients from complex impedances (or admittances) using Thomasson formulation or the Paris Formula
+        
+        integration - "gauss" (default) evaluates the integrand on a fixed Gauss-Legendre grid of n_points angles for all 
+                      frequencies at once (see statistical_alpha()). "quad" integrates each frequency with scipy.integrate.quad.
+        n_points - number of angles of the "gauss" integration (per sub-interval, for the Thomasson formulation). 
+                   With the default (32), the absorption coefficients match a converged quad integration within 1e-8 
+                   (24 points: 1e-7, 16 points: 1e-5). Note that "quad" with its default tolerances may itself deviate 
+                   by up to about 2e-5 from the converged value.
         """    
             
         ############################################################    
@@ -426,67 +414,31 @@ class Material():
             if self.normalized_surface_impedance.size == 0:
                 self.surface_impedance = 1/np.conj(self.admittance)
         
-        self.normal_incidence_alpha = np.zeros(len(self.surface_impedance))
+        vp = (self.normalized_surface_impedance - 1)/(self.normalized_surface_impedance + 1)
+        self.normal_incidence_alpha = 1 - (abs(vp))**2
+            
+        if method != "thomasson" and method != "paris":
+            raise ValueError("Method is not valid. You must use \"paris\" or \"thomasson\".")
         
-        for zsi, zs in enumerate (self.normalized_surface_impedance):
-
-            vp =  (zs - 1)/(zs + 1)    
-            self.normal_incidence_alpha[zsi] = 1 - (abs(vp))**2
+        if integration == "gauss":
+            self.statistical_alpha = statistical_alpha(self.normalized_surface_impedance, k0, method=method, a=a, b=b, n_points=n_points)
             
+        elif integration == "quad":
             
-        if method == "thomasson":
+            self.statistical_alpha = np.zeros(len(self.normalized_surface_impedance))
             
-            self.statistical_alpha = np.zeros(len(self.surface_impedance))
-
             for zsi, zs in enumerate (self.normalized_surface_impedance):
-
-                def alpha_fun(theta):
-
-                    mi = np.sin(theta)
-                    ke = (2*k0[zsi]*a*b) / (a+b)
-                    kappa = 0.956 / ke
-                    z_h = 1 / ((1 + (kappa-1j*mi)**2)**(1/2))
-
-                    def h(q):
-                        h = np.log((1+q**2)**(1/2) + q) - ((1+q**2)**(1/2)-1)/(3*q)
-                        return h
-
-                    z_l = (2*k0[zsi]*a*b / np.pi) + 1j*(2*k0[zsi] / np.pi) * (b*h(a/b) + a*h(b/a))
-
-                    z_r = 1 / ((1/(z_l.real**2))**(1/2) + (1/(z_h.real**2))**(1/2))
-
-
-                    z_hi0 = 0.67/ke
-                    z_i0 = 1 / ((1/(z_l.imag**3))**(1/3) + (1/(z_hi0**3))**(1/3))
-                    z_i = np.max((z_i0, z_h.imag))
-
-                    z_radiation = z_r + 1j*z_i
-
-                    alpha_fun = zs.real*np.sin(theta) / (abs(zs + z_radiation))**2
-
-                    return alpha_fun
-
-                self.statistical_alpha[zsi] = 8 * abs(scipy.integrate.quad(alpha_fun, 0, np.pi/2)[0])
                 
-            
-        elif method == "paris":
-                
-            self.statistical_alpha = np.zeros(len(self.normalized_surface_impedance))
-
-            for zsi, zs in enumerate (self.normalized_surface_impedance):
-
-                def alpha_fun(theta):
-
-                    vp =  (zs*np.cos(theta) - 1)/(zs*np.cos(theta) + 1)    
-                    alpha = 1 - (abs(vp))**2
-                    alpha_s = alpha*np.sin(2*theta)
-
-                    return alpha_s
-
-                self.statistical_alpha[zsi] = abs(scipy.integrate.quad(alpha_fun, 0, np.pi/2)[0])
+                if method == "thomasson":
+                    alpha_fun = lambda theta: _thomasson_integrand(theta, zs, k0[zsi], a, b)
+                    self.statistical_alpha[zsi] = 8 * abs(scipy.integrate.quad(alpha_fun, 0, np.pi/2)[0])
+                    
+                else:
+                    alpha_fun = lambda theta: _paris_integrand(theta, zs)
+                    self.statistical_alpha[zsi] = abs(scipy.integrate.quad(alpha_fun, 0, np.pi/2)[0])
         
         else:
-            raise ValueError("Method is not valid. You must use \"paris\" or \"thomasson\".")
+            raise ValueError("Integration is not valid. You must use \"gauss\" or \"quad\".")
         
         if "f_list" in kwargs:
             self.alpha_in_bands(f_list=f_list)
@@ -504,44 +456,19 @@ class Material():
             raise ValueError("Frequency vector is empty.") 
             
         if self.third_octave_bands_statistical_alpha.size != 0 and self.third_octave_bands.size != 0:
-            lower_limit = self.lower[1]
-            upper_limit = self.upper[1]
-            center_freq = self.center[1]
-            
             bands = self.third_octave_bands
             alpha = self.third_octave_bands_statistical_alpha
 
         elif self.octave_bands_statistical_alpha.size != 0 and self.octave_bands.size != 0:
-            lower_limit = self.lower[0]
-            upper_limit = self.upper[0]
-            center_freq = self.center[0]
-            
             bands = self.octave_bands
             alpha = self.octave_bands_statistical_alpha
             
         else:
             raise ValueError("There is not enough information about this material yet.") 
             
-        tck_alpha = interpolate.splrep(bands, alpha, k=1)
-        
-        admittance = np.zeros(len(self.freq), dtype = np.complex64)
-        statistical_alpha = np.zeros(len(self.freq))
-        for fi,f in enumerate(self.freq):
-            
-            if f < bands[0]:
-                admittance[fi] = np.cos(55*np.pi/180)*(1-(1-interpolate.splev(bands[0], tck_alpha, der=0))**0.5)/(1+(1-interpolate.splev(bands[0], tck_alpha, der=0))**0.5)       
-                statistical_alpha[fi] = interpolate.splev(bands[0], tck_alpha, der=0)
-                
-            elif f > bands[-1]:
-                admittance[fi] = np.cos(55*np.pi/180)*(1-(1-interpolate.splev(bands[-1], tck_alpha, der=0))**0.5)/(1+(1-interpolate.splev(bands[-1], tck_alpha, der=0))**0.5) 
-                statistical_alpha[fi] = interpolate.splev(bands[-1], tck_alpha, der=0)
-                
-            else:
-                admittance[fi] = np.cos(55*np.pi/180)*(1-(1-interpolate.splev(f, tck_alpha, der=0))**0.5)/(1+(1-interpolate.splev(f, tck_alpha, der=0))**0.5)       
-                statistical_alpha[fi] = interpolate.splev(f, tck_alpha, der=0)
-                
-            if np.isnan(admittance[fi]):
-                admittance[fi] = np.cos(55*np.pi/180)*(1-(1-1)**0.5)/(1+(1-1)**0.5)
+        # Linear interpolation of the band data, kept constant outside the bands (alpha above 1 is taken as 1):
+        statistical_alpha = band_interpolate(bands, alpha, self.freq)
+        admittance = (np.cos(55*np.pi/180)*(1-(1-np.minimum(statistical_alpha, 1))**0.5)/(1+(1-np.minimum(statistical_alpha, 1))**0.5)).astype(np.complex64)
         
         self.admittance = admittance
         self.statistical_alpha = statistical_alpha
@@ -623,6 +550,16 @@ class Material():
 
                     Obs: to a porous absorver with an air cavity, the values of the flow resistivity and 
                          thickness limits even decrease as the cavity depth increases                                     
+
+        If the solution from the default guesses does not fit the input data, the problem is solved again from random 
+        guesses. The following keywords control these restarts:
+        starts -> number of random starts solved at once (default 1).
+        workers -> number of processes used to solve them (default 1).
+        seed -> seed of the random guesses, for reproducible fits (default None).
+        max_restarts -> maximum number of random starts (default 50). If none of them fits the input data, 
+                        the best solution found is kept, a notice is printed and self.rmk1_converged is set to False.
+        catalogue -> MaterialCatalogue (see sea/catalogue.py) where fitted materials are kept. If the same band data, 
+                     absorber type and air properties were already fitted, the optimization is skipped.
         '''
 
         if "absorber_type" in kwargs:
@@ -659,64 +596,40 @@ class Material():
         
         
         ################################################
-        # Computes a list of frequencies (f_list) containing three frequencies per octave (third-octave) band
-
-        aux = 0
-        while bands[0] > upper_limit[aux]:
-            aux = aux + 1
-
-        f_list = np.array([])
-        for band in bands:
-
-            freqs = np.array([np.mean((center_freq[aux], lower_limit[aux])), center_freq[aux], np.mean((upper_limit[aux], center_freq[aux]))])
-            f_list = np.append(f_list,freqs)
-            aux += 1
-            
-        #################################################
-        # Defines cost function to be minimized
+        # Looks for the material in the catalogue of fitted materials
         
-        def cost_fun (parameters):
-
-            """
-            This funciton defines the cost function to be minimized by the optimization process
-            (The cost function is defined as the squared L2-norm between the corresponding 
-            statistical absorption coefficient and the input absorption coefficient)
-
-            Parameters = [k, r, m, g, gama]
-            The parameters are normalize by their typical orders of magnitude to facilitate 
-            the progress of the algorithm
-            """
-
-            self.impedance_thru_rmk1(parameters=parameters, f_list=f_list)
-
-            if type == "third_octave_bands":
-                difference = alpha_in - self.third_octave_bands_statistical_alpha
-            else:
-                difference = alpha_in - self.octave_bands_statistical_alpha
+        catalogue = kwargs.get("catalogue", None)
+        if catalogue is not None:
+            key = catalogue.key(bands, alpha_in, self.absorber_type, self.rho0, self.c0)
+            
+            if catalogue.contains(key) and self.freq.size != 0:
+                self.rmk1 = catalogue.rmk1(key)
+                self.rmk1_converged = catalogue.converged(key)
+                self.admittance = catalogue.admittance(key, self.freq)
+                self.normalized_surface_impedance = 1/np.conj(self.admittance)
+                self.surface_impedance = self.normalized_surface_impedance*(self.rho0*self.c0)
+                self.impedance2alpha()
                 
-            squared_l2_norm = np.real(np.inner(difference, difference))
-
-            return squared_l2_norm
-
+                print("The material was found in the catalogue, with rmk+1 parameters equal to %s.\n" % self.rmk1)
+                if self.rmk1_converged != True:
+                    print("Its rmk+1 fit did not reach the validation cost when it was added to the catalogue.\n")
+                
+                self.absorber_type = "Generic " + str(self.absorber_type)
+                return
+        
+        ################################################
+        # Computes a list of frequencies (f_list) containing three frequencies per octave (third-octave) band
 
+        aux = np.searchsorted(upper_limit, bands[0]) + np.arange(len(bands))
+        f_list = np.stack(((center_freq[aux] + lower_limit[aux])/2, center_freq[aux], (upper_limit[aux] + center_freq[aux])/2), axis=1).ravel()
+            
         ################################################
         # Next condition statements define the constraints to be used in the optimization
-        # problem based on the type of absorber
+        # problem based on the type of absorber (see rmk1_constraint)
 
         if self.absorber_type == "soft porous" or self.absorber_type == "perforated panel" or self.absorber_type == "membrane":
 
-            def constrain(parameters):
-
-                # Parameters = [r, m, k, g, gama]
-                # The parameters are normalize by their typical orders of magnitude to facilitate the progress of the algorithm
-                
-                self.impedance_thru_rmk1(parameters=parameters, f_list=f_list)
-                zs = 2 - np.real(self.normalized_surface_impedance)
-
-                return zs
-
-            ineq_cons = {'type': 'ineq',
-                         'fun': constrain}
+            constraint = "soft"
 
             bounds = ((0, np.inf), (0, np.inf), (0, np.inf), (0, np.inf), (-1, 1)) # (k, r, m, g, gama)
             guesses = np.array([0, 1.6, 0, 0, 0]) # np.array([k, r, m, g, gama])
@@ -728,26 +641,21 @@ class Material():
 
         if self.absorber_type == "hard porous" or self.absorber_type == "microperforated panel" or self.absorber_type == "hard":
 
-            def constrain(parameters):
-
-                '''
-                Parameters = [r, m, k, g, gama]
+            constraint = "hard"
 
-                The parameters are normalize by their typical orders of magnitude to facilitate 
-                the progress of the algorithm
-                '''
-                
-                self.impedance_thru_rmk1(parameters=parameters, f_list=f_list)
-                zs = np.real(self.normalized_surface_impedance) - 1
-
-                return zs
+            bounds = ((0, np.inf), (0, np.inf), (0, np.inf), (0, np.inf), (-1, 1)) # (k, r, m, g, gama)
+            guesses = np.array([0, 1.6, 0, 0, 0]) # np.array([k, r, m, g, gama])
 
+        ################################################
+        # Multi-start options
 
-            ineq_cons = {'type': 'ineq',
-                         'fun': constrain}
+        starts = kwargs.get("starts", 1)               # random starts solved at once (in parallel if workers > 1)
+        workers = kwargs.get("workers", 1)             # processes used to solve the starts
+        max_restarts = kwargs.get("max_restarts", 50)  # maximum number of random starts
+        rng = np.random.default_rng(kwargs.get("seed", None))
 
-            bounds = ((0, np.inf), (0, np.inf), (0, np.inf), (0, np.inf), (-1, 1)) # (k, r, m, g, gama)
-            guesses = np.array([0, 1.6, 0, 0, 0]) # np.array([k, r, m, g, gama])
+        problem = {"f_list": f_list, "alpha_in": np.asarray(alpha_in, dtype=np.float64), "c0": self.c0, 
+                   "constraint": constraint, "bounds": bounds}
 
         ################################################
 
@@ -758,30 +666,43 @@ class Material():
         else:
             validation = 0.1
         
-        solution = minimize(cost_fun, guesses, method='SLSQP', constraints = [ineq_cons], bounds = bounds, options={'ftol': 1e-10, 'disp': True, 'maxiter': 1000})
-        print(self.rmk1)
+        solutions = _fit_rmk1_starts([guesses], problem)
+        best = min(solutions, key=lambda solution: solution[1])
+        print("Start from the default guesses: cost = %0.6f, rmk+1 parameters = %s" % (best[1], best[0]))
         
-        i = 0
-        for alpha in alpha_in:
-            if alpha < 0.1:
-                i += 1
-        '''
-        if any(alpha_in) > 1:
-            validation = 0.25
-        elif i >= 3:
-            validation = 0.001
-        else:
-            validation = 0.015
-        '''
+        restarts = 0
+        executor = None
+        try:
+            while best[1] > validation and restarts < max_restarts:
+                
+                # The pool is only started if the random starts are needed, and then kept for all of them:
+                if workers > 1 and starts > 1 and executor is None:
+                    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+                # Random values between 0 and 2 to all the normalized parameters, with the exception of the exponent (within its bounds):
+                n_starts = min(starts, max_restarts - restarts)
+                random_guesses = [np.array([rng.uniform(0,2), rng.uniform(0,2), rng.uniform(0,2), rng.uniform(0,2), 
+                                            rng.uniform(max(bounds[4][0], -1), min(bounds[4][1], 1))]) for i in range(n_starts)]
+                restarts += n_starts
+                
+                solutions = _fit_rmk1_starts(random_guesses, problem, executor)
+                best = min(solutions + [best], key=lambda solution: solution[1])
+                print("%s random starts: best cost = %0.6f, rmk+1 parameters = %s" % (restarts, best[1], best[0]))
+                
+        finally:
+            if executor is not None:
+                executor.shutdown()
         
-        while cost_fun (solution.x) > validation:
+        # Kept on the material, so callers can check whether the fit reached the validation cost:
+        self.rmk1_converged = bool(best[1] <= validation)
+        if self.rmk1_converged != True:
+            print("The rmk+1 fit did not reach the validation cost (%s) after %s random starts. The best solution found was kept." 
+                  % (validation, restarts))
 
-            guesses = np.array([uniform(0,2), uniform(0,2), uniform(0,2), uniform(0,2), uniform(-1,1)]) # assign random values between 0 and 2 to all the normalized parameters, with the exception of the exponent, -1 <= gama <= 1
-            solution = minimize(cost_fun, guesses, method='SLSQP', constraints = [ineq_cons], bounds = bounds, options={'ftol': 1e-10, 'disp': True, 'maxiter': 1000})
-            print(self.rmk1)
+        self.impedance_thru_rmk1(parameters=best[0])
         
-
-        self.impedance_thru_rmk1()
+        if catalogue is not None:
+            catalogue.add(key, self.rmk1, self.absorber_type, bands, alpha_in, converged=self.rmk1_converged)
         
         print("The solution of the optimization problem leads to rmk+1 parameters equal to %s.\nImpedances, admittances and everything else related to it was already calculated.\n" % self.rmk1)
         
@@ -793,6 +714,10 @@ class Material():
         """
         Given data and it's corresponding frequencies, calculates these data in octave and third-octave bands.
         It is done directly: the value of a band is simply the mean value of all data inside this band.
+        
+        band_system -> optional custom system of bands, given as a dict with its "upper" limits and "center" frequencies 
+                       (as the lower, upper and center tables of this class). If it is passed, the octave and third-octave 
+                       data is not changed, and the centers of the bands with data and their values are returned instead.
         """
         ############################################################    
         if "f_list" in kwargs:
@@ -810,56 +735,12 @@ class Material():
             f_list = self.freq
             
         ############################################################ 
-        first_band_aux = {0:0,
-                          1:0}
-        upper_limit = self.upper[0]
-        while f_list[0] > upper_limit[first_band_aux[0]]:
-            first_band_aux[0] = first_band_aux[0] + 1
-
-        upper_limit = self.upper[1]
-        while f_list[0] > upper_limit[first_band_aux[1]]:
-            first_band_aux[1] = first_band_aux[1] + 1
-
-        for i in np.arange(len(self.upper)):
-
-            upper_limit = self.upper[i]
-            center_freq = self.center[i]
-            aux = first_band_aux[i]
-            
-            data_in_bands = {}
-            f_aux = 0
-            for fi, f in enumerate(f_list):
-                
-                if f < upper_limit[aux]:
+        if "band_system" in kwargs:
+            band_system = kwargs.get("band_system")
+            return band_average(self.statistical_alpha, f_list, band_system["upper"], band_system["center"])
 
-                    if fi == (len(f_list) - 1):
-                        data_in_bands [center_freq[aux]] = np.mean(self.statistical_alpha[f_aux:fi+1])
-
-                    else:
-                        pass   
-
-                else:
-                    data_in_bands [center_freq[aux]] = np.mean(self.statistical_alpha[f_aux:fi])
-
-                    aux = aux + 1
-                    f_aux = fi
-
-                    if fi == (len(f_list) - 1): 
-                        data_in_bands [center_freq[aux]] = self.statistical_alpha[fi]
-
-                    while f > upper_limit[aux]:
-                        aux = aux + 1
-
-            lists = sorted(data_in_bands.items()) # sorted by key, return a list of tuples
-            bands, data_in_bands = zip(*lists) # unpack a list of pairs into two tuples
-
-            if i == 0:
-                self.octave_bands = np.array(bands)
-                self.octave_bands_statistical_alpha = np.array(data_in_bands)    
-                
-            if i == 1:
-                self.third_octave_bands = np.array(bands)
-                self.third_octave_bands_statistical_alpha = np.array(data_in_bands)  
+        self.octave_bands, self.octave_bands_statistical_alpha = band_average(self.statistical_alpha, f_list, self.upper[0], self.center[0])
+        self.third_octave_bands, self.third_octave_bands_statistical_alpha = band_average(self.statistical_alpha, f_list, self.upper[1], self.center[1])
 
     
     def plot(self, **kwargs):
@@ -1013,3 +894,478 @@ def double_layer(zs2, zc1, c1, k1,  d1, c0, theta):
     return z_si
 
 
+def porous_characteristics(flow_resistivity, freq_vec, rho0=1.21, c0=343.0):
+    
+    """
+        Computes the characteristic sound speed, density, impedance and wave number of a porous absorber 
+        (empirical model of Miki). Arrays of flow resistivities and frequencies are broadcast together.
+    """
+    
+    c1=0.0978
+    c2=0.7
+    c3=0.189
+    c4=0.595
+    c5=0.0571
+    c6=0.754
+    c7=0.087
+    c8=0.723
+
+    w = 2*np.pi*np.asarray(freq_vec)
+    X = np.asarray(freq_vec)*rho0/flow_resistivity
+    characteristic_c = c0/(1+c1*np.power(X,-c2) -1j*c3*np.power(X,-c4))
+    characteristic_rho = (rho0*c0/characteristic_c)*(1+c5*np.power(X,-c6)-1j*c7*np.power(X,-c8))
+    
+    return characteristic_c, characteristic_rho, characteristic_rho*characteristic_c, w/characteristic_c
+
+
+def porous_impedance(parameters, freq_vec, theta=0, rho0=1.21, c0=343.0):
+    
+    """
+        Surface impedance of a single layer porous absorber with rigid back end (see Material.porous), without changing any material
+        
+        parameters -> [rf, d]
+        freq_vec -> frequencies [Hz]
+        theta -> angle of incidence
+        
+        Each parameter, freq_vec and theta may be arrays; they are broadcast together with the numpy rules, so a 
+        whole design space is evaluated at once (e.g. rf[:, None, None], d[None, :, None] and freq_vec[None, None, :]).
+    """
+    
+    flow_resistivity, thickness = parameters[0], parameters[1]
+    characteristic_c, _, characteristic_impedance, characteristic_k = porous_characteristics(flow_resistivity, freq_vec, rho0, c0)
+    
+    theta_t = np.arctan(characteristic_c*np.sin(theta)/c0)
+
+    return -1j*(characteristic_impedance)/(np.cos(theta_t))/np.tan((characteristic_k)*np.cos(theta_t)*thickness) 
+
+
+def porous_with_air_cavity_impedance(parameters, freq_vec, theta=0, rho0=1.21, c0=343.0):
+    
+    """
+        Surface impedance of a porous absorber with an air cavity (see Material.porous_with_air_cavity), 
+        broadcast as in porous_impedance
+        
+        parameters -> [rf, d, d_air]
+    """
+    
+    flow_resistivity, thickness, air_cavity_depth = parameters[0], parameters[1], parameters[2]
+    characteristic_c, _, characteristic_impedance, characteristic_k = porous_characteristics(flow_resistivity, freq_vec, rho0, c0)
+    w = 2*np.pi*np.asarray(freq_vec)
+    
+    theta_t_1 = np.arctan(characteristic_c*np.sin(theta)/c0)
+    theta_t_2 = np.arctan(c0*np.sin(theta_t_1)/characteristic_c)
+
+    air_surf_imp = -1j*(rho0*c0)/(np.cos(theta_t_2))/np.tan((w/c0)*np.cos(theta_t_2)*air_cavity_depth)
+
+    return double_layer(air_surf_imp, characteristic_impedance, characteristic_c, characteristic_k, thickness, c0, theta)
+
+
+def membrane_impedance(parameters, freq_vec, theta=0, rho0=1.21, c0=343.0):
+    
+    """
+        Surface impedance of a membrane absorber (see Material.membrane), broadcast as in porous_impedance. 
+        As in Material.membrane, normal incidence is assumed (theta is not used).
+        
+        parameters -> [m, d, rf, d_porous]
+    """
+    
+    mass_per_unit_area, cavity_depth, flow_resistivity, porous_layer_thickness = parameters[0], parameters[1], parameters[2], parameters[3]
+    w = 2*np.pi*np.asarray(freq_vec)
+    
+    porous_surf_imp = porous_impedance([flow_resistivity, porous_layer_thickness], freq_vec, 0, rho0, c0)
+    z_si = double_layer(porous_surf_imp, rho0*c0, c0, w/c0, (cavity_depth - porous_layer_thickness), c0, 0)
+
+    return 1j*w*mass_per_unit_area + z_si
+
+
+def perforated_panel_impedance(parameters, freq_vec, theta=0, rho0=1.21, c0=343.0):
+    
+    """
+        Surface impedance of a perforated panel absorber (see Material.perforated_panel), broadcast as in porous_impedance. 
+        As in Material.perforated_panel, normal incidence is assumed (theta is not used).
+        
+        parameters -> [h, a, p, d, rf, d_porous]
+    """
+    
+    panel_thickness, openings_radius, perforation_rate = parameters[0], parameters[1], parameters[2]
+    cavity_depth, flow_resistivity, porous_layer_thickness = parameters[3], parameters[4], parameters[5]
+    w = 2*np.pi*np.asarray(freq_vec)
+    
+    m = rho0*(panel_thickness + 1.7*openings_radius)/perforation_rate       # superficial density of the gas in each perfuration
+    z_t = 1j*w*m                 # impedance of a single opening
+    
+    # cavity impedance 
+    _, _, characteristic_impedance, characteristic_k = porous_characteristics(flow_resistivity, freq_vec, rho0, c0)
+
+    z_sar = -1j*(rho0*c0) * 1/(np.tan((w/c0)*(cavity_depth-porous_layer_thickness)))
+    
+    z_si = (-1j*z_sar*characteristic_impedance*1/(np.tan(characteristic_k*(porous_layer_thickness))) + (characteristic_impedance)**2) / (z_sar - 1j*characteristic_impedance*1/(np.tan(characteristic_k*(porous_layer_thickness))))
+
+    # The total impedance is the sum:
+    return z_t + z_si
+
+
+def microperforated_panel_impedance(parameters, freq_vec, theta=0, rho0=1.21, c0=343.0, mi0=18.13e-6):
+    
+    """
+        Surface impedance of a microperforated panel absorber (see Material.microperforated_panel), broadcast as in 
+        porous_impedance. As in Material.microperforated_panel, normal incidence is assumed (theta is not used).
+        
+        parameters -> [h, a, p, d_air]
+        mi0 -> dynamic viscosity of air [Pa*s]
+    """
+    
+    panel_thickness, openings_radius, perforation_rate, air_cavity_depth = parameters[0], parameters[1], parameters[2], parameters[3]
+    w = 2*np.pi*np.asarray(freq_vec)
+    
+    s_2 = (rho0*w*openings_radius**2) / (mi0) 
+    
+    z_t = ((32*mi0*panel_thickness)/(4*openings_radius**2) * (1+s_2/32)**0.5 \
+            + 1j*w*rho0*panel_thickness*(1 + (9+s_2/2)**(-0.5)))/(rho0*c0)
+    
+    z_e = (((rho0*mi0*w)/2)**0.5 + 1j*1.7*rho0*w*openings_radius)/(rho0*c0)
+    
+    return ((z_t+z_e)/perforation_rate - 1j*1/(np.tan((w/c0)*air_cavity_depth)))*(rho0*c0)
+
+
+# Surface impedance models of each absorber type (as named in Room.add_material):
+ABSORBER_MODELS = {
+            "porous" : porous_impedance,
+            "porous with air cavity" : porous_with_air_cavity_impedance,
+            "membrane" : membrane_impedance,
+            "perforated panel" : perforated_panel_impedance,
+            "microperforated panel" : microperforated_panel_impedance
+            }
+
+
+def absorber_model(absorber_type, parameters, freq_vec, theta=0, rho0=1.21, c0=343.0, method="thomasson", a=11**0.5, b=11**0.5, n_points=32, **kwargs):
+    
+    """
+        Evaluates an absorber model for whole arrays of parameter sets, frequencies and angles of incidence at once, 
+        without building any material
+        
+        absorber_type -> one of the keys of ABSORBER_MODELS
+        parameters -> parameters of the absorber, as in the corresponding method of Material (each one may be an array)
+        freq_vec, theta -> frequencies [Hz] and angles of incidence, broadcast with the parameters (see porous_impedance)
+        method, a, b, n_points -> options of the statistical absorption (see statistical_alpha)
+        
+        The **kwargs are passed to the model (e.g. mi0 of the microperforated panel).
+        
+        Returns the admittances and the statistical absorption coefficients, both shaped as the broadcast inputs.
+    """
+    
+    if absorber_type not in ABSORBER_MODELS:
+        raise ValueError("Invalid absorber; must be one of %s." % ", ".join(ABSORBER_MODELS))
+    
+    normalized_surface_impedance = ABSORBER_MODELS[absorber_type](parameters, freq_vec, theta, rho0, c0, **kwargs)/(rho0*c0)
+    k0 = 2*np.pi*np.asarray(freq_vec)/c0
+    
+    return np.conj(1/normalized_surface_impedance), statistical_alpha(normalized_surface_impedance, k0, method=method, a=a, b=b, n_points=n_points)
+
+
+def band_index(f_list, upper):
+    
+    """
+        Returns the index of the band of each frequency of f_list. A frequency belongs to the first band whose
+        upper limit is above it (so frequencies below the first band are taken as part of it).
+    """
+    
+    return np.searchsorted(np.asarray(upper), np.asarray(f_list), side="right")
+
+
+def band_average(data, f_list, upper, center):
+    
+    """
+        Computes the mean value of data in each band of a band system, in a single pass.
+        
+        data -> values at the frequencies of f_list (sorted)
+        upper, center -> upper limits and center frequencies of the bands
+        
+        Returns the center frequencies of the bands that have data and the mean values in them. 
+        Frequencies above the last band are left out.
+    """
+    
+    data = np.asarray(data)
+    index = band_index(f_list, upper)
+    inside = index < len(upper)
+    
+    bands, first, counts = np.unique(index[inside], return_index=True, return_counts=True)
+    if bands.size == 0:
+        return np.array([]), np.array([])
+    
+    return np.asarray(center)[bands], np.add.reduceat(data[inside], first)/counts
+
+
+def band_interpolate(bands, data, f_list):
+    
+    """
+        Interpolates band data onto the frequencies of f_list, in a single pass. The interpolation is linear 
+        between the band centers and the data is kept constant below the first band and above the last one.
+    """
+    
+    return np.interp(np.asarray(f_list, dtype=np.float64), np.asarray(bands, dtype=np.float64), np.asarray(data, dtype=np.float64))
+
+
+def rmk1_impedance(parameters, w):
+    
+    """
+        Computes the normalized surface impedance of the RMK + 1 model and its derivatives with respect to the 
+        parameters, without changing any material
+        
+        parameters -> [k, r, m, g, gama], normalized as in Material.impedance_thru_rmk1
+        w -> angular frequencies
+        
+        Returns the impedances (one per frequency) and their derivatives, shaped [parameter, frequency].
+    """
+    
+    jw = 1j*np.asarray(w, dtype=np.float64)
+    k, r, m, g, gama = parameters
+    
+    zs = k*(10**4)*jw**(-1) + r + m*(10**-4)*jw + g*(10)*jw**gama
+    
+    dzs_dparameters = np.array([(10**4)*jw**(-1), 
+                                np.ones(jw.shape, dtype=np.complex128), 
+                                (10**-4)*jw, 
+                                (10)*jw**gama, 
+                                g*(10)*jw**gama*np.log(jw)])
+    
+    return zs, dzs_dparameters
+
+
+def rmk1_cost(parameters, f_list, alpha_in, c0=343.0, a=11**0.5, b=11**0.5, n_points=32):
+    
+    """
+        Cost function of Material.impedance_from_alpha and its gradient, without changing any material
+        (squared L2-norm between the statistical absorption coefficients of the RMK + 1 model, averaged in 
+        the bands, and the input absorption coefficients)
+        
+        parameters -> [k, r, m, g, gama], normalized as in Material.impedance_thru_rmk1
+        f_list -> frequencies, three per band
+        alpha_in -> statistical absorption coefficient of each band
+        
+        The gradient is exact for the Gauss-Legendre rule of statistical_alpha (the quadrature angles 
+        only depend on the frequencies).
+    """
+    
+    f_list = np.asarray(f_list, dtype=np.float64)
+    zs, dzs_dparameters = rmk1_impedance(parameters, 2*np.pi*f_list)
+    
+    theta, weights, z_radiation = _thomasson_quadrature(2*np.pi*f_list/c0, a, b, n_points)
+    
+    # Integrand x*sin(theta)/|z + z_radiation|^2 (z = x + 1j*y) and its derivatives with respect to x and y:
+    d = zs + z_radiation
+    denominator = abs(d)**2
+    integral = np.sum(weights * zs.real*np.sin(theta) / denominator, axis=0)
+    dintegral_dx = np.sum(weights * np.sin(theta) * (1/denominator - 2*zs.real*d.real/denominator**2), axis=0)
+    dintegral_dy = np.sum(weights * np.sin(theta) * (-2*zs.real*d.imag/denominator**2), axis=0)
+    
+    alpha = 8 * abs(integral)
+    dalpha_dparameters = 8 * np.sign(integral) * (dintegral_dx*dzs_dparameters.real + dintegral_dy*dzs_dparameters.imag)
+    
+    # Mean of the three frequencies of each band:
+    difference = alpha_in - alpha.reshape((-1, 3)).mean(axis=1)
+    cost = np.inner(difference, difference)
+    gradient = -2 * dalpha_dparameters.reshape((5, -1, 3)).mean(axis=2) @ difference
+    
+    return cost, gradient
+
+
+def rmk1_constraint(parameters, f_list, constraint):
+    
+    """
+        Inequality constraints (>= 0) of Material.impedance_from_alpha and their jacobian
+        
+        constraint -> "soft" (real part of the normalized impedance below 2, for soft porous absorbers, perforated 
+                      panels and membranes) or "hard" (real part above 1, for the other absorbers)
+    """
+    
+    zs, dzs_dparameters = rmk1_impedance(parameters, 2*np.pi*np.asarray(f_list, dtype=np.float64))
+    
+    if constraint == "soft":
+        return 2 - zs.real, -dzs_dparameters.real.T
+    else:
+        return zs.real - 1, dzs_dparameters.real.T
+
+
+def _fit_rmk1(guesses, problem):
+    
+    """
+        Solves the constrained optimization problem of Material.impedance_from_alpha from one set of guesses, 
+        returning the parameters and the cost. Module level, so that it can run in a process pool.
+    """
+    
+    f_list = problem["f_list"]
+    
+    ineq_cons = {'type': 'ineq',
+                 'fun': lambda parameters: rmk1_constraint(parameters, f_list, problem["constraint"])[0], 
+                 'jac': lambda parameters: rmk1_constraint(parameters, f_list, problem["constraint"])[1]}
+    
+    cost_fun = lambda parameters: rmk1_cost(parameters, f_list, problem["alpha_in"], problem["c0"])
+    
+    solution = minimize(cost_fun, guesses, jac=True, method='SLSQP', constraints = [ineq_cons], bounds = problem["bounds"], 
+                        options={'ftol': 1e-10, 'disp': False, 'maxiter': 1000})
+    
+    return solution.x, cost_fun(solution.x)[0]
+
+
+def _fit_rmk1_starts(guesses, problem, executor=None):
+    
+    """
+        Solves the optimization problem from each set of guesses (in the process pool executor, if given).
+    """
+    
+    if executor is not None and len(guesses) > 1:
+        return list(executor.map(functools.partial(_fit_rmk1, problem=problem), guesses))
+        
+    return [_fit_rmk1(guess, problem) for guess in guesses]
+
+
+def statistical_alpha(normalized_surface_impedance, k0, method="thomasson", a=11**0.5, b=11**0.5, n_points=32):
+    
+    """
+        Computes the statistical absorption coefficients of all frequencies at once, integrating over the 
+        angle of incidence with a Gauss-Legendre rule of n_points angles (see Material.impedance2alpha)
+        
+        normalized_surface_impedance -> normalized surface impedance of each frequency
+        k0 -> wave number of each frequency (only used by the Thomasson formulation)
+        method -> "thomasson" (finite absorber of sides a and b) or "paris" (infinite absorber)
+        n_points -> number of angles. The Thomasson integrand has a kink at the angle where its radiation 
+                    reactance switches branch, so the integral is split at that angle and each part gets n_points.
+    """
+    
+    zs = np.asarray(normalized_surface_impedance)
+    
+    if method == "thomasson":
+        
+        # The quadrature only depends on k0, so it is built on its own shape (aligned with the impedances) and 
+        # accumulated angle by angle, which keeps the memory of large batches (see absorber_model) bounded:
+        k0 = np.asarray(k0, dtype=np.float64)
+        k0 = k0.reshape((1,)*(zs.ndim - k0.ndim) + k0.shape)
+        theta, weights, z_radiation = _thomasson_quadrature(k0, a, b, n_points)
+        
+        alpha = 0
+        for i in range(theta.shape[0]):
+            alpha = alpha + weights[i] * zs.real*np.sin(theta[i]) / (abs(zs + z_radiation[i]))**2
+        
+        return 8 * abs(alpha)
+    
+    elif method == "paris":
+        
+        x, w = np.polynomial.legendre.leggauss(n_points)
+        theta = ((x + 1)*np.pi/4).reshape((-1,) + (1,)*zs.ndim)
+        w = w.reshape((-1,) + (1,)*zs.ndim)
+        
+        return abs(np.sum(w*np.pi/4*_paris_integrand(theta, zs), axis=0))
+    
+    else:
+        raise ValueError("Method is not valid. You must use \"paris\" or \"thomasson\".")
+
+
+def _thomasson_quadrature(k0, a, b, n_points):
+    
+    """
+        Angles, weights and radiation impedances of the Gauss-Legendre rule of the Thomasson formulation, shaped 
+        [angle, *k0.shape]. The rule is split at the kink of the integrand (see _thomasson_kink).
+    """
+    
+    x, w = np.polynomial.legendre.leggauss(n_points)
+    x = x.reshape((-1,) + (1,)*k0.ndim)
+    w = w.reshape((-1,) + (1,)*k0.ndim)
+    
+    theta_kink = _thomasson_kink(k0, a, b)
+    
+    theta = []
+    weights = []
+    for lower, upper in ((np.zeros(k0.shape), theta_kink), (theta_kink, np.full(k0.shape, np.pi/2))):
+        theta.append(lower + (x + 1)/2*(upper - lower))
+        weights.append(w*(upper - lower)/2)
+    theta = np.concatenate(theta)
+    
+    return theta, np.concatenate(weights), _thomasson_radiation_impedance(theta, k0, a, b)
+
+
+def _thomasson_radiation(k0, a, b):
+    
+    """
+        Parts of the radiation impedance of the Thomasson formulation that do not depend on the angle of incidence.
+    """
+    
+    ke = (2*k0*a*b) / (a+b)
+    kappa = 0.956 / ke
+
+    def h(q):
+        h = np.log((1+q**2)**(1/2) + q) - ((1+q**2)**(1/2)-1)/(3*q)
+        return h
+
+    z_l = (2*k0*a*b / np.pi) + 1j*(2*k0 / np.pi) * (b*h(a/b) + a*h(b/a))
+
+    z_hi0 = 0.67/ke
+    z_i0 = 1 / ((1/(z_l.imag**3))**(1/3) + (1/(z_hi0**3))**(1/3))
+    
+    return kappa, z_l, z_i0
+
+
+def _thomasson_radiation_impedance(theta, k0, a, b):
+    
+    """
+        Radiation impedance of the Thomasson formulation, for arrays of angles and wave numbers (broadcast).
+    """
+    
+    kappa, z_l, z_i0 = _thomasson_radiation(k0, a, b)
+    
+    mi = np.sin(theta)
+    z_h = 1 / ((1 + (kappa-1j*mi)**2)**(1/2))
+
+    z_r = 1 / ((1/(z_l.real**2))**(1/2) + (1/(z_h.real**2))**(1/2))
+    z_i = np.maximum(z_i0, z_h.imag)
+
+    return z_r + 1j*z_i
+
+
+def _thomasson_integrand(theta, zs, k0, a, b):
+    
+    """
+        Integrand of the Thomasson formulation, for arrays of angles, impedances and wave numbers (broadcast).
+    """
+    
+    z_radiation = _thomasson_radiation_impedance(theta, k0, a, b)
+
+    return zs.real*np.sin(theta) / (abs(zs + z_radiation))**2
+
+
+def _thomasson_kink(k0, a, b, iterations=60):
+    
+    """
+        Angle at which the radiation reactance of the Thomasson formulation switches from z_i0 to the imaginary 
+        part of z_h (found by bisection for all wave numbers at once), or pi/2 if it does not switch.
+    """
+    
+    kappa, z_l, z_i0 = _thomasson_radiation(k0, a, b)
+    g = lambda theta: (1 / ((1 + (kappa-1j*np.sin(theta))**2)**(1/2))).imag - z_i0
+    
+    lower = np.zeros(np.shape(k0))
+    upper = np.full(np.shape(k0), np.pi/2)
+    g_lower = g(lower)
+    switches = np.sign(g_lower) != np.sign(g(upper))
+    
+    for i in range(iterations):
+        middle = (lower + upper)/2
+        g_middle = g(middle)
+        left = np.sign(g_middle) == np.sign(g_lower)
+        lower = np.where(left, middle, lower)
+        g_lower = np.where(left, g_middle, g_lower)
+        upper = np.where(left, upper, middle)
+    
+    return np.where(switches, (lower + upper)/2, np.pi/2)
+
+
+def _paris_integrand(theta, zs):
+    
+    """
+        Integrand of the Paris formula, for arrays of angles and impedances (broadcast).
+    """
+    
+    vp =  (zs*np.cos(theta) - 1)/(zs*np.cos(theta) + 1)    
+    alpha = 1 - (abs(vp))**2
+    
+    return alpha*np.sin(2*theta)
@@ -1,5 +1,19 @@
 #Post-processing functions that might help
 
+def _load(room):
+    '''
+    Returns the room itself if a Room object is given, or the room saved in the given .pickle file otherwise.
+    '''
+    
+    if isinstance(room, str):
+        import pickle
+        
+        file_to_read = open(room, "rb")
+        room = pickle.load(file_to_read)
+        file_to_read.close()
+        
+    return room
+
 #def mac (file_path, configuration_names, ref=1, source_analisys=1):
 def mac (reference_path, compared_paths, sources=[], receivers=[], plot=True):
   
@@ -10,6 +24,7 @@ def mac (reference_path, compared_paths, sources=[], receivers=[], plot=True):
     compared -> paths to the .pickle files that carry the simulation results that is gonna be compared to the reference to compute the MAC. 
                 It must be a list of strings. Example:
                     compared = ["file_1.pickle", "file_2.pickle", "file_3.pickle"]
+                Room objects can be given instead of paths (e.g. the rooms returned by Room.run_material_sweep()).
     sources -> numbers of the sources that you are gonna use to compare. If not given, all the sources are gonna be used to compute the MAC. 
     receivers -> numbers of the receivers that you are gonna use to compare. If not given, all the receivers are gonna be used to compute the MAC.
     
@@ -18,17 +33,11 @@ def mac (reference_path, compared_paths, sources=[], receivers=[], plot=True):
     import numpy as np
 
     try:
-        import pickle
-
-        file_to_read = open(reference_path, "rb")
-        ref = pickle.load(file_to_read)
-        file_to_read.close()
+        ref = _load(reference_path)
 
         compared_list = []
         for path in compared_paths:
-            file_to_read = open(path, "rb")
-            compared_list.append(pickle.load(file_to_read))
-            file_to_read.close()
+            compared_list.append(_load(path))
 
         sources = np.array(sources)
         receivers = np.array(receivers)
@@ -38,27 +47,22 @@ def mac (reference_path, compared_paths, sources=[], receivers=[], plot=True):
         if receivers.size == 0:
             receivers = np.arange(len(ref.receivers))
 
+        # [frequency, source * receiver * channel], without the unused channels (NaN) of omni receivers:
+        reference = ref.pressure_array()[:, sources][:, :, receivers].reshape((len(ref.simulated_freqs), -1))
+        channels = ~np.isnan(reference).any(axis=0)
+        reference = reference[:, channels]
+
         mac_list = []
         for compared in compared_list:
 
-            reference = []
-            to_be_compared = []
-            
-            for source in sources:
-                for receiver in receivers:
-
-                    for s_i, s in enumerate(compared.sources):
-                        for r_i, r in enumerate(compared.receivers):
-                            if s_i == source and r_i == receiver:
-                                reference.append(ref.total_pressure[s_i*len(ref.receivers)+r_i : : len(ref.sources)*len(ref.receivers)])
-                                to_be_compared.append(compared.total_pressure[s_i*len(compared.receivers)+r_i : : len(compared.sources)*len(compared.receivers)])
+            to_be_compared = compared.pressure_array()[:, sources][:, :, receivers].reshape((len(compared.simulated_freqs), -1))[:, channels]
 
             mac = []
 
             for fi, f in enumerate(ref.simulated_freqs):
 
-                ref_aux = np.array(reference)[:,fi]
-                to_be_compared_aux = np.array(to_be_compared)[:,fi]
+                ref_aux = reference[fi]
+                to_be_compared_aux = to_be_compared[fi]
                 mac.append((abs(np.matmul(ref_aux.conj(), to_be_compared_aux.transpose()))**2) / np.real((np.matmul(ref_aux.conj(), ref_aux.transpose())) * np.matmul(to_be_compared_aux.conj(), to_be_compared_aux.transpose())))
 
             mac_list.append(mac)
@@ -72,9 +76,7 @@ def mac (reference_path, compared_paths, sources=[], receivers=[], plot=True):
         
         compared_list = []
         for path in compared_paths:
-            file_to_read = open(path, "rb")
-            compared_list.append(pickle.load(file_to_read))
-            file_to_read.close()
+            compared_list.append(_load(path))
 
         sources = np.array(sources)
         receivers = np.array(receivers)
@@ -88,22 +90,15 @@ def mac (reference_path, compared_paths, sources=[], receivers=[], plot=True):
         for source in sources:
             for compared in compared_list:
 
-                to_be_compared = []
-
-                for receiver in receivers:
-
-                    for s_i, s in enumerate(compared.sources):
-                        for r_i, r in enumerate(compared.receivers):
-                            if s_i == source and r_i == receiver:
-                                to_be_compared.append(compared.total_pressure[s_i*len(compared.receivers)+r_i : : len(compared.sources)*len(compared.receivers)])
+                # [receiver, frequency], like the reference:
+                to_be_compared = compared.pressure_array()[:, source, receivers, 0].T
 
-                print(to_be_compared)
                 mac = []
 
                 for fi, f in enumerate(compared.simulated_freqs):
 
                     ref_aux = reference[:,fi]
-                    to_be_compared_aux = np.array(to_be_compared)[:,fi]
+                    to_be_compared_aux = to_be_compared[:,fi]
                     mac.append((abs(np.matmul(ref_aux.conj(), to_be_compared_aux.transpose()))**2) / np.real((np.matmul(ref_aux.conj(), ref_aux.transpose())) * np.matmul(to_be_compared_aux.conj(), to_be_compared_aux.transpose())))
 
                 mac_list.append(mac)
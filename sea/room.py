@@ -10,6 +10,7 @@ from matplotlib import pylab as plt
 import matplotlib as mpl
 import cloudpickle
 import collections
+import copy
 bempp.api.PLOT_BACKEND = "gmsh"
 import gmsh_api.gmsh as gmsh
 #import gmsh.api.gmsh as gmsh
@@ -22,12 +23,19 @@ import pickle
 
 warnings.filterwarnings('ignore')
 
+# Number of elements per wavelength (factor) used to mesh each frequency band. Each entry is
+# (upper frequency of the band [Hz], factor):
+MESH_BANDS = ((50, 12), (100, 10), (150, 8), (265, 6), (np.inf, 4))
+
 from sea.definitions import Air
 from sea.definitions import Algorithm
 from sea.definitions import Receiver
 from sea.definitions import Source
 from sea.materials import Material
 import sea.spherical_harmonics as sh
+import sea.solvers as solvers
+from sea.store import ResultStore
+from sea.catalogue import MaterialCatalogue
 
 
 class Room:   
@@ -43,6 +51,27 @@ class Room:
             self.room_name = kwargs["room_name"]
         except:
             self.room_name = "my_room"
+            
+        try:
+            self.mesh_cache = kwargs["mesh_cache"]
+        except:
+            self.mesh_cache = "mesh_cache"
+            
+        try:
+            self.result_store = kwargs["result_store"]
+        except:
+            self.result_store = "results"
+            
+        try:
+            self.material_cache = kwargs["material_cache"]
+        except:
+            self.material_cache = "material_cache"
+            
+        # Folder of the spherical harmonic translation coefficients (see sea.spherical_harmonics.translate_sh):
+        try:
+            self.sh_cache = kwargs["sh_cache"]
+        except:
+            self.sh_cache = "sh_cache"
         
         self.receivers = []
         self.sources = []
@@ -51,11 +80,14 @@ class Room:
         self.boundary_pressure = [] 
         self.boundary_velocity = [] 
         
-        self.scattered_pressure = []
-        self.incident_pressure = []
-        self.total_pressure = []
+        # Receiver pressures are arrays shaped [frequency, source, receiver, channel] (see .pressure()):
+        self.scattered_pressure = np.zeros((0, 0, 0, 1), dtype=np.complex128)
+        self.incident_pressure = np.zeros((0, 0, 0, 1), dtype=np.complex128)
+        self.total_pressure = np.zeros((0, 0, 0, 1), dtype=np.complex128)
         
         self.simulated_freqs = []
+        self.simulated_meshes = []
+        self.solver_info = []
         
         
     def air_properties(self, c0 = 343.0, rho0 = 1.21, temperature = 20.0, humid = 50.0, p_atm = 101325.0):
@@ -148,9 +180,10 @@ class Room:
             self.path_to_msh = key
      
     
-    def generate_mesh(self, c0, freq, factor):
+    def generate_mesh(self, c0, freq, factor, msh_path="last_msh.msh"):
         """
         This function generates a .msh file from the .geo file uploaded.
+        The mesh is written to msh_path (default is last_msh.msh).
         """
         
         import meshio
@@ -174,7 +207,7 @@ class Room:
         gmsh.model.mesh.generate(2)
         #gmsh.model.mesh.setOrder(1)
         
-        gmsh.write("last_msh.msh")
+        gmsh.write(msh_path)
         gmsh.finalize()
 
         #max_element_size = (c0/freq)/6
@@ -205,10 +238,96 @@ class Room:
             gmsh.model.addPhysicalGroup(2, phgr_ent[i],phgr_ordered[i])
 
             
-        gmsh.write("last_msh.msh")
+        gmsh.write(msh_path)
         gmsh.finalize() 
         '''
-        self.path_to_msh = "last_msh.msh"
+        self.path_to_msh = msh_path
+        
+        
+    def mesh_band(self, freq):
+        """
+        Returns the frequency for which the mesh used at freq is built and the number of elements per wavelength (factor).
+        All frequencies that fall inside the same band of MESH_BANDS share one mesh, built for the highest frequency 
+        of the algorithm inside that band.
+        """
+        
+        lower = 0
+        for upper, factor in MESH_BANDS:
+            if freq <= upper:
+                break
+            lower = upper
+            
+        freq_mesh = freq
+        if hasattr(self, "frequencies"):
+            freq_vec = np.array(self.frequencies.freq_vec)
+            in_band = freq_vec[(freq_vec > lower) & (freq_vec <= upper)]
+            if in_band.size != 0:
+                freq_mesh = max(freq, np.max(in_band))
+                
+        return freq_mesh, factor
+    
+    
+    def geometry_hash(self):
+        """
+        Returns a hash of the content of the .geo file, which keys the meshes of the mesh cache.
+        """
+        
+        import hashlib
+        
+        try:
+            geo_file = open(self.path_to_geo, "rb")
+        except:
+            print("Geometry was not find. Please, upload a .geo file:")
+            self.add_geometry()
+            geo_file = open(self.path_to_geo, "rb")
+        geo_hash = hashlib.sha1(geo_file.read()).hexdigest()
+        geo_file.close()
+        
+        return geo_hash
+    
+    
+    def mesh_path(self, freq, band_meshes=True, geo_hash=None):
+        """
+        Returns the path of the mesh used at frequency freq in the mesh cache (see .get_mesh()), without generating it.
+        geo_hash is the hash of the geometry (see .geometry_hash()); pass it to avoid reading the .geo file again.
+        """
+        
+        freq_mesh, factor = self.mesh_band(freq)
+        if band_meshes != True:
+            freq_mesh = freq
+        element_size = (self.air.c0/freq_mesh)/factor
+        
+        if geo_hash is None:
+            geo_hash = self.geometry_hash()
+        
+        return os.path.join(self.mesh_cache, "msh_%s_%0.6f.msh" % (geo_hash[:16], element_size))
+    
+    
+    def get_mesh(self, freq, band_meshes=True):
+        """
+        Returns the path to the mesh used at frequency freq, generating it only if it is not in the mesh cache yet.
+        
+        Meshes are stored in the self.mesh_cache folder, keyed by a hash of the content of the .geo file and by the 
+        maximum element size. So, they persist across runs and are shared by every room built from the same geometry.
+        If band_meshes is True, all frequencies of a band of MESH_BANDS share the same mesh (see .mesh_band()). 
+        Otherwise, a mesh is built for freq itself.
+        """
+        
+        path = self.mesh_path(freq, band_meshes)
+        
+        if os.path.isfile(path) != True:
+            freq_mesh, factor = self.mesh_band(freq)
+            if band_meshes != True:
+                freq_mesh = freq
+            os.makedirs(self.mesh_cache, exist_ok=True)
+            # Mesh into a temporary file and move it afterwards, so that parallel workers never read a half written mesh:
+            tmp_path = os.path.join(self.mesh_cache, "tmp_%s_%s.msh" % (os.path.basename(path)[4:20], os.getpid()))
+            self.generate_mesh(self.air.c0, freq_mesh, factor, tmp_path)
+            os.replace(tmp_path, path)
+        
+        self.path_to_msh = path
+        
+        return path
         
     
     def add_geometry(self):
@@ -265,7 +384,8 @@ class Room:
                     self.materials.append(material)
                 
                 elif material.admittance.size == 0:
-                    material.impedance_from_alpha(absorber_type=kwargs["absorber_type"])
+                    # Materials fitted before (by this or any other room) are taken from the catalogue:
+                    material.impedance_from_alpha(absorber_type=kwargs["absorber_type"], catalogue=MaterialCatalogue(self.material_cache))
                     self.materials.append(material)
                     
             else:
@@ -315,9 +435,7 @@ class Room:
             '''
             
             
-            self.generate_mesh(self.air.c0, f, 6)
-
-            grid = bempp.api.import_grid(self.path_to_msh)
+            grid = bempp.api.import_grid(self.get_mesh(f))
             
             def configure_plotly_browser_state():
                 import IPython
@@ -366,7 +484,46 @@ class Room:
             plotly.offline.iplot(fig)
         
         
-    def run(self, save=True):
+    def run(self, save=True, workers=1, chunk_size=None, solver="auto", tol=1E-5, band_meshes=True, preconditioner=None, 
+            assembler="auto", precision="single", refine=0, resume=False):
+        '''
+        Runs the simulation for all frequencies of the algorithm.
+        Inputs:
+            save - if True, the results of each frequency are appended to the result store of the room (the folder 
+                   self.result_store/self.room_name, see sea.store) as soon as they are solved, and the room is saved 
+                   once at the end of the run.
+            resume - if True, the frequencies that are already in the result store (e.g. of a run that was interrupted) 
+                     are loaded from it instead of being solved again. Records written for another setup (materials, 
+                     sources, receivers or mesh) are solved again.
+            workers - number of worker processes. If greater than 1, the frequencies are solved in parallel, 
+                      since each one of them is independent from the others.
+            chunk_size - number of consecutive frequencies sent to a worker at once (only used if workers > 1). 
+                         By default, the frequencies are split in about four chunks per worker.
+            solver - how the boundary pressure of all sources is solved at each frequency. It must be "lu" (one dense 
+                     LU factorization shared by all sources), "block gmres" (one block Krylov space shared by all sources), 
+                     "gmres" (one GMRES solve per source), "recycled gmres" (GCRO-DR, which warm starts each frequency 
+                     from the solution of the previous one and recycles a deflation subspace between them, as long as 
+                     they share the same mesh - see band_meshes) or "auto" (default), which picks the cheapest one of 
+                     "lu", "block gmres" and "gmres" based on the number of degrees of freedom, the number of sources and 
+                     the assembler. See sea.solvers. The method, iterations and solve time of each frequency are kept in .solver_info.
+            tol - relative tolerance of the iterative solvers (default is 1E-5).
+            preconditioner - preconditioner of the iterative solvers. It must be None (default), "block jacobi" (inverse of 
+                             the blocks of each physical group) or "near field" (sparse approximate inverse built from the 
+                             nearest elements of each element). It is built once per frequency and used for all sources. 
+                             Its build time is kept in .solver_info, next to the iterations and solve time.
+            assembler - assembler of the boundary operators. It must be "dense", "fmm" or "auto" (default), which uses 
+                        "dense" up to 20000 degrees of freedom and "fmm" above it (see sea.solvers.select_backend). 
+                        Note that "lu" needs the dense matrix, so it is not meant for "fmm". With "fmm", the preconditioners 
+                        are built from the sparse near field (singular part) of the operators, so the dense matrix is never built.
+            precision - "single" (default) or "double". It is the precision used by bempp to assemble the operators 
+                        and the precision of the LU factors.
+            refine - number of iterative refinement steps after a LU solve (default is 0). With single precision 
+                     LU factors, one or two steps recover the accuracy of the assembled operators.
+            The assembler, precision and number of degrees of freedom of each frequency are kept in .solver_info.
+            band_meshes - if True (default), all frequencies inside a band of MESH_BANDS share the same mesh, built for 
+                          the highest frequency of the band. Otherwise, each frequency gets its own mesh. Either way, 
+                          meshes are taken from the mesh cache whenever possible (see .get_mesh()).
+        '''
   
         if hasattr(self, "frequencies") != True:
             print("Algorithm frequencies are not defined yet.")
@@ -385,71 +542,538 @@ class Room:
                     #raise ValueError("The frequencies considered to calculate one of the spherical harmonic coefficients for the "
                                      #+ str(si) +  " source are not the same that you are considering in the simulation.")
         
+        self._sweep([self], [self._admittances(self.materials)], save, workers, chunk_size, 
+                    solver=solver, tol=tol, band_meshes=band_meshes, preconditioner=preconditioner, 
+                    assembler=assembler, precision=precision, refine=refine, resume=resume)
+        
+        
+    def run_material_sweep(self, configurations, save=True, workers=1, chunk_size=None, solver="auto", tol=1E-5, band_meshes=True, preconditioner=None, 
+            assembler="auto", precision="single", refine=0, resume=False):
+        '''
+        Runs the simulation for several material configurations of the same room (same geometry, sources 
+        and receivers). The mesh and the boundary operators of each frequency only depend on the geometry, 
+        so they are built once and shared by all configurations; only the admittance operator and the 
+        right-hand sides are rebuilt for each one of them.
+        Inputs:
+            configurations - list of material configurations. Each configuration is a list of Material objects, 
+                             with one material per physical group (the same way as .add_material()).
+            The other inputs are the same of .run().
+        Returns a list with one copy of the room per configuration, holding its materials and its results. 
+        Each copy can be saved, viewed and post-processed (e.g. by sea.post.mac) like any other room.
+        '''
+        
+        if hasattr(self, "frequencies") != True:
+            raise ValueError("Algorithm frequencies are not defined yet.")
+            
+        rooms = []
+        for ci, materials in enumerate(configurations):
+            room = copy.copy(self)
+            room.room_name = "%s_config_%s" % (self.room_name, ci)
+            room.materials = list(materials)
+
+            # The copy is shallow, so each room gets its own receiver and source lists and result containers
+            # (e.g. .receiver_evaluate() on one room must not add the receivers to the others):
+            room.receivers = list(self.receivers)
+            room.sources = list(self.sources)
+            room.boundary_pressure = list(self.boundary_pressure)
+            room.boundary_velocity = list(self.boundary_velocity)
+            room.incident_pressure = self.incident_pressure.copy()
+            room.scattered_pressure = self.scattered_pressure.copy()
+            room.total_pressure = self.total_pressure.copy()
+            room.simulated_freqs = list(self.simulated_freqs)
+            room.simulated_meshes = list(self.simulated_meshes)
+            room.solver_info = list(self.solver_info)
+            rooms.append(room)
+            
+        self._sweep(rooms, [self._admittances(room.materials) for room in rooms], save, workers, chunk_size, 
+                    solver=solver, tol=tol, band_meshes=band_meshes, preconditioner=preconditioner, 
+                    assembler=assembler, precision=precision, refine=refine, resume=resume)
+        
+        return rooms
+    
+    
+    def _admittances(self, materials):
+        '''
+        Returns the admittance table (one admittance array per material) of a material configuration.
+        '''
+        
         admittances = []
-        if len(self.materials) == 0:
+        if len(materials) == 0:
             for i in (np.unique(self.grid.domain_indices)):
                 admittances.append(Material(admittance = np.zeros_like(self.frequencies.freq_vec, dtype=np.complex64), freq_vec=self.frequencies.freq_vec, rho0=self.air.rho0, c0=self.air.c0))
         else:
-            for material in self.materials:
+            for material in materials:
                 admittances.append(material.admittance)
                 
-        bempp.api.DEVICE_PRECISION_CPU = 'single'  
+        return admittances
+    
+    
+    def _sweep(self, rooms, configurations, save=True, workers=1, chunk_size=None, resume=False, **kwargs):
+        '''
+        Solves all frequencies for the given material configurations and stores the results of each 
+        configuration in the matching room of rooms. The kwargs are passed on to ._run_frequency().
+        With save=True, the results of each frequency are appended to the result store of each room as soon 
+        as they are solved (see sea.store.ResultStore) and the rooms are pickled once, at the end. With 
+        resume=True, the frequencies that are already in the result stores of all rooms are loaded instead of solved.
+        '''
+        
+        freq_vec = self.frequencies.freq_vec
+        
+        stores = []
+        keys = []
+        if save == True or resume == True:
+            stores = [ResultStore(os.path.join(room.result_store, room.room_name)) for room in rooms]
+            # Setup key of each room and frequency, so records of another setup (e.g. of a run before a material, 
+            # source or receiver was changed) are never taken as results of this one:
+            geo_hash = self.geometry_hash()
+            meshes = [os.path.basename(self.mesh_path(f, kwargs.get("band_meshes", True), geo_hash)) for f in freq_vec]
+            keys = [room._setup_keys(admittances, meshes) for room, admittances in zip(rooms, configurations)]
+        
+        done = set()
+        if resume == True:
+            done = set(fi for fi, f in enumerate(freq_vec) if all(store.contains(f, key[fi]) for store, key in zip(stores, keys)))
+            stale = [fi for fi, f in enumerate(freq_vec) if fi not in done and any(store.contains(f) for store in stores)]
+            print("Resuming: %s of %s frequencies are already in the result store." % (len(done), len(freq_vec)))
+            if len(stale) != 0:
+                print("%s frequencies of the result store were solved for a different setup (materials, sources, receivers " 
+                      "or mesh) and will be solved again." % len(stale))
+        
+        for room in rooms:
+            room._allocate_results(len(freq_vec))
+        
+        pending = [fi for fi in range(len(freq_vec)) if fi not in done]
+        solved = self._solve_frequencies(pending, configurations, workers, chunk_size, **kwargs)
+        
+        try:
+            for fi, f in enumerate(freq_vec):
+                
+                if fi in done:
+                    all_results = [store.load(f) for store in stores]
+                else:
+                    all_results = next(solved)
+                    if save == True:
+                        for store, key, results in zip(stores, keys, all_results):
+                            store.append(results, key[fi])
+                
+                for room, results in zip(rooms, all_results):
+                    room._store_results(results)
+        finally:
+            for store in stores:
+                store.close()
+        
+        if save == True:
+            for room in rooms:
+                room.save()
+                
+                
+    def _near_field_matrix(self, space, k, identity, dof_admittance):
+        '''
+        Returns the sparse matrix of the near field of the left-hand side (.5*identity + dlp - 1j*k*slp*mu_op), with 
+        the singular part (interactions between adjacent elements) of the boundary operators.
+        '''
+        
+        import scipy.sparse
+        
+        slp_near = bempp.api.operators.boundary.helmholtz.single_layer(
+            space, space, space, k, assembler="only_singular_part").weak_form().A
+        dlp_near = bempp.api.operators.boundary.helmholtz.double_layer(
+            space, space, space, k, assembler="only_singular_part").weak_form().A
+        
+        # On DP0 spaces, the mass matrix is diagonal, so slp*mu_op is the single layer scaled column by column by the admittance:
+        return (.5 * identity.weak_form().A + dlp_near - 1j*k*slp_near @ scipy.sparse.diags(dof_admittance)).tocsr()
+    
+    
+    def _setup_keys(self, admittances, meshes):
+        '''
+        Returns the setup key of each frequency: a hash of everything its results depend on, i.e. the admittance 
+        table of the materials, the sources and receivers (types, coordinates, orientations and data) and the 
+        name of its mesh (meshes holds one name per frequency).
+        '''
+        
+        import hashlib
+        
+        def update(data, value):
+            if isinstance(value, (list, tuple)):
+                for item in value:
+                    update(data, item)
+                return
+            value = np.asarray(value)
+            if value.dtype == object:
+                update(data, list(value.ravel()))
+            else:
+                data.update(("%s%s" % (value.dtype, value.shape)).encode())
+                data.update(value.tobytes())
+        
+        data = hashlib.sha1()
+        update(data, [np.asarray(getattr(admittance, "admittance", admittance), dtype=np.complex128) for admittance in admittances])
+        for source in self.sources:
+            for name in ("type", "coord", "q", "elevation", "azimuth", "power_correction", "sh_order", "sh_coefficients"):
+                update(data, [name, getattr(source, name, "")])
+        for receiver in self.receivers:
+            for name in ("type", "coord", "azimuth", "sh_order", "sh_coefficients_left", "sh_coefficients_right"):
+                update(data, [name, getattr(receiver, name, "")])
         
-        for fi,f in enumerate(self.frequencies.freq_vec):
+        # The setup is hashed once and only the mesh name is added for each frequency:
+        keys = []
+        for mesh in meshes:
+            key = data.copy()
+            update(key, mesh)
+            keys.append(key.hexdigest())
+        
+        return keys
+                
+                
+    def _solve_frequencies(self, freq_indices, configurations, workers=1, chunk_size=None, **kwargs):
+        '''
+        Solves the given frequencies for all configurations, yielding the results of each one of them 
+        (as returned by ._run_frequency()) in frequency order.
+        '''
+        
+        if workers > 1:
+            yield from self._run_parallel(freq_indices, configurations, workers, chunk_size, **kwargs)
+            return
+        
+        # Solver state carried from one frequency to the next (one per configuration), and angular tables 
+        # shared by all frequencies of the same mesh:
+        solver_states = [{} for admittances in configurations]
+        angular_tables = {}
+        for fi in freq_indices:
+            yield self._run_frequency(fi, self.frequencies.freq_vec[fi], configurations, solver_states=solver_states, 
+                                      angular_tables=angular_tables, **kwargs)
+                
+                
+    def _run_parallel(self, freq_indices, configurations, workers, chunk_size=None, **kwargs):
+        '''
+        Distributes the frequencies among a pool of worker processes. Each chunk of consecutive 
+        frequencies is solved by a single worker, which owns its own gmsh/bempp state. Results are yielded in frequency order, no matter which 
+        worker finishes first. The kwargs are passed on to ._run_frequency().
+        '''
+        
+        import functools
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        
+        freq_indices = np.array(freq_indices, dtype=int)
+        if len(freq_indices) == 0:
+            return
+        if chunk_size is None:
+            # A few chunks per worker, so that the (more expensive) high frequencies get spread among the pool:
+            chunk_size = max(1, int(np.ceil(len(freq_indices)/(4*workers))))
+        chunks = [freq_indices[i:i+chunk_size] for i in range(0, len(freq_indices), chunk_size)]
+        
+        print("Running %s frequencies in %s chunks on %s worker processes." % (len(freq_indices), len(chunks), workers))
+        
+        # "spawn" gives every worker a fresh interpreter, so no gmsh/bempp/OpenCL state is inherited from this process:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            run_chunk = functools.partial(_run_frequency_chunk, **kwargs)
+            for chunk_results in executor.map(run_chunk, [self]*len(chunks), chunks, [configurations]*len(chunks)):
+                for all_results in chunk_results:
+                    yield all_results
+                    
+                    
+    def _allocate_results(self, n_freqs):
+        '''
+        Clears the results and preallocates the receiver pressure arrays for n_freqs frequencies. There is 
+        one channel per omni receiver and two (left and right) per binaural receiver. If there are binaural 
+        receivers, the second channel of the omni receivers is NaN.
+        '''
+        
+        n_channels = 2 if any(receiver.type == "binaural" for receiver in self.receivers) else 1
+        shape = (n_freqs, len(self.sources), len(self.receivers), n_channels)
+        
+        self.incident_pressure = np.full(shape, np.nan, dtype=np.complex128)
+        self.scattered_pressure = np.full(shape, np.nan, dtype=np.complex128)
+        self.total_pressure = np.full(shape, np.nan, dtype=np.complex128)
+        
+        self.boundary_pressure = []
+        self.boundary_velocity = []
+        self.simulated_freqs = []
+        self.simulated_meshes = []
+        self.solver_info = []
+        
+        
+    def _store_results(self, results):
+        '''
+        Stores the results of one frequency (as returned by ._run_frequency()) after the ones already simulated.
+        '''
+        
+        fi = len(self.simulated_freqs)
+        
+        self.boundary_pressure.extend(results["boundary_pressure"])
+        self.boundary_velocity.extend(results.get("boundary_velocity", []))
+        
+        # The results of ._run_frequency() are ordered by source and then by receiver:
+        for kind in ("incident_pressure", "scattered_pressure", "total_pressure"):
+            values = getattr(self, kind)
+            for i, value in enumerate(results[kind]):
+                si, ri = divmod(i, len(self.receivers))
+                value = np.ravel(value)
+                values[fi, si, ri, :value.size] = value
+        
+        self.simulated_freqs.append(results["freq"])
+        self.simulated_meshes.append(results["mesh"])
+        self.solver_info.append(results["solver_info"])
+        
+    
+    def pressure(self, source=0, receiver=0, kind="total", channel=None):
+        '''
+        Returns a view of the pressure at a receiver due to a source, for all simulated frequencies.
+        Inputs:
+            source - index of the source (starting at 0).
+            receiver - index of the receiver (starting at 0).
+            kind - "total" (default), "incident" or "scattered".
+            channel - None (default) returns an array shaped [frequency, channel]; 0 or 1 returns the omni/left or 
+                      the right channel, shaped [frequency].
+        '''
+        
+        pressure = self.pressure_array(kind)[:, source, receiver]
+        if channel is not None:
+            pressure = pressure[:, channel]
+            
+        return pressure
+    
+    
+    def pressure_array(self, kind="total"):
+        '''
+        Returns a view of the pressure of all simulated frequencies, sources and receivers, shaped 
+        [frequency, source, receiver, channel]. kind must be "total" (default), "incident" or "scattered".
+        '''
+        
+        if kind not in ("total", "incident", "scattered"):
+            raise ValueError("Kind is not valid. It must be total, incident or scattered.")
+            
+        return getattr(self, "%s_pressure" % kind)[:len(self.simulated_freqs)]
+        
+        
+    def _directional_source_coefficients(self, source, f):
+        '''
+        Returns the spherical harmonic coefficients of a directional source for frequency f, with its power 
+        correction and rotated to its orientation (top-pole format).
+        '''
+        
+        try:
+            i = np.where(source.freq_vec == f)[0][0]
+            sh_coefficients_source = source.sh_coefficients[i]
+        except:
+            raise ValueError("The spherical harmonic coefficients for this source were not defined for frequency %0.3f Hz." % f)
+    
+        try:
+            sh_coefficients_source = 1/(10**(source.power_correction/20)) * sh_coefficients_source
+        
+        except:
+            print("There was not found any power correction for this source.")
+    
+    
+        rot_mat_FPTP = sh.get_rotation_matrix(0, -np.pi/2, 0, source.sh_order)   # Rotation Matrix front pole to top pole
+        rot_mat_AzEl = sh.get_rotation_matrix(0, -source.elevation, source.azimuth, source.sh_order); # Rotation Matrix for Loudspeaker orientation
+                        
+        sh_coefficients_rotated_source = sh_coefficients_source.reshape((np.size(sh_coefficients_source),1))
+        sh_coefficients_rotated_source = sh.reflect_sh(rot_mat_FPTP * sh_coefficients_rotated_source, 1, 0, 0)  # Convert to top-pole format
+        sh_coefficients_rotated_source = rot_mat_AzEl * sh_coefficients_rotated_source
+        
+        return sh_coefficients_rotated_source
+    
+    
+    def _boundary_quadrature(self, grid, max_points=50000):
+        '''
+        Generator over the quadrature points of grid, in blocks of at most max_points points. Yields the indices 
+        of the elements of the block, the quadrature points and the normals (arrays with 3 columns, n_quad points 
+        per element) and the quadrature weights of each element (array shaped [element, quadrature point]).
+        '''
+        
+        # The same quadrature rule used by bempp to project a GridFunction:
+        quad_points, quad_weights = bempp.api.integration.triangle_gauss.rule(bempp.api.GLOBAL_PARAMETERS.quadrature.regular)
+        
+        vertices = grid.vertices[:, grid.elements]  # [coordinate, corner, element]
+        n_elements = grid.number_of_elements
+        n_quad = len(quad_weights)
+        
+        block_size = max(1, max_points//n_quad)
+        for start in range(0, n_elements, block_size):
+            elements = np.arange(start, min(start + block_size, n_elements))
             
-            self.current_freq = f
-            k = self.air.k0[fi]
+            # Quadrature points of each element (x = v0 + s*(v1 - v0) + t*(v2 - v0)):
+            v0 = vertices[:, 0, elements].T
+            v1 = vertices[:, 1, elements].T
+            v2 = vertices[:, 2, elements].T
+            x = (v0[:, None, :] + quad_points[0][None, :, None]*(v1 - v0)[:, None, :] 
+                 + quad_points[1][None, :, None]*(v2 - v0)[:, None, :]).reshape((-1, 3))
+            normals = np.repeat(grid.normals[elements], n_quad, axis=0)
+            weights = quad_weights[None, :]*grid.integration_elements[elements][:, None]
+            
+            yield elements, x, normals, weights
+    
+    
+    def _angular_tables(self, grid, space, position, max_order, angular_tables=None, max_points=50000):
+        '''
+        Returns the angular tables (see sh.spherical_angular_tables()) of the spherical basis functions centred 
+        at position, at all quadrature points of grid, as a list of (degrees of freedom, quadrature weights, tables) 
+        blocks of at most max_points points. They do not depend on the frequency, so they are kept in the 
+        angular_tables dictionary (if given), which is shared by all frequencies solved on the same mesh.
+        '''
+        
+        key = (tuple(np.ravel(position)), max_order)
+        if angular_tables is not None and key in angular_tables:
+            return angular_tables[key]
+        
+        blocks = []
+        for elements, x, normals, weights in self._boundary_quadrature(grid, max_points):
+            blocks.append((space.local2global[elements, 0], weights, 
+                           sh.spherical_angular_tables(max_order, x - np.ravel(position), normals)))
+        
+        if angular_tables is not None:
+            angular_tables[key] = blocks
+        
+        return blocks
+    
+    
+    def _receiver_projections(self, grid, space, receiver, k, angular_tables=None):
+        '''
+        Returns the projections (conjugated) of all incoming spherical basis functions of a binaural receiver, 
+        and of their normal derivatives, on the basis functions of space (DP0), as two arrays shaped 
+        [(receiver.sh_order+1)^2, number of degrees of freedom]. All quadrature points are evaluated at once 
+        and only the radial functions are evaluated for each frequency (see ._angular_tables()).
+        '''
+        
+        OpSnm = np.zeros(((receiver.sh_order + 1)**2, space.global_dof_count), dtype=np.complex128)
+        OpDnm = np.zeros(((receiver.sh_order + 1)**2, space.global_dof_count), dtype=np.complex128)
+        
+        for dofs, weights, tables in self._angular_tables(grid, space, receiver.coord, receiver.sh_order, angular_tables):
+            
+            H, dHdn = sh.spherical_basis_from_tables(k, tables, sh.spherical_hankel_in_all)
+            
+            OpSnm[:, dofs] = np.conj((H.reshape(weights.shape + (-1,))*weights[:, :, None]).sum(axis=1)).T
+            OpDnm[:, dofs] = np.conj((dHdn.reshape(weights.shape + (-1,))*weights[:, :, None]).sum(axis=1)).T
+            
+            del H, dHdn
+        
+        return OpSnm, OpDnm
+    
+    
+    def _directional_source_projections(self, grid, space, source, sh_coefficients, k, dof_admittance, angular_tables=None):
+        '''
+        Returns the projections of the right-hand side of a directional source (dphi/dn - 1j*k*admittance*phi, 
+        with phi the sound field radiated by the source) on the basis functions of space (DP0). All quadrature 
+        points are evaluated at once and only the radial functions are evaluated for each frequency 
+        (see ._angular_tables()).
+        '''
+        
+        projections = np.zeros(space.global_dof_count, dtype=np.complex128)
+        sh_coefficients = np.asarray(sh_coefficients).reshape(-1)
+        order = int(np.sqrt(sh_coefficients.size)) - 1
+        
+        for dofs, weights, tables in self._angular_tables(grid, space, source.coord, order, angular_tables):
+            
+            Phi, dPhi_dn = sh.spherical_basis_from_tables(k, tables, sh.spherical_hankel_out_all)
+            val = (Phi @ sh_coefficients).reshape(weights.shape)
+            d_val = (dPhi_dn @ sh_coefficients).reshape(weights.shape)
+            
+            projections[dofs] = ((d_val - 1j*k*dof_admittance[dofs][:, None]*val)*weights).sum(axis=1)
+            
+            del Phi, dPhi_dn
+        
+        return projections
+    
+    
+    def _run_frequency(self, fi, f, configurations, solver="auto", tol=1E-5, band_meshes=True, preconditioner=None, 
+                       assembler="auto", precision="single", refine=0, solver_states=None, angular_tables=None):
+        '''
+        Solves the room for a single frequency (index fi of the frequency vector) and returns a list with the 
+        results of each material configuration. Each configuration is an admittance table (one admittance 
+        array per material) and its results are a dictionary of lists, ordered the same way as the result lists 
+        of the room. The boundary operators only depend on the mesh and on the wavenumber, so they are assembled 
+        once and shared by all configurations. solver_states is a list with one dictionary per configuration, 
+        which is kept by the caller between consecutive frequencies (see sea.solvers.solve_multiple_rhs()). 
+        angular_tables is a dictionary kept by the caller as well, with the frequency independent tables of the 
+        directional sources and binaural receivers of the current mesh (see ._angular_tables()).
+        '''
+        
+        if solver_states is None:
+            solver_states = [{} for admittances in configurations]
+        if angular_tables is None:
+            angular_tables = {}
             
-            print ("Working on frequency = %0.3f Hz." % f)
+        bempp.api.DEVICE_PRECISION_CPU = precision
+        
+        self.current_freq = f
+        k = self.air.k0[fi]
+        
+        print ("Working on frequency = %0.3f Hz." % f)
 
-            #Generate mesh for this frequency:
-            if f <= 50:
-                factor = 12
-            elif f <= 100:
-                factor = 10
-            elif f <= 150:
-                factor = 8 
-            elif f <= 265:
-                factor = 6 
-            else:
-                factor = 4
+        #Get the mesh for this frequency (from the mesh cache, if it was already generated):
+        mesh = self.get_mesh(f, band_meshes)
+        grid = bempp.api.import_grid(mesh)
+        
+        # The angular tables are only valid on the mesh they were computed on:
+        if angular_tables.get("mesh") != mesh:
+            angular_tables.clear()
+            angular_tables["mesh"] = mesh
+
+        '''
+        #Open and reorder physical groups of the .msh file for this frequency:
+        try:
+            msh_path = "meshs/msh_%s_%sHz.msh" %(self.room_name, f)
+            reorder_physical_groups(msh_path)
+            grid = bempp.api.import_grid(msh_path)
+        except:
+            raise ValueError("Mesh file for %s Hz was not found." % f)
+        '''   
+        #print("Defining space...")
+        #space = bempp.api.function_space(grid, "P", 1) # como nos code do Guto
+        space = bempp.api.function_space(grid, "DP", 0)  # como nos code antigos               
+        
+        # Physical group and position of each degree of freedom (one per element), used by the preconditioners:
+        dof_groups = np.zeros(space.global_dof_count, dtype=np.int32)
+        dof_groups[space.local2global[:,0]] = grid.domain_indices
+        dof_points = np.zeros((space.global_dof_count, 3))
+        dof_points[space.local2global[:,0]] = grid.centroids
+        
+        # Pick the assembler and the solver from the number of degrees of freedom and sources:
+        frequency_assembler, frequency_solver = solvers.select_backend(space.global_dof_count, len(self.sources), assembler, solver)
+        print("%s degrees of freedom: %s assembler, %s solver, %s precision." % (space.global_dof_count, frequency_assembler, frequency_solver, precision))
+        
+        #print("identity")
+        identity = bempp.api.operators.boundary.sparse.identity(
+            space, space, space)
+        #print("dlp")
+        dlp = bempp.api.operators.boundary.helmholtz.double_layer(
+            space, space, space, k, assembler=frequency_assembler)
+        #print("slp")
+        slp = bempp.api.operators.boundary.helmholtz.single_layer(
+            space, space, space, k, assembler=frequency_assembler)
+        
+        # All omni receivers are evaluated at once, with potential operators that are assembled once per frequency 
+        # and reused for every source and configuration:
+        omni_receivers = [ri for ri, receiver in enumerate(self.receivers) if receiver.type == "omni"]
+        if len(omni_receivers) != 0:
+            omni_points = np.concatenate([self.receivers[ri].coord for ri in omni_receivers]).T
+            slp_pot = bempp.api.operators.potential.helmholtz.single_layer(
+                space, omni_points, k)
+            dlp_pot = bempp.api.operators.potential.helmholtz.double_layer(
+                space, omni_points, k)
+                
+        # Projection matrices of the binaural receivers, shared by all sources and configurations:
+        receiver_projections = {}
+        
+        all_results = []
+        for ci, admittances in enumerate(configurations):
             
-            #print("Generating mesh...")
-            try:
-                self.generate_mesh(self.air.c0, f, factor)
-                grid = bempp.api.import_grid(self.path_to_msh)
-            except:
-                print("Geometry file not found. Please, upload it:")
-                self.add_geometry()
+            if len(configurations) > 1:
+                print ("Working on material configuration %s of %s." % (ci+1, len(configurations)))
                 
-                self.generate_mesh(self.air.c0, f, factor)
-                grid = bempp.api.import_grid(self.path_to_msh)
-
-            '''
-            #Open and reorder physical groups of the .msh file for this frequency:
-            try:
-                msh_path = "meshs/msh_%s_%sHz.msh" %(self.room_name, f)
-                reorder_physical_groups(msh_path)
-                grid = bempp.api.import_grid(msh_path)
-            except:
-                raise ValueError("Mesh file for %s Hz was not found." % f)
-            '''   
-            #print("Defining space...")
-            #space = bempp.api.function_space(grid, "P", 1) # como nos code do Guto
-            space = bempp.api.function_space(grid, "DP", 0)  # como nos code antigos               
+            results = {"freq": f, "mesh": mesh, "boundary_pressure": [], "boundary_velocity": [], 
+                       "incident_pressure": [], "scattered_pressure": [], "total_pressure": []}
             
-            admittance = np.array([item[fi] for item in admittances])
+            # The recycled subspace and the initial guess are only meaningful on the same mesh:
+            solver_state = solver_states[ci]
+            if solver_state.get("mesh") != mesh:
+                solver_state.clear()
+                solver_state["mesh"] = mesh
             
-            #Generate subspaces. It is needed if any of the receivers is binaural.
-            if len(self.receivers) != 0 and any(receiver.type == "binaural" for receiver in self.receivers):  
-                print("Defining subspaces...")
-                # Initialize approximation spaces:
-                sub_spaces = [None] * len(admittance) # Initalise as empty list
-                spaceNumDOF = np.zeros(len(admittance), dtype=np.int32)
-                for i in np.arange(len(admittance)): # Loop over subspaces
-                    sub_spaces[i] = bempp.api.function_space(grid, "DP", 0, segments=[i])  # discontinuous piecewise-constant
-                    spaceNumDOF[i] = sub_spaces[i].global_dof_count
-                iDOF = np.concatenate((np.array([0]), np.cumsum(spaceNumDOF)))
+            admittance = np.array([item[fi] for item in admittances])
+        
+            # Admittance of each degree of freedom (DP0, so it is also the admittance of each element):
+            dof_admittance = admittance[dof_groups - 1]
             '''
             @bempp.api.complex_callable(jit=False) 
             def mu_fun_r(r,n,domain_index,result):
@@ -457,226 +1081,139 @@ class Room:
             @bempp.api.complex_callable(jit=False) 
             def mu_fun_i(r,n,domain_index,result):
                 result[0]=np.imag(admittance[domain_index-1])
-            
+        
             mu_op_r = bempp.api.MultiplicationOperator(bempp.api.GridFunction(space,fun=mu_fun_r),space,space,space)
             mu_op_i = bempp.api.MultiplicationOperator(bempp.api.GridFunction(space,fun=mu_fun_i),space,space,space)
             '''
-            
-            @bempp.api.callable(complex=True, jit=False, parameterized=True)
-            def mu_fun(x, n, domain_index, result, admittance):
-                    result[0]=admittance[domain_index-1]
-            
+        
+            # The admittance is constant on each element, so its DP0 coefficients are given directly 
+            # (no callback is evaluated at the quadrature points):
             mu_op = bempp.api.MultiplicationOperator(
-                bempp.api.GridFunction(space, fun=mu_fun, function_parameters=admittance)
+                bempp.api.GridFunction(space, coefficients=dof_admittance)
                 , space, space, space)
-            
-            #print("identity")
-            identity = bempp.api.operators.boundary.sparse.identity(
-                space, space, space)
-            #print("dlp")
-            dlp = bempp.api.operators.boundary.helmholtz.double_layer(
-                space, space, space, k)
-            #print("slp")
-            slp = bempp.api.operators.boundary.helmholtz.single_layer(
-                space, space, space, k)
-            
+        
             #lhs = (.5 * identity + dlp - 1j*k*slp*(mu_op_r+1j*mu_op_i))
             lhs = (.5 * identity + dlp - 1j*k*slp*mu_op)
-            
-            del identity, dlp
-            
+        
+            # The left-hand side does not depend on the source. So, the right-hand sides of all 
+            # sources are computed first and then solved together:
+            source_grids = []
+            source_q = []
+            source_sh_coefficients = []
             for si, source in enumerate(self.sources):
-                
-                print ("Working on source %s of %s." % (si+1, len(self.sources)))
-                
+            
+                q = None
                 if source.type == "monopole":
-                    
+                
                     try:
                         i = np.where(source.freq_vec == f)[0][0]
                         q = np.array([[source.q[i]]])    
                     except:
                         raise ValueError("There is no information about the power of source %s for frequency %0.3f Hz." % (si, f))
-                   
+               
                     sh_coefficients_rotated_source = 1j*k/(4*np.pi)**0.5
+                
+                    # Parameters of the compiled callable: source position, wavenumber, volume velocity and 
+                    # the admittance of each material:
+                    source_parameters = np.concatenate((source.coord.reshape(3), [k, q[0][0]], admittance)).astype(np.complex128)
+                    source_grids.append(bempp.api.GridFunction(space, fun=_monopole_source_fun, 
+                                                               function_parameters=source_parameters))
                     
-                    @bempp.api.callable(complex=True, jit=False)
-                    def source_fun(r, n, domain_index, result):
-                        result[0]=0
-                        pos = np.linalg.norm(r-source.coord)
-                        val  = q*np.exp(1j*k*pos)/(4*np.pi*pos)
-                        result[0] +=  -(1j*admittance[domain_index-1]*k*val - val/(pos*pos) * (1j*k*pos-1)* np.dot(r-source.coord,n))                  
-                        
                 else:             
-                    
-                    try:
-                        i = np.where(source.freq_vec == f)[0][0]
-                        sh_coefficients_source = source.sh_coefficients[i]
-                    except:
-                        raise ValueError("The spherical harmonic coefficients for this source were not defined for frequency %0.3f Hz." % f)
-                    
-                    try:
-                        sh_coefficients_source = 1/(10**(source.power_correction/20)) * sh_coefficients_source
-                        
-                    except:
-                        print("There was not found any power correction for this source.")
-                    
-                    
-                    rot_mat_FPTP = sh.get_rotation_matrix(0, -np.pi/2, 0, source.sh_order)   # Rotation Matrix front pole to top pole
-                    rot_mat_AzEl = sh.get_rotation_matrix(0, -source.elevation, source.azimuth, source.sh_order); # Rotation Matrix for Loudspeaker orientation
-                                        
-                    sh_coefficients_rotated_source = sh_coefficients_source.reshape((np.size(sh_coefficients_source),1))
-                    sh_coefficients_rotated_source = sh.reflect_sh(rot_mat_FPTP * sh_coefficients_rotated_source, 1, 0, 0)  # Convert to top-pole format
-                    sh_coefficients_rotated_source = rot_mat_AzEl * sh_coefficients_rotated_source
-                    
-                    #@bempp.api.callable(complex=True, jit=True, parameterized=True)
-                    #def source_fun(r, n, domain_index, result, parameters):
-                        
-                        #result[0]=0
-                        
-                        #coord = np.real(parameters[:3])
-                        #k = parameters[3]
-                        #mu = parameters[4:]
-                        
-                        #val, d_val  = sh.spherical_basis_out_all(k, sh_coefficients_rotated, r-coord, n)
-                        #result[0] += d_val - 1j*mu[domain_index]*k*val
-                        #result[0] = d_val - 1j*mu[domain_index]*k*val
-                    
-                    #source_coord = source.coord.reshape(3)
-                    @bempp.api.callable(complex=True, jit=False)
-                    #@bempp.api.callable(complex=True, jit=True)
-                    def source_fun(r, n, domain_index, result):
-                        result[0]=0
-                        val, d_val  = sh.spherical_basis_out_all(k, sh_coefficients_rotated_source, r-source.coord.reshape(3), n)
-                        result[0] += d_val - 1j*admittance[domain_index-1]*k*val
-                    
-                    #source_parameters = np.zeros(4+len(admittance),dtype = 'complex128')
-
-                    #source_parameters[:3] = source.coord
-                    #source_parameters[3] = k
-                    #source_parameters[4:] = admittance
                 
-                #rhs = bempp.api.GridFunction.from_zeros(self.space)
-                source_grid = bempp.api.GridFunction(space, fun=source_fun)
-                rhs =  -slp * source_grid
+                    sh_coefficients_rotated_source = self._directional_source_coefficients(source, f)
                     
-                #print("boundary_pressure")
-                boundary_pressure, info = bempp.api.linalg.gmres(lhs, rhs, tol=1E-5)
-                                
+                    # The outgoing spherical basis functions can not be compiled (lpmv), so the projections 
+                    # are evaluated at all quadrature points at once instead of with a callback:
+                    source_grids.append(bempp.api.GridFunction(space, dual_space=space, 
+                        projections=self._directional_source_projections(grid, space, source, sh_coefficients_rotated_source, 
+                                                                         k, dof_admittance, angular_tables)))
+            
+                source_q.append(q)
+                source_sh_coefficients.append(sh_coefficients_rotated_source)
+
+            # rhs = -slp * source_grid, for all sources at once:
+            rhs = -(slp.weak_form() @ np.array([source_grid.coefficients for source_grid in source_grids]).T)
+        
+            print("Solving for %s sources..." % len(self.sources))
+            # The preconditioner depends on the admittance, so it is built for each configuration (but only once for all sources):
+            # With fmm, the entries of the left-hand side are only available through products, so the preconditioner 
+            # is built from its sparse near field instead:
+            near_field = None
+            if preconditioner is not None and frequency_assembler == "fmm":
+                near_field = self._near_field_matrix(space, k, identity, dof_admittance)
+            M, preconditioner_info = solvers.build_preconditioner(lhs.weak_form(), preconditioner, groups=dof_groups, points=dof_points, 
+                                                                  near_field=near_field)
+            
+            solution, solver_info = solvers.solve_multiple_rhs(lhs.weak_form(), rhs, method=frequency_solver, tol=tol, state=solver_state, M=M, 
+                                                               precision=precision, refine=refine)
+            print("Solved with %s in %0.2f s (%s iterations)." % (solver_info["method"], solver_info["time"], solver_info["iterations"]))
+            solver_info.update(preconditioner_info)
+            solver_info.update({"assembler": frequency_assembler, "precision": precision, "dofs": space.global_dof_count})
+            results["solver_info"] = solver_info
+            
+            del M
+        
+            del rhs
+        
+            for si, source in enumerate(self.sources):
+            
+                print ("Working on source %s of %s." % (si+1, len(self.sources)))
+            
+                q = source_q[si]
+                sh_coefficients_rotated_source = source_sh_coefficients[si]
+                source_grid = source_grids[si]
+            
+                boundary_pressure = bempp.api.GridFunction(space, coefficients=solution[:,si])
+                            
                 #un = 1j*(mu_op_r+1j*mu_op_i)*k*boundary_pressure - source_grid
                 un = 1j*mu_op*k*boundary_pressure - source_grid
-                   
-                self.boundary_pressure.append (boundary_pressure.coefficients)
-                
-                del rhs
-                try:
-                    del sh_coefficients_source, rot_mat_FPTP, rot_mat_AzEl
-                except:
-                    pass                    
+               
+                results["boundary_pressure"].append(boundary_pressure.coefficients)
+                results["boundary_velocity"].append(un.coefficients)
                 
+                if len(omni_receivers) != 0:
+                    print ("Working on %s omni receivers." % len(omni_receivers))
+                    
+                    pScat_omni = (slp_pot*un - dlp_pot*boundary_pressure)[0]
+                    
+                    if source.type == "monopole":
+                        distances = np.linalg.norm(omni_points.T - source.coord, axis=1)
+                        pInc_omni = q[0][0]*np.exp(1j*k*distances)/(4*np.pi*distances)
+                    else:
+                        pInc_omni = sh.spherical_basis_out_p0_only(k, sh_coefficients_rotated_source, omni_points.T - source.coord.reshape(3))[:,0]
+                        
+                    pT_omni = pScat_omni + pInc_omni
+            
                 if len(self.receivers) != 0:
                     for ri, receiver in enumerate(self.receivers):
 
-                        print ("Working on receiver %s of %s." % (ri+1, len(self.receivers)))
-
                         if receiver.type == "omni":
                             
-                            slp_pot = bempp.api.operators.potential.helmholtz.single_layer(
-                                space, receiver.coord.T, k)
-                            
-                            dlp_pot = bempp.api.operators.potential.helmholtz.double_layer(
-                                space, receiver.coord.T, k)
-                            
-                            pScat =  (slp_pot*un - dlp_pot*boundary_pressure)[0][0]
-
-                            
-                            distance  = np.linalg.norm(receiver.coord - source.coord)
-                            if source.type == "monopole":
-                                pInc = (q[0][0]*np.exp(1j*k*distance)/(4*np.pi*distance))
-
-                            else:
-                                pInc = (sh.spherical_basis_out_p0_only(k, sh_coefficients_rotated_source, receiver.coord.reshape(3) - source.coord.reshape(3)))[0][0]
-                            
-                            pT = pScat + pInc
-
-                            self.incident_pressure.append(pInc)
-                            self.scattered_pressure.append(pScat) 
-                            self.total_pressure.append(pT) 
-                            
-                            del dlp_pot, slp_pot, pScat, distance, pInc, pT
-                                                      
-                            gc.collect(generation=0)
-                            gc.collect(generation=1)
-                            gc.collect(generation=2)
+                            i = omni_receivers.index(ri)
+                            results["incident_pressure"].append(pInc_omni[i])
+                            results["scattered_pressure"].append(pScat_omni[i]) 
+                            results["total_pressure"].append(pT_omni[i]) 
 
 
                         else:
+                            
+                            print ("Working on receiver %s of %s." % (ri+1, len(self.receivers)))
 
-                            AnmInc  = np.zeros([(receiver.sh_order + 1) ** 2], np.complex64)
-                            AnmInc  = sh.get_translation_matrix((receiver.coord - source.coord).reshape((3,)), k, source.sh_order, receiver.sh_order) @ sh_coefficients_rotated_source
+                            # Rotation - coaxial translation - rotation, without forming the translation matrix:
+                            AnmInc  = sh.translate_sh(sh_coefficients_rotated_source, (receiver.coord - source.coord).reshape((3,)), 
+                                                      k, receiver.sh_order, cache_path=self.sh_cache).reshape((-1, 1))
                             #print("AnmInc")
-                            AnmScat = np.zeros([(receiver.sh_order + 1) ** 2], np.complex64)
-                            #print("AnmScat")
-
-                            for n in range(receiver.sh_order + 1):
-                                for m in range(-n, n+1):
-                                    #print("OpDnmFunc")
-                                    # Define functions to be evaluated:
-                                    @bempp.api.complex_callable(jit=False)
-                                    #@bempp.api.callable(complex=True, jit=True)
-                                    def OpDnmFunc(x, nUV, domain_index, result):
-                                        H, dHdn = sh.spherical_basis_in(n, m, k, x - receiver.coord.reshape(3), nUV)
-                                        result[0] = dHdn
-                                        
-                                    #print("OpSnmFunc")
-                                    @bempp.api.complex_callable(jit=False)
-                                    #@bempp.api.callable(complex=True, jit=True)
-                                    def OpSnmFunc (x, nUV, domain_index, result):
-                                        H = sh.spherical_basis_in_p0_only(n, m, k, x - receiver.coord.reshape(3))
-                                        result[0] = H
-
-                                    for i in np.arange(len(admittance)):  # loop over subspaces
-
-                                        # Integrate the SH functions with the basis functions from the approximation spaces:
-                                        #print("OpSnmGF")
-                                        OpSnmGF = bempp.api.GridFunction(sub_spaces[i], fun=OpSnmFunc)
-                                        #print("OpDnmGF")
-                                        OpDnmGF = bempp.api.GridFunction(sub_spaces[i], fun=OpDnmFunc)
-
-
-                                        # Integrate the SH functions with the basis functions from the approximation spaces:
-                                        #OpSnmGF = bempp.api.GridFunction(space, fun=OpSnmFunc)
-                                        #OpDnmGF = bempp.api.GridFunction(space, fun=OpDnmFunc)
-
-
-                                        # Integrate the SH functions with the basis functions from the approximation spaces:
-                                        #OpSnmGF =  bempp.api.MultiplicationOperator(
-                                         #   bempp.api.GridFunction(space, fun=OpSnmFunc)
-                                          #  , space, space, space)
-
-                                        #OpDnmGF = bempp.api.MultiplicationOperator(
-                                         #   bempp.api.GridFunction(space, fun=OpDnmFunc)
-                                          #  , space, space, space)
-
-                                        # Extract projections and conjugate to get discrete form of intended operators:
-                                        #OpSnm = np.conj(OpSnmGF.projections())
-                                        #OpDnm = np.conj(OpDnmGF.projections())
-
-                                        # Extract projections and conjugate to get discrete form of intended operators:
-                                        #print("OpSnm")
-                                        OpSnm = np.conj(OpSnmGF.projections(sub_spaces[i]))
-                                        #print("OpDnm")
-                                        OpDnm = np.conj(OpDnmGF.projections(sub_spaces[i]))
-                                        
-                                        del OpSnmGF, OpDnmGF
-
-                                        #AnmScat[n**2 + n + m] = 1j*k*np.sum(boundary_pressure * (OpDnm + 1j*k*mu_op * OpSnm))
-
-                                        #AnmScat[n**2 + n + m] = 1j*k*np.sum(boundary_pressure * (OpDnmGF + 1j*k*mu_op * OpSnmGF))
-                                        #print("AnmScat")
-                                        AnmScat[n**2 + n + m] += 1j*k*np.sum(boundary_pressure.coefficients[iDOF[i]:iDOF[i+1]] * (OpDnm + np.complex128(1j*k*admittance[i]) * OpSnm))
-
-                                        del OpSnm, OpDnm
+                            # Projections of all incoming SH functions (and of their normal derivatives) on the boundary 
+                            # basis functions, conjugated to get the discrete form of the intended operators. They only 
+                            # depend on the receiver, the mesh and the wavenumber, so they are computed once per frequency:
+                            if (ri, mesh) not in receiver_projections:
+                                receiver_projections[(ri, mesh)] = self._receiver_projections(grid, space, receiver, k, angular_tables)
+                            OpSnm, OpDnm = receiver_projections[(ri, mesh)]
                             
+                            AnmScat = (1j*k*(OpDnm @ boundary_pressure.coefficients 
+                                             + 1j*k*(OpSnm @ (dof_admittance*boundary_pressure.coefficients)))).astype(np.complex64)
+                        
                             rotation_matrix = sh.get_rotation_matrix(0, 0, -receiver.azimuth, receiver.sh_order)
                             AnmInc = rotation_matrix * AnmInc
                             AnmScat = rotation_matrix * AnmScat
@@ -698,61 +1235,194 @@ class Room:
                             pT = [a + b for a, b in zip(pInc, pScat)]
 
 
-                            self.scattered_pressure.append(pScat)
-                            self.incident_pressure.append(pInc)
-                            self.total_pressure.append(pT)  
-            
+                            results["scattered_pressure"].append(pScat)
+                            results["incident_pressure"].append(pInc)
+                            results["total_pressure"].append(pT)  
+        
                             del AnmInc, AnmScat, rotation_matrix, pInc, pScat, pT, sh_coefficients_receiver_left, sh_coefficients_receiver_right    
 
                             #print("Collecting garbage...")
                             gc.collect(generation=0)
                             gc.collect(generation=1)
                             gc.collect(generation=2)
-                                
+                            
                     del boundary_pressure, un
-                    
-            del space, grid, mu_op, lhs, slp
-            try:
-                del sub_spaces, spaceNumDOF, iDOF 
-            except:
-                pass
-            
-            bempp.api.clear_fmm_cache()
+                
+            all_results.append(results)
             
-            self.simulated_freqs.append(f)
-                                        
-            if save == True:
-                self.save()
+            del mu_op, lhs, source_grids, solution, dof_admittance
+        
+        del space, grid, identity, dlp, slp, receiver_projections
+        if len(omni_receivers) != 0:
+            del slp_pot, dlp_pot
+        
+        bempp.api.clear_fmm_cache()
+        
+        return all_results
                             
 
-    def receiver_evaluate (self, source, receiver, **kwargs):
+
+    def evaluate_field(self, points, freqs=[], sources=[], chunk_size=5000, assembler="dense", field_path=None):
+        '''
+        Evaluates the pressure on a set of points (e.g. a listening plane or volume) from the boundary solution 
+        stored by .run(), so nothing is solved again. The potential operators are assembled for chunks of at most 
+        chunk_size points at a time, so the memory does not grow with the number of points.
+        Inputs:
+            points - coordinates of the points - array with 3 columns (see .grid_points()).
+            freqs - simulated frequencies to be evaluated. If not given, all simulated frequencies are evaluated.
+            sources - numbers of the sources to be evaluated (starting at 0). If not given, all sources are evaluated.
+            chunk_size - maximum number of points of each potential operator.
+            assembler - assembler of the potential operators, "dense" (default) or "fmm" (better for many points).
+            field_path - if given, the total pressure of each frequency is written to its own file in this folder 
+                         ("field_<freq>.npy", shaped [source, point], next to "points.npy") as soon as it is evaluated, 
+                         and the list of files is returned. Otherwise, the total pressure is returned as an array 
+                         shaped [frequency, source, point].
+        '''
+        
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        
+        freqs = np.array(freqs)
+        if freqs.size == 0:
+            freqs = np.array(self.simulated_freqs)
+        sources = np.array(sources, dtype=int)
+        if sources.size == 0:
+            sources = np.arange(len(self.sources))
         
-        if "boundary_pressure" in kwargs and "boundary_velocity" in kwargs:
+        if field_path is not None:
+            os.makedirs(field_path, exist_ok=True)
+            np.save(os.path.join(field_path, "points.npy"), points)
+            field_files = []
+        else:
+            field = np.zeros((len(freqs), len(sources), len(points)), dtype=np.complex128)
+        
+        for i, f, pInc, pScat in self._evaluate_points(points, freqs, sources, chunk_size, assembler):
+                
+            if field_path is not None:
+                field_files.append(os.path.join(field_path, "field_%0.6f.npy" % f))
+                np.save(field_files[-1], pInc + pScat)
+            else:
+                field[i] = pInc + pScat
             
-            pScat = np.zeros(len(self.frequencies.freq_vec), dtype = np.complex64)
-            pInc = np.zeros(len(self.frequencies.freq_vec), dtype = np.complex64)
-            pT = np.zeros(len(self.frequencies.freq_vec), dtype = np.complex64)
+        if field_path is not None:
+            return field_files
+        
+        return field
+    
+    
+    def _evaluate_points(self, points, freqs, sources, chunk_size=5000, assembler="dense"):
+        '''
+        Evaluates the incident and scattered pressure on the given points from the stored boundary solution, 
+        yielding (index, frequency, incident pressure, scattered pressure) for each frequency, with pressures 
+        shaped [source, point].
+        '''
             
-            for fi,f in enumerate(self.frequencies.freq_vec):
+        if len(self.boundary_velocity) != len(self.boundary_pressure):
+            raise ValueError("The boundary velocity was not stored for all frequencies. Run the simulation again to evaluate new points.")
         
-                k = self.air.k0[fi]
+        mesh = None
+        for i, f in enumerate(freqs):
             
-                dlp_pot = bempp.api.operators.potential.helmholtz.double_layer(
-                    self.space, receiver.coord.T, k, assembler = "dense", device_interface = "numba")
+            try:
+                si_freq = self.simulated_freqs.index(f)
+            except:
+                raise ValueError("Frequency %0.3f Hz was not simulated." % f)
+                
+            print ("Evaluating frequency = %0.3f Hz." % f)
+            
+            # Consecutive frequencies usually share the same mesh (see MESH_BANDS):
+            if self.simulated_meshes[si_freq] != mesh:
+                mesh = self.simulated_meshes[si_freq]
+                space = bempp.api.function_space(bempp.api.import_grid(mesh), "DP", 0)
+                
+            if space.global_dof_count != self.boundary_pressure[si_freq*len(self.sources)].size:
+                raise ValueError("Mesh %s does not match the boundary solution of %0.3f Hz." % (mesh, f))
+            
+            k = self.air.k0[np.where(self.frequencies.freq_vec == f)[0][0]]
+            
+            boundary_pressure = []
+            boundary_velocity = []
+            for si in sources:
+                boundary_pressure.append(bempp.api.GridFunction(space, coefficients=self.boundary_pressure[si_freq*len(self.sources) + si]))
+                boundary_velocity.append(bempp.api.GridFunction(space, coefficients=self.boundary_velocity[si_freq*len(self.sources) + si]))
+                
+            pInc = np.zeros((len(sources), len(points)), dtype=np.complex128)
+            pScat = np.zeros((len(sources), len(points)), dtype=np.complex128)
+            for start in range(0, len(points), chunk_size):
+                chunk = points[start:start+chunk_size]
+                
                 slp_pot = bempp.api.operators.potential.helmholtz.single_layer(
-                    self.space, receiver.coord.T, k, assembler = "dense", device_interface = "numba")
+                    space, chunk.T, k, assembler=assembler)
+                dlp_pot = bempp.api.operators.potential.helmholtz.double_layer(
+                    space, chunk.T, k, assembler=assembler)
                 
-                pS = -dlp_pot.evaluate(kwargs["boundary_pressure"])[0][0] + slp_pot.evaluate(kwargs["boundary_velocity"])[0][0]
-                pScat[fi] = pS
-
-                distance  = np.linalg.norm(receiver.coord - source.coord)
-                pInc[fi] = q[0][0]*np.exp(1j*k*distance)/(4*np.pi*distance)
-
-                pT[fi] = pScat[fi] + pInc[fi]
+                for j, si in enumerate(sources):
+                    source = self.sources[si]
+                    
+                    pScat[j, start:start+chunk_size] = (slp_pot*boundary_velocity[j] - dlp_pot*boundary_pressure[j])[0]
+                    
+                    if source.type == "monopole":
+                        q = source.q[np.where(source.freq_vec == f)[0][0]]
+                        distances = np.linalg.norm(chunk - source.coord, axis=1)
+                        pInc[j, start:start+chunk_size] = q*np.exp(1j*k*distances)/(4*np.pi*distances)
+                    else:
+                        sh_coefficients_rotated_source = self._directional_source_coefficients(source, f)
+                        pInc[j, start:start+chunk_size] = sh.spherical_basis_out_p0_only(k, sh_coefficients_rotated_source, chunk - source.coord.reshape(3))[:,0]
+                    
+                del slp_pot, dlp_pot
+                
+            yield i, f, pInc, pScat
                 
-            self.scattered_pressure.append(pScat)
-            self.incident_pressure.append(pInc)
-            self.total_pressure.append(pT)  
+            del boundary_pressure, boundary_velocity, pInc, pScat
+            
+        bempp.api.clear_fmm_cache()
+    
+    
+    def grid_points(self, x, y, z):
+        '''
+        Returns the points of a regular grid (a plane, if one of the coordinates has a single value, or a volume) 
+        as an array with 3 columns, to be used by .evaluate_field(). x, y and z are the coordinates along each 
+        axis, e.g. np.linspace(0, 5, 50).
+        '''
+        
+        X, Y, Z = np.meshgrid(np.atleast_1d(x), np.atleast_1d(y), np.atleast_1d(z), indexing="ij")
+        
+        return np.stack((X.ravel(), Y.ravel(), Z.ravel()), axis=1)
+    
+    
+    def receiver_evaluate (self, receivers, chunk_size=5000, assembler="dense"):
+        '''
+        Adds receivers to a room that was already simulated and evaluates them for all simulated frequencies 
+        and sources, from the stored boundary pressure and velocity (no solve is needed). All receivers are 
+        evaluated at once, with one pair of potential operators per frequency.
+        Inputs:
+            receivers - a Receiver or a list of them. Only omni receivers can be added this way.
+            chunk_size - maximum number of receivers of each potential operator.
+            assembler - assembler of the potential operators, "dense" (default) or "fmm".
+        The new receivers are appended to self.receivers and their results to the pressure arrays.
+        '''
+        
+        if isinstance(receivers, Receiver):
+            receivers = [receivers]
+            
+        if any(receiver.type != "omni" for receiver in receivers):
+            raise ValueError("Only omni receivers can be evaluated after the simulation.")
+        
+        points = np.concatenate([receiver.coord for receiver in receivers]).astype(np.float64)
+        n_freqs, n_sources, n_receivers, n_channels = self.total_pressure.shape
+        
+        new_results = {}
+        for kind in ("incident_pressure", "scattered_pressure", "total_pressure"):
+            new_results[kind] = np.full((n_freqs, n_sources, len(receivers), n_channels), np.nan, dtype=np.complex128)
+        
+        for fi, f, pInc, pScat in self._evaluate_points(points, self.simulated_freqs, np.arange(n_sources), chunk_size, assembler):
+            new_results["incident_pressure"][fi, :, :, 0] = pInc
+            new_results["scattered_pressure"][fi, :, :, 0] = pScat
+            new_results["total_pressure"][fi, :, :, 0] = pInc + pScat
+            
+        for kind in new_results:
+            setattr(self, kind, np.concatenate((getattr(self, kind), new_results[kind]), axis=2))
+            
+        self.receivers.extend(receivers)
             
     
     def plot_spl (self, sources=[], receivers=[]):
@@ -765,35 +1435,30 @@ class Room:
         if receivers.size == 0:
             receivers=np.arange(len(self.receivers))
         
-        for source in sources:
-            for receiver in receivers:
-                i=0
-                for s_i in np.arange(len(self.sources)):
-                    for r_i, r in enumerate(self.receivers):
-                        if s_i == source and r_i == receiver: 
+        for s_i in sources:
+            for r_i in receivers:
+                r = self.receivers[r_i]
                                                             
-                            if r.type == "omni":
-                                plt.plot(self.simulated_freqs, 20*np.log10(np.abs(self.total_pressure[s_i*len(self.receivers)+r_i : : len(self.sources)*len(self.receivers)])/(2e-5*np.sqrt(2))))
-                                plt.legend(["Source %s, Receiver %s" % (s_i+1, r_i+1)], fontsize = 13)
-                            else:                                 
-                                plt.plot(self.simulated_freqs, 20*np.log10(np.abs([item[0] for item in self.total_pressure[s_i*len(self.receivers)+r_i : : len(self.sources)*len(self.receivers)]])/(2e-5*np.sqrt(2))))
-                                plt.plot(self.simulated_freqs, 20*np.log10(np.abs([item[1] for item in self.total_pressure[s_i*len(self.receivers)+r_i : : len(self.sources)*len(self.receivers)]])/(2e-5*np.sqrt(2))))
-                                plt.legend(["left", "right"], fontsize = 13)
-
-                            plt.xlabel('Frequency [Hz]', fontsize = 15)
-                            plt.ylabel('SPL [dB]', fontsize = 15)
-                            
-                            plt.xscale('log')
-                            
-                            plt.yticks(fontsize = 12)
-                            plt.xticks([20, 30, 40, 60, 80, 100, 200, 400, 1000], ['20', '','40','60','80','100','200','400','1k'], fontsize = 12)
-                            
-                            plt.xlim(self.simulated_freqs[0], self.simulated_freqs[-1])
-        
-                            plt.savefig('SPL_LS%s_MP%s.pdf' %(s_i+1, r_i+1), bbox_inches='tight')
-                            plt.show()
+                if r.type == "omni":
+                    plt.plot(self.simulated_freqs, 20*np.log10(np.abs(self.pressure(s_i, r_i, channel=0))/(2e-5*np.sqrt(2))))
+                    plt.legend(["Source %s, Receiver %s" % (s_i+1, r_i+1)], fontsize = 13)
+                else:                                 
+                    plt.plot(self.simulated_freqs, 20*np.log10(np.abs(self.pressure(s_i, r_i, channel=0))/(2e-5*np.sqrt(2))))
+                    plt.plot(self.simulated_freqs, 20*np.log10(np.abs(self.pressure(s_i, r_i, channel=1))/(2e-5*np.sqrt(2))))
+                    plt.legend(["left", "right"], fontsize = 13)
+
+                plt.xlabel('Frequency [Hz]', fontsize = 15)
+                plt.ylabel('SPL [dB]', fontsize = 15)
+                
+                plt.xscale('log')
+                
+                plt.yticks(fontsize = 12)
+                plt.xticks([20, 30, 40, 60, 80, 100, 200, 400, 1000], ['20', '','40','60','80','100','200','400','1k'], fontsize = 12)
+                
+                plt.xlim(self.simulated_freqs[0], self.simulated_freqs[-1])
 
-                        i+=1
+                plt.savefig('SPL_LS%s_MP%s.pdf' %(s_i+1, r_i+1), bbox_inches='tight')
+                plt.show()
 
                 
     def plot_phase (self, sources=[], receivers=[]):
@@ -806,34 +1471,29 @@ class Room:
         if receivers.size == 0:
             receivers=np.arange(len(self.receivers))
         
-        for source in sources:
-            for receiver in receivers:
-                i=0
-                for s_i in np.arange(len(self.sources)):
-                    for r_i, r in enumerate(self.receivers):
-                        if s_i == source and r_i == receiver: 
+        for s_i in sources:
+            for r_i in receivers:
+                r = self.receivers[r_i]
                                                             
-                            if r.type == "omni":
-                                plt.plot(self.simulated_freqs, np.rad2deg(np.angle(np.conj(self.total_pressure[s_i*len(self.receivers)+r_i : : len(self.sources)*len(self.receivers)]))))
-                                plt.legend(["Source %s, Receiver %s" % (s_i+1, r_i+1)], fontsize = 13)
-                            else:                                 
-                                plt.plot(self.simulated_freqs, np.rad2deg(np.angle(np.conj([item[0] for item in self.total_pressure[s_i*len(self.receivers)+r_i : : len(self.sources)*len(self.receivers)]]))))
-                                plt.plot(self.simulated_freqs, np.rad2deg(np.angle(np.conj([item[1] for item in self.total_pressure[s_i*len(self.receivers)+r_i : : len(self.sources)*len(self.receivers)]]))))
-                                plt.legend(["left", "right"], fontsize = 13)
-
-                            plt.xlabel('Frequency [Hz]', fontsize = 15)
-                            plt.ylabel('Phase [°]', fontsize = 15)
-                            
-                            plt.yticks([-180,-120,-60,0,60,120,180], ['-180','-120','-60','0','60','120','180'], fontsize = 12)
-                            plt.xticks([20, 30, 40, 60, 80, 100, 200, 400, 1000], ['20', '','40','60','80','100','200','400','1k'], fontsize = 12)
-                            
-                            plt.xscale('log')
-                            plt.xlim(self.simulated_freqs[0], self.simulated_freqs[-1])
-                            
-                            plt.savefig('Phase_LS%s_MP%s.pdf' %(s_i+1, r_i+1), bbox_inches='tight')
-                            plt.show()
-
-                        i+=1
+                if r.type == "omni":
+                    plt.plot(self.simulated_freqs, np.rad2deg(np.angle(np.conj(self.pressure(s_i, r_i, channel=0)))))
+                    plt.legend(["Source %s, Receiver %s" % (s_i+1, r_i+1)], fontsize = 13)
+                else:                                 
+                    plt.plot(self.simulated_freqs, np.rad2deg(np.angle(np.conj(self.pressure(s_i, r_i, channel=0)))))
+                    plt.plot(self.simulated_freqs, np.rad2deg(np.angle(np.conj(self.pressure(s_i, r_i, channel=1)))))
+                    plt.legend(["left", "right"], fontsize = 13)
+
+                plt.xlabel('Frequency [Hz]', fontsize = 15)
+                plt.ylabel('Phase [°]', fontsize = 15)
+                
+                plt.yticks([-180,-120,-60,0,60,120,180], ['-180','-120','-60','0','60','120','180'], fontsize = 12)
+                plt.xticks([20, 30, 40, 60, 80, 100, 200, 400, 1000], ['20', '','40','60','80','100','200','400','1k'], fontsize = 12)
+                
+                plt.xscale('log')
+                plt.xlim(self.simulated_freqs[0], self.simulated_freqs[-1])
+                
+                plt.savefig('Phase_LS%s_MP%s.pdf' %(s_i+1, r_i+1), bbox_inches='tight')
+                plt.show()
                 
     
     def save(self, place="drive"):
@@ -884,20 +1544,13 @@ class Room:
             
         for f in freqs:
             
-            if f <= 50:
-                factor = 12
-            elif f <= 100:
-                factor = 10
-            elif f <= 150:
-                factor = 8 
-            elif f <= 265:
-                factor = 6 
+            # Use the same mesh the boundary pressure was computed on:
+            if hasattr(self, "simulated_meshes") and len(self.simulated_meshes) == len(self.simulated_freqs) and f in self.simulated_freqs:
+                msh_path = self.simulated_meshes[self.simulated_freqs.index(f)]
             else:
-                factor = 4
-
-            self.generate_mesh(self.air.c0, f, factor)
+                msh_path = self.get_mesh(f)
 
-            grid = bempp.api.import_grid(self.path_to_msh)
+            grid = bempp.api.import_grid(msh_path)
             
             for source in sources:
                 
@@ -994,4 +1647,35 @@ def reorder_physical_groups(msh_path):
 
 
     gmsh.write(msh_path)
-    gmsh.finalize() 
+    gmsh.finalize()
+
+
+def _run_frequency_chunk(room, freq_indices, configurations, **kwargs):
+    """
+    Worker function of Room.run(workers > 1). Solves the given frequencies on a copy of the room 
+    and returns a list with the results of each one of them (see Room._run_frequency()).
+    """
+    
+    # The frequencies of a chunk are consecutive, so the solver state is carried along the chunk:
+    solver_states = [{} for admittances in configurations]
+    angular_tables = {}
+    chunk_results = []
+    for fi in freq_indices:
+        chunk_results.append(room._run_frequency(fi, room.frequencies.freq_vec[fi], configurations, 
+                                                 solver_states=solver_states, angular_tables=angular_tables, **kwargs))
+        
+    return chunk_results
+
+
+@bempp.api.callable(complex=True, jit=True, parameterized=True)
+def _monopole_source_fun(r, n, domain_index, result, parameters):
+    """
+    Right-hand side of a monopole source (see Room._run_frequency()), compiled by numba. The parameters are 
+    the source position (3 values), the wavenumber, the volume velocity and the admittance of each material.
+    """
+    
+    d = r - parameters[:3].real
+    pos = np.sqrt(d[0]*d[0] + d[1]*d[1] + d[2]*d[2])
+    k = parameters[3]
+    val = parameters[4]*np.exp(1j*k*pos)/(4*np.pi*pos)
+    result[0] = -(1j*parameters[4 + domain_index]*k*val - val/(pos*pos) * (1j*k*pos-1) * (d[0]*n[0] + d[1]*n[1] + d[2]*n[2]))
@@ -0,0 +1,574 @@
+"""
+This module contains the linear solvers used to compute the boundary pressure. They work on
+the discrete (weak) form of the boundary integral operators, so that the same left-hand side can
+be solved for several right-hand sides (one per sound source) at once.
+"""
+
+import time
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.spatial
+
+
+def solve_multiple_rhs(A, B, method="auto", tol=1E-5, max_lu_dofs=8000, restart=None, maxiter=None, state=None, M=None,
+                       precision="double", refine=0):
+    """
+    (X, info) = solve_multiple_rhs(A, B, method, tol)
+
+    Solves A X = B for all the columns of B (one column per sound source).
+
+    Arguments:
+    A           discrete operator (scipy LinearOperator, e.g. lhs.weak_form()) of size N x N
+    B           right-hand sides - array of size N x number of sources
+    method      "lu" -> the dense matrix of A is factorized once and every right-hand side
+                        is solved against the same LU factors
+                "block gmres" -> a single block Krylov space is built for all right-hand sides
+                "gmres" -> every right-hand side is solved on its own (as it used to be done)
+                "recycled gmres" -> every right-hand side is solved with GCRO-DR, which carries a
+                                    recycled subspace from one solve to the next (see state)
+                "auto" -> "lu" if N <= max_lu_dofs and the factorization is cheaper than iterating
+                          for each source, "block gmres" if there is more than one source and "gmres" otherwise
+    tol         relative tolerance of the iterative methods
+    max_lu_dofs largest number of degrees of freedom for which "auto" uses the dense LU factorization
+    state       dictionary kept by the caller between consecutive calls of a frequency sweep (only used by
+                "recycled gmres"). The recycled subspace ("U") and the previous solution ("X", used as
+                initial guess) are read from it and updated in it. It must be emptied whenever the size
+                or the meaning of the unknowns changes (e.g. when the mesh changes). "X" is always the
+                solution of A X = B, so it is only used as initial guess without preconditioner: with M,
+                the unknowns are Y = M^-1 X and M changes from one call to the next.
+    M           preconditioner of the iterative methods (see build_preconditioner). It is applied on the
+                right (A M Y = B, X = M Y), so the tolerance still refers to the true residual. "lu"
+                does not use it.
+    precision   precision of the LU factors ("single" or "double")
+    refine      number of iterative refinement steps of "lu": the residual is computed with A and
+                solved with the same LU factors, which recovers the accuracy of A when the factors
+                are in single precision
+
+    Returned info is a dictionary with the method that was used, the total number of iterations
+    (0 for "lu"), the iterations of each right-hand side (for "gmres" and "recycled gmres") and
+    the solve time in seconds.
+    """
+
+    B = np.asarray(B)
+    if B.ndim == 1:
+        B = B.reshape((B.size, 1))
+
+    ndof, nrhs = B.shape
+
+    if method == "auto":
+        method = select_method(ndof, nrhs, max_lu_dofs)
+
+    start_time = time.time()
+    rhs_iterations = []
+
+    if M is not None and method != "lu":
+        A_original = A
+        A = scipy.sparse.linalg.LinearOperator(A.shape, matvec=lambda x: A_original @ (M @ x),
+                                               matmat=lambda X: A_original @ (M @ X), dtype=A.dtype)
+
+    if method == "lu":
+        lu = lu_factor(A, precision)
+        X = scipy.linalg.lu_solve(lu, B).astype(np.result_type(A.dtype, B.dtype))
+        for i in range(refine):
+            X = X + scipy.linalg.lu_solve(lu, B - A @ X)
+        iterations = 0
+
+    elif method == "block gmres":
+        X, iterations = block_gmres(A, B, tol=tol, restart=restart, maxiter=maxiter)
+
+    elif method == "gmres":
+        X = np.zeros(B.shape, dtype=np.result_type(A.dtype, B.dtype, np.complex64))
+        iterations = 0
+        for i in range(nrhs):
+            X[:,i], its = gmres(A, B[:,i], tol=tol, restart=restart, maxiter=maxiter)
+            iterations += its
+            rhs_iterations.append(its)
+
+    elif method == "recycled gmres":
+        if state is None:
+            state = {}
+
+        # The previous solution is a valid initial guess only if the unknowns are the same (no preconditioner):
+        X0 = state.get("X") if M is None else None
+        if X0 is not None and X0.shape != B.shape:
+            X0 = None
+
+        X = np.zeros(B.shape, dtype=np.result_type(A.dtype, B.dtype, np.complex64))
+        iterations = 0
+        for i in range(nrhs):
+            x0 = None if X0 is None else X0[:,i]
+            X[:,i], its, state["U"] = gcro_dr(A, B[:,i], tol=tol, restart=restart, maxiter=maxiter,
+                                              x0=x0, U=state.get("U"))
+            iterations += its
+            rhs_iterations.append(its)
+
+    else:
+        raise ValueError("Method is not valid. You must use \"lu\", \"block gmres\", \"gmres\", \"recycled gmres\" or \"auto\".")
+
+    if M is not None and method != "lu":
+        X = M @ X
+
+    if method == "recycled gmres":
+        state["X"] = X
+
+    info = {"method": method, "iterations": iterations, "rhs_iterations": rhs_iterations, "time": time.time() - start_time,
+            "refinement": refine if method == "lu" else 0}
+
+    return X, info
+
+
+def select_backend(ndof, nrhs, assembler="auto", method="auto", max_lu_dofs=8000, max_dense_dofs=20000):
+    """
+    (assembler, method) = select_backend(ndof, nrhs, assembler, method)
+
+    Picks the assembler of the boundary operators and the solution method for ndof unknowns and
+    nrhs right-hand sides. An "auto" assembler is "dense" up to max_dense_dofs unknowns (where the
+    dense matrix still fits in memory) and "fmm" above it. An "auto" method is chosen by select_method
+    for dense operators and is always iterative for FMM operators, which have no matrix to factorize.
+    Values other than "auto" are returned unchanged.
+    """
+
+    if assembler == "auto":
+        assembler = "dense" if ndof <= max_dense_dofs else "fmm"
+
+    if method == "auto":
+        if assembler == "fmm":
+            method = "block gmres" if nrhs > 1 else "gmres"
+        else:
+            method = select_method(ndof, nrhs, max_lu_dofs)
+
+    return assembler, method
+
+
+def select_method(ndof, nrhs, max_lu_dofs=8000, iterations_estimate=50):
+    """
+    Picks the cheapest solution method for ndof unknowns and nrhs right-hand sides.
+    A dense LU costs about ndof**3/3 operations, while each iteration of a Krylov method costs
+    about ndof**2 per right-hand side, so the factorization pays off when
+    ndof < 3*iterations_estimate*nrhs (and the dense matrix fits in memory).
+    """
+
+    if ndof <= max_lu_dofs and ndof <= 3*iterations_estimate*nrhs:
+        return "lu"
+    elif nrhs > 1:
+        return "block gmres"
+    else:
+        return "gmres"
+
+
+def dense_matrix(A):
+    """
+    Returns the dense matrix of the discrete operator A.
+    """
+
+    if isinstance(A, np.ndarray):
+        return A
+    elif hasattr(A, "to_dense"):
+        # (composed bempp operators may return an np.matrix)
+        return np.asarray(A.to_dense())
+    else:
+        return A @ np.eye(A.shape[1], dtype=A.dtype)
+
+
+def lu_factor(A, precision="double"):
+    """
+    Computes the LU factors of the dense matrix of the discrete operator A, in single or double precision.
+    """
+
+    matrix = dense_matrix(A)
+    if precision == "single":
+        matrix = matrix.astype(np.complex64)
+    elif precision != "double":
+        raise ValueError("Precision is not valid. You must use \"single\" or \"double\".")
+
+    return scipy.linalg.lu_factor(matrix, check_finite=False)
+
+
+def build_preconditioner(A, method, groups=None, points=None, near_field=None, **kwargs):
+    """
+    (M, info) = build_preconditioner(A, method, groups, points)
+
+    Builds a preconditioner for the discrete operator A, which is meant to be built once and
+    used for all the right-hand sides of A (see solve_multiple_rhs).
+
+    Arguments:
+    A          discrete operator of size N x N
+    method     None -> no preconditioner (M is None)
+               "block jacobi" -> inverse of the diagonal blocks of A given by groups (see block_jacobi)
+               "near field" -> sparse approximate inverse built from the near field of each
+                               degree of freedom (see near_field_inverse)
+    groups     group (e.g. the physical group) of each degree of freedom - array of size N
+    points     coordinates of each degree of freedom - array of size N x 3
+    near_field sparse matrix with the near-field (singular) entries of A. The preconditioners take their
+               entries from it instead of from A, which is required if A is only available through
+               products (e.g. assembled with fmm), since its dense matrix would cost N products.
+    The kwargs are passed on to the chosen preconditioner.
+
+    Returned info is a dictionary with the preconditioner that was built and its build time in seconds.
+    """
+
+    start_time = time.time()
+
+    if method is None:
+        return None, {"preconditioner": method, "preconditioner_time": 0.0}
+    elif method != "block jacobi" and method != "near field":
+        raise ValueError("Preconditioner is not valid. You must use None, \"block jacobi\" or \"near field\".")
+
+    if near_field is not None:
+        matrix = scipy.sparse.csr_matrix(near_field)
+    elif is_matrix_free(A):
+        raise ValueError("The preconditioners need the entries of A, but it is only available through products "
+                         "(e.g. it was assembled with fmm). Pass its near field (near_field) instead.")
+    else:
+        matrix = dense_matrix(A)
+
+    if method == "block jacobi":
+        M = block_jacobi(matrix, groups, **kwargs)
+    else:
+        M = near_field_inverse(matrix, points, **kwargs)
+
+    return M, {"preconditioner": method, "preconditioner_time": time.time() - start_time}
+
+
+def is_matrix_free(A):
+    """
+    Returns True if the discrete operator A (or any of the operators it is composed of) is only
+    available through products, e.g. assembled with fmm, so its entries can not be assembled cheaply.
+    """
+
+    if isinstance(A, np.ndarray) or scipy.sparse.issparse(A):
+        return False
+
+    parts = [getattr(A, name) for name in ("_op", "_op1", "_op2", "_operator") if hasattr(A, name)]
+    if len(parts) != 0:
+        return any(is_matrix_free(part) for part in parts)
+
+    return type(A).__name__ == "GenericDiscreteBoundaryOperator" or hasattr(A, "to_dense") != True
+
+
+def block_jacobi(A, groups, max_block_size=1000):
+    """
+    Block-Jacobi preconditioner: the inverse of the blocks of A that couple the degrees of freedom
+    of the same group. Groups larger than max_block_size are split into consecutive blocks.
+    A may also be a sparse matrix (e.g. the near field of A), in which case only its entries are used.
+    Returns a LinearOperator.
+    """
+
+    matrix = A if scipy.sparse.issparse(A) else dense_matrix(A)
+    groups = np.asarray(groups)
+
+    blocks = []
+    for group in np.unique(groups):
+        dofs = np.where(groups == group)[0]
+        for i in range(0, dofs.size, max_block_size):
+            block = dofs[i:i+max_block_size]
+            blocks.append((block, scipy.linalg.lu_factor(_entries(matrix, block[:, None], block[None, :]), check_finite=False)))
+
+    def matmat(X):
+        X = np.asarray(X)
+        Y = np.zeros(X.shape, dtype=np.result_type(matrix.dtype, X.dtype))
+        for block, lu in blocks:
+            Y[block] = scipy.linalg.lu_solve(lu, X[block])
+        return Y
+
+    return scipy.sparse.linalg.LinearOperator(matrix.shape, matvec=matmat, matmat=matmat, dtype=matrix.dtype)
+
+
+def near_field_inverse(A, points, neighbours=16):
+    """
+    Sparse approximate inverse of A built from the near field: row i of M is the row of the inverse
+    of the small block of A that couples degree of freedom i with its nearest neighbours (which holds
+    the strongest interactions of a boundary integral operator). A may also be a sparse matrix (e.g. the
+    near field of A), in which case only its entries are used. Returns a sparse (CSR) matrix.
+    """
+
+    matrix = A if scipy.sparse.issparse(A) else dense_matrix(A)
+    ndof = matrix.shape[0]
+    neighbours = min(neighbours, ndof)
+
+    near = scipy.spatial.cKDTree(points).query(points, k=neighbours)[1].reshape((ndof, neighbours))
+
+    # m^T A[J,J] = e_i^T, for the blocks of all degrees of freedom at once:
+    blocks = _entries(matrix, near[:, :, None], near[:, None, :])
+    e = (near == np.arange(ndof)[:, None]).astype(matrix.dtype)
+    values = np.linalg.solve(np.swapaxes(blocks, 1, 2), e[:, :, None])[:, :, 0]
+
+    rows = np.repeat(np.arange(ndof), neighbours)
+    return scipy.sparse.csr_matrix((values.ravel(), (rows, near.ravel())), shape=matrix.shape)
+
+
+def _entries(matrix, rows, cols):
+    """
+    Entries of a dense or sparse matrix at the (broadcast) index arrays rows and cols, as a dense array.
+    """
+
+    rows, cols = np.broadcast_arrays(rows, cols)
+    if scipy.sparse.issparse(matrix):
+        return np.asarray(matrix[rows.ravel(), cols.ravel()]).reshape(rows.shape)
+    return matrix[rows, cols]
+
+
+def gmres(A, b, tol=1E-5, restart=None, maxiter=None, x0=None, M=None):
+    """
+    (x, iterations) = gmres(A, b, tol)
+
+    Thin wrapper around scipy's GMRES that also counts the iterations.
+    """
+
+    iterations = [0]
+    def callback(residual):
+        iterations[0] += 1
+
+    x, info = scipy.sparse.linalg.gmres(A, b, x0=x0, rtol=tol, restart=restart, maxiter=maxiter, M=M,
+                                        callback=callback, callback_type="pr_norm")
+
+    if info > 0:
+        print("GMRES did not converge to the required tolerance after %s iterations." % iterations[0])
+
+    return x, iterations[0]
+
+
+def block_gmres(A, B, tol=1E-5, restart=None, maxiter=None, X0=None):
+    """
+    (X, iterations) = block_gmres(A, B, tol)
+
+    Restarted block GMRES. A single block Krylov space span{R0, A R0, A^2 R0, ...} is built for
+    all the columns of B, so each iteration costs one (block) product with A and the information
+    gathered for one right-hand side is shared by the others.
+
+    Arguments:
+    A         discrete operator of size N x N (anything that supports A @ X)
+    B         right-hand sides - array of size N x s
+    tol       relative tolerance, which must be met by every column
+    restart   number of block iterations before restarting (default is min(N//s, 100))
+    maxiter   maximum number of restart cycles (default is 10)
+    X0        initial guess (default is zero)
+
+    Returned iterations is the total number of block iterations.
+    """
+
+    ndof, nrhs = B.shape
+    dtype = np.result_type(A.dtype, B.dtype, np.complex64)
+
+    if restart is None:
+        restart = min(max(ndof//nrhs, 1), 100)
+    if maxiter is None:
+        maxiter = 10
+
+    if X0 is None:
+        X = np.zeros((ndof, nrhs), dtype=dtype)
+        R = B.astype(dtype)
+    else:
+        X = np.array(X0, dtype=dtype)
+        R = B - A @ X
+
+    b_norms = np.linalg.norm(B, axis=0)
+    b_norms[b_norms == 0] = 1
+
+    iterations = 0
+    for cycle in range(maxiter):
+
+        V0, S0 = np.linalg.qr(R)
+        if np.all(np.linalg.norm(R, axis=0)/b_norms <= tol):
+            break
+
+        V = [V0]
+        H = np.zeros(((restart + 1)*nrhs, restart*nrhs), dtype=dtype)
+        E = np.zeros(((restart + 1)*nrhs, nrhs), dtype=dtype)
+        E[:nrhs,:] = S0
+
+        for j in range(restart):
+
+            # Block Arnoldi step (modified Gram-Schmidt between blocks):
+            W = np.asarray(A @ V[j], dtype=dtype)
+            for i in range(j + 1):
+                Hij = V[i].conj().T @ W
+                W = W - V[i] @ Hij
+                H[i*nrhs:(i+1)*nrhs, j*nrhs:(j+1)*nrhs] = Hij
+
+            Vj, Hj = np.linalg.qr(W)
+            H[(j+1)*nrhs:(j+2)*nrhs, j*nrhs:(j+1)*nrhs] = Hj
+            V.append(Vj)
+            iterations += 1
+
+            # Small least squares problem min||E - H Y|| for all the columns:
+            rows = (j + 2)*nrhs
+            cols = (j + 1)*nrhs
+            Y = np.linalg.lstsq(H[:rows,:cols], E[:rows,:], rcond=None)[0]
+            residual_norms = np.linalg.norm(E[:rows,:] - H[:rows,:cols] @ Y, axis=0)
+
+            if np.all(residual_norms/b_norms <= tol) or np.linalg.norm(Hj) <= np.finfo(Hj.dtype).eps*np.linalg.norm(H[:rows,:cols]):
+                break
+
+        X = X + np.concatenate(V[:j+1], axis=1) @ Y
+        R = B - A @ X
+
+        if np.all(np.linalg.norm(R, axis=0)/b_norms <= tol):
+            break
+
+    else:
+        print("Block GMRES did not converge to the required tolerance after %s iterations." % iterations)
+
+    return X, iterations
+
+
+def gcro_dr(A, b, tol=1E-5, restart=None, maxiter=None, x0=None, U=None, recycle=10):
+    """
+    (x, iterations, U) = gcro_dr(A, b, tol, x0=x0, U=U)
+
+    GMRES with deflated restarting and subspace recycling (GCRO-DR, Parks et al., 2006).
+    At the end of each restart cycle, the harmonic Ritz vectors of the smallest harmonic Ritz
+    values are kept in U. The next cycles (and the next solves, when U is passed on) work on the
+    orthogonal complement of A U, so the slowly converging part of the spectrum does not have to
+    be found again. When a sequence of slightly different systems is solved (e.g. consecutive
+    frequencies on the same mesh), passing U and the previous solution as x0 cuts the iterations.
+
+    Arguments:
+    A         discrete operator of size N x N (anything that supports A @ X)
+    b         right-hand side - array of size N
+    tol       relative tolerance
+    restart   size of the search space of each cycle, recycled vectors included (default is min(N, 60))
+    maxiter   maximum number of restart cycles (default is 20)
+    x0        initial guess (default is zero)
+    U         recycled subspace of a previous solve - array of size N x k (it is ignored if its size does not match)
+    recycle   number of vectors to be kept in the recycled subspace
+
+    Returned iterations is the number of Arnoldi steps. Returned U is the recycled subspace
+    that must be passed on to the next solve.
+    """
+
+    ndof = b.size
+    dtype = np.result_type(A.dtype, b.dtype, np.complex64)
+
+    if restart is None:
+        restart = min(ndof, 60)
+    if maxiter is None:
+        maxiter = 20
+
+    b_norm = np.linalg.norm(b)
+    if b_norm == 0:
+        b_norm = 1
+
+    if x0 is None:
+        x = np.zeros(ndof, dtype=dtype)
+        r = b.astype(dtype)
+    else:
+        x = np.array(x0, dtype=dtype)
+        r = b - A @ x
+
+    # C = A U with orthonormal columns, so that the recycled part of the solution is a projection:
+    C = None
+    if U is not None and U.ndim == 2 and U.shape[0] == ndof and U.shape[1] > 0:
+        C, R = np.linalg.qr(np.asarray(A @ U, dtype=dtype))
+        U = U @ scipy.linalg.solve_triangular(R, np.eye(R.shape[0], dtype=dtype))
+        y = C.conj().T @ r
+        x = x + U @ y
+        r = r - C @ y
+    else:
+        U = None
+
+    iterations = 0
+    for cycle in range(maxiter):
+
+        beta = np.linalg.norm(r)
+        if beta/b_norm <= tol:
+            break
+
+        k = 0 if C is None else C.shape[1]
+        m = max(min(restart - k, ndof - k), 1)
+
+        V = np.zeros((ndof, m + 1), dtype=dtype)
+        H = np.zeros((m + 1, m), dtype=np.complex128)
+        B = np.zeros((k, m), dtype=np.complex128)
+        V[:,0] = r/beta
+
+        for j in range(m):
+
+            # Arnoldi step on (I - C C^H) A:
+            w = np.asarray(A @ V[:,j], dtype=dtype)
+            if k > 0:
+                B[:,j] = C.conj().T @ w
+                w = w - C @ B[:,j]
+            for i in range(j + 1):
+                H[i,j] = np.vdot(V[:,i], w)
+                w = w - H[i,j]*V[:,i]
+            H[j+1,j] = np.linalg.norm(w)
+            iterations += 1
+
+            if H[j+1,j] <= np.finfo(dtype).eps*np.linalg.norm(H[:j+2,:j+1]):
+                break
+            V[:,j+1] = w/H[j+1,j]
+
+            e1 = np.zeros(j + 2, dtype=np.complex128)
+            e1[0] = beta
+            y = np.linalg.lstsq(H[:j+2,:j+1], e1, rcond=None)[0]
+            if np.linalg.norm(e1 - H[:j+2,:j+1] @ y)/b_norm <= tol:
+                break
+
+        m = j + 1
+        H = H[:m+1,:m]
+        B = B[:,:m]
+        V = V[:,:m+1]
+
+        e1 = np.zeros(m + 1, dtype=np.complex128)
+        e1[0] = beta
+        y = np.linalg.lstsq(H, e1, rcond=None)[0]
+
+        # A (V y - U B y) = V H y, so the residual stays in the span of V:
+        x = x + V[:,:m] @ y.astype(dtype)
+        if k > 0:
+            x = x - U @ (B @ y).astype(dtype)
+        r = V @ (e1 - H @ y).astype(dtype)
+
+        U, C = _recycle(U, C, V, H, B, recycle)
+
+        if np.linalg.norm(r)/b_norm <= tol:
+            break
+
+    else:
+        print("GCRO-DR did not converge to the required tolerance after %s iterations." % iterations)
+
+    return x, iterations, U
+
+
+def _recycle(U, C, V, H, B, recycle):
+    """
+    Returns the new recycled subspace (U, C = A U) of a GCRO-DR cycle: the harmonic Ritz vectors of
+    the smallest harmonic Ritz values of A on the span of [U V].
+    """
+
+    m = H.shape[1]
+    k = 0 if C is None else C.shape[1]
+    dtype = V.dtype
+
+    recycle = min(recycle, k + m - 1)
+    if recycle < 1:
+        return U, C
+
+    # G is the projection of A on [U V] (A [U V] = [C V] G) and WZ = [C V]^H [U V]:
+    G = np.zeros((k + m + 1, k + m), dtype=np.complex128)
+    WZ = np.zeros((k + m + 1, k + m), dtype=np.complex128)
+    G[k:,k:] = H
+    WZ[k:k+m,k:] = np.eye(m)
+    if k > 0:
+        G[:k,:k] = np.eye(k)
+        G[:k,k:] = B
+        WZ[:k,:k] = C.conj().T @ U
+        WZ[k:,:k] = V.conj().T @ U
+
+    theta, P = scipy.linalg.eig(G.conj().T @ G, G.conj().T @ WZ)
+    theta[~np.isfinite(theta)] = np.inf
+    P = P[:,np.argsort(np.abs(theta))[:recycle]]
+
+    Q, R = np.linalg.qr(G @ P)
+    if k > 0:
+        Y = np.concatenate((U, V[:,:m]), axis=1) @ P.astype(dtype)
+        C = np.concatenate((C, V), axis=1) @ Q.astype(dtype)
+    else:
+        Y = V[:,:m] @ P.astype(dtype)
+        C = V @ Q.astype(dtype)
+    U = Y @ scipy.linalg.solve_triangular(R, np.eye(R.shape[0])).astype(dtype)
+
+    return U, C
@@ -2,6 +2,8 @@
 This module contains the functions needed to use the spherical harmonic techniques
 """
 
+import os
+import functools
 import numpy as np
 import scipy.sparse
 from scipy.special import lpmv, spherical_jn, spherical_yn
@@ -130,23 +132,122 @@ def get_translation_matrix(t,k,OrderS,OrderR):
 	Y, dy_dbeta, dy_dalpha = spherical_harmonic_all(OrderT, np.array([[alpha]]), np.array([[sinbeta]]), np.array([[cosbeta]]))
 
 
-	# Allocated results array:
-	T = np.zeros(((OrderR+1)**2, (OrderS+1)**2))
+	# Radial functions of all translation orders:
+	h_all, dhdz_all = spherical_hankel_out_all(OrderT, k*r)
 
-
-	# Loop over translation order & compute summation:
-	for nT in np.arange(OrderT+1):
-		h, dhdz = spherical_hankel_out(nT,k*r) # Compute radial function:
-
-		for mT in np.arange(-nT, nT+1):
-			iT = sub2indSH(mT,nT)
-			T = T + h * Y[0][int(iT)] * S[int(iT),:,:] #!!!
+	# Summation over all translation orders (nT, mT) at once:
+	nT = np.repeat(np.arange(OrderT+1), 2*np.arange(OrderT+1)+1)
+	T = np.tensordot(h_all[..., nT] * Y[0], S, axes=(-1, 0))
 
 	return T
                 
 
-#@jit(nopython=True)
-def GetStructuralTranslationCoefficients(OrderS,OrderR):
+def translate_sh(Bnm, t, k, OrderR, cache_path=None):
+	"""
+	Anm = translate_sh(Bnm, t, k, OrderR)
+	Translates the coefficients Bnm of a Spherical Harmonic source (outgoing
+	spherical Hankel radial functions) to the coefficients at Spherical
+	Harmonic receivers (spherical Bessel radial functions) at positions t
+	relative to the source. The result is the same as
+	get_translation_matrix(t,k,OrderS,OrderR) @ Bnm, but T is never formed:
+	each translation is decomposed in a rotation that aligns t with the z
+	axis, a coaxial translation and the inverse rotation (sections 3.2 and
+	3.3 of Gumerov, N., & Duraiswami, R. (2005). Fast Multipole Methods for
+	the Helmholtz Equation in Three Dimensions (1st ed.). Elsevier Science).
+	The coaxial translation only couples coefficients of the same m, so each
+	translation costs O(p^3) instead of O(p^4).
+	Arguments:
+	Bnm         Source coefficients (vector with (OrderS+1)**2 elements)
+	t           Cartesian translation vectors (3 elements, or array with 3 columns)
+	k           Wavenumber (positive real scalar or vector in radians/meter)
+	OrderR      Order of the receiver (non-negative real integer scalar)
+	cache_path  Folder of the structural translation coefficients (see
+	            GetStructuralTranslationCoefficients)
+	Returned variable is an array of size [k, t, (OrderR+1)**2], without the
+	dimensions of a scalar k or of a single translation vector t.
+	"""
+
+	Bnm = np.asarray(Bnm).reshape(-1)
+	OrderS = int(np.sqrt(Bnm.size)) - 1
+	OrderR = int(OrderR)
+	OrderT = OrderS + OrderR
+
+	single_t = np.ndim(t) == 1
+	t = np.asarray(t, dtype=np.float64).reshape((-1, 3))
+	scalar_k = np.ndim(k) == 0
+	k = np.atleast_1d(np.asarray(k, dtype=np.float64))
+
+	iR, iS, C = get_coaxial_translation_coefficients(OrderS, OrderR, cache_path)
+
+	# Express t in spherical coordinates:
+	[r,alpha,sinbeta,cosbeta] = cart2sph(t[:,0],t[:,1],t[:,2])
+	beta = np.arctan2(sinbeta, cosbeta)
+
+	# Coaxial translation coefficients of all wavenumbers and distances, [k, t, entry]:
+	h, dhdz = spherical_hankel_out_all(OrderT, k[:, None]*r[None, :])
+	coaxial = h @ C
+
+	# Sums each coaxial entry into its receiver coefficient:
+	entries_to_receiver = scipy.sparse.csr_matrix((np.ones(iR.size), (np.arange(iR.size), iR)), 
+							shape=(iR.size, (OrderR+1)**2))
+
+	Anm = np.zeros((k.size, t.shape[0], (OrderR+1)**2), dtype=np.complex128)
+	for i in range(t.shape[0]):
+		# Rotation that aligns t with the z axis (the inverse rotation is the conjugate transpose):
+		RotS = _translation_rotation(-alpha[i], -beta[i], OrderS)
+		RotR = _translation_rotation(-alpha[i], -beta[i], OrderR)
+
+		coaxial_Bnm = coaxial[:, i, :] * (RotS @ Bnm)[iS]
+		Anm[:, i, :] = (entries_to_receiver.T @ coaxial_Bnm.T).T @ RotR.conj()
+
+	if single_t:
+		Anm = Anm[:, 0, :]
+	if scalar_k:
+		Anm = Anm[0]
+
+	return Anm
+
+
+@functools.lru_cache(maxsize=256)
+def _translation_rotation(a, b, Order):
+	"""
+	Dense rotation matrix of translate_sh (see get_rotation_matrix), kept for
+	the translation directions already used.
+	"""
+
+	return get_rotation_matrix(a, b, 0, Order).toarray()
+
+
+def get_coaxial_translation_coefficients(OrderS, OrderR, cache_path=None):
+	"""
+	(iR, iS, C) = get_coaxial_translation_coefficients(OrderS, OrderR)
+	Returns the coefficients of a translation along the positive z axis, in
+	the same sparse form used by translate_sh: only the entries that couple
+	receiver coefficient iR with source coefficient iS of the same m are
+	kept, and the translation matrix of a distance r is given by
+	T[iR, iS] = sum over nT of h_nT(k*r) * C[nT, :]. They are obtained from
+	the structural translation coefficients (the spherical harmonics on the
+	z axis are only non-zero for mT = 0).
+	"""
+
+	OrderT = int(OrderS) + int(OrderR)
+	S = GetStructuralTranslationCoefficients(OrderS, OrderR, cache_path)
+
+	mS, nS = [x.astype(np.int64) for x in ind2subSH(np.arange((int(OrderS)+1)**2))]
+	mR, nR = [x.astype(np.int64) for x in ind2subSH(np.arange((int(OrderR)+1)**2))]
+	iR, iS = np.nonzero(mR[:, None] == mS[None, :])
+
+	nT = np.arange(OrderT+1)
+	C = np.sqrt((2*nT+1)/(4*np.pi))[:, None] * S[sub2indSH(0, nT)][:, iR, iS]
+
+	return iR, iS, C.astype(np.complex128)
+
+
+# Structural translation coefficients already computed, by (OrderS, OrderR):
+_structural_translation_coefficients = {}
+
+
+def GetStructuralTranslationCoefficients(OrderS,OrderR,cache_path=None):
 	"""
 	S = GetStructuralTranslationCoefficients(OrderS,OrderR)
 	Computes the 'Structural Translation Coefficients' used in Spherical
@@ -154,101 +255,150 @@ def GetStructuralTranslationCoefficients(OrderS,OrderR):
 	Gumerov, N., & Duraiswami, R. (2005). Fast Multipole Methods for the
 	Helmholtz Equation in Three Dimensions (1st ed.). Elsevier Science.
 	Arguments:
-	OrderS    Order of the source   (non-negative real integer scalar)
-	OrderR    Order of the receiver (non-negative real integer scalar)
-	Returned variable is a 3D array of size [(OrderR+1)**2, (OrderS+1)**2,
-	(OrderR+OrderS+1)**2]. 
+	OrderS      Order of the source   (non-negative real integer scalar)
+	OrderR      Order of the receiver (non-negative real integer scalar)
+	cache_path  Folder where the coefficients are kept between sessions. If None
+	            (default), they are only kept in memory and nothing is written.
+	Returned variable is a 3D array of size [(OrderR+OrderS+1)**2, (OrderR+1)**2,
+	(OrderS+1)**2]. It only depends on the orders, so it is computed once per
+	order pair and the same (read-only) array is returned afterwards.
 	"""
 
+	OrderS = int(OrderS)
+	OrderR = int(OrderR)
+
+	if (OrderS, OrderR) in _structural_translation_coefficients:
+		return _structural_translation_coefficients[(OrderS, OrderR)]
+
+	if cache_path is not None:
+		path = os.path.join(cache_path, "structural_translation_coefficients_%d_%d.npy" % (OrderS, OrderR))
+		if os.path.exists(path):
+			S = np.load(path)
+			S.flags.writeable = False
+			_structural_translation_coefficients[(OrderS, OrderR)] = S
+			return S
+
 	# Order required for translation:
 	OrderT = OrderS + OrderR
 
-	# Allocate cell array:
-	S = np.zeros(((OrderT+1)**2, (OrderR+1)**2, (OrderS+1)**2), dtype = np.complex64)
+	# All source (n, m in book) and receiver (n', m' in book) indices:
+	mS, nS = [x.astype(np.int64) for x in ind2subSH(np.arange((OrderS+1)**2))]
+	mR, nR = [x.astype(np.int64) for x in ind2subSH(np.arange((OrderR+1)**2))]
+	iS, iR = np.meshgrid(np.arange((OrderS+1)**2), np.arange((OrderR+1)**2), indexing="ij")
+	iS = iS.ravel()
+	iR = iR.ravel()
+
+	# The 3j symbol is only non-zero for m'' = m - m' and |n - n'| <= n'' <= n + n' (in book):
+	nT = np.abs(nS[iS] - nR[iR])[:, None] + np.arange(min(OrderS, OrderR)*2 + 1)[None, :]
+	iS = np.repeat(iS[:, None], nT.shape[1], axis=1)
+	iR = np.repeat(iR[:, None], nT.shape[1], axis=1)
+	valid = nT <= nS[iS] + nR[iR]
+	nT = nT[valid]
+	iS = iS[valid]
+	iR = iR[valid]
+	mT = mS[iS] - mR[iR]
+	valid = np.abs(mT) <= nT
+	nT = nT[valid]
+	mT = mT[valid]
+	iS = iS[valid]
+	iR = iR[valid]
+
+	# Sign factors (m'' and m' are negated):
+	epT = np.where(mT < 0, (-1.0)**mT, 1.0)
+	epS = np.where(mS[iS] > 0, (-1.0)**mS[iS], 1.0)
+	epR = np.where(mR[iR] < 0, (-1.0)**mR[iR], 1.0)
 
-	# Loop over translation order (n2 & m2):
-	for nT in  np.arange(OrderT+1, dtype = np.float64): # n'' in book
-		for mT in np.arange(-nT, nT+1, dtype = np.float64): # m'' in book
-			iT = sub2indSH(mT,nT)
-			if mT < 0: # because m'' is negated
-				epT = (-1)**mT
-			else:
-				epT = 1.0
-
-			# Loop over source order (nS & mS):
-			for nS in np.arange(OrderS+1, dtype = np.float64): # n in book
-				for mS in np.arange(-nS, nS+1, dtype = np.float64): # m in book
-					if mS > 0:
-						epS = (-1)**mS
-					else:
-						epS = 1.0
-
-					# Loop over recevier order (nR & mR):
-					for nR in np.arange(OrderR+1, dtype = np.float64): # n' in book
-						for mR in np.arange(-nR, nR+1, dtype = np.float64): # m' in book
-							if mR < 0: # because m' is negated
-								epR = (-1)**mR
-							else:
-								epR = 1.0
-
-							# Compute coefficient if within non-zero range:
-							if nT >= abs(nR-nS) and nT <= (nR+nS):
-								S[int(iT), int(sub2indSH(mR,nR)), int(sub2indSH(mS,nS))] = (
-											1j**(nR+nT-nS) * epS * epR * epT 
-											* np.sqrt(4*np.pi*(2*nS+1)*(2*nR+1)*(2*nT+1))
-											* Wigner3jSymbol(nS, nR, nT, mS, -mR, -mT)
-											* Wigner3jSymbol(nS, nR, nT, 0, 0, 0) 
-											)
+	S = np.zeros(((OrderT+1)**2, (OrderR+1)**2, (OrderS+1)**2), dtype = np.complex64)
+	S[sub2indSH(mT,nT), iR, iS] = (
+					1j**((nR[iR]+nT-nS[iS]) % 4) * epS * epR * epT 
+					* np.sqrt(4*np.pi*(2*nS[iS]+1)*(2*nR[iR]+1)*(2*nT+1))
+					* wigner_3j(nS[iS], nR[iR], nT, mS[iS], -mR[iR], -mT)
+					* wigner_3j(nS[iS], nR[iR], nT, 0, 0, 0) 
+					)
+
+	if cache_path is not None:
+		# Written to a temporary file first, so other processes never read a truncated table:
+		os.makedirs(cache_path, exist_ok=True)
+		tmp_path = path[:-4] + "_tmp_%s.npy" % os.getpid()
+		np.save(tmp_path, S)
+		os.replace(tmp_path, path)
+
+	S.flags.writeable = False
+	_structural_translation_coefficients[(OrderS, OrderR)] = S
 
 	return S
 
 
-#@jit(nopython=True)
-def Wigner3jSymbol(j1, j2, j3, m1, m2, m3):
+def wigner_3j(j1, j2, j3, m1, m2, m3):
 	"""
-	W3jS = Wigner3j(j1, j2, j3, m1, m2, m3)
-	Computes the Wigner 3j symbol following the formulation given at
-	http://mathworld.wolfram.com/Wigner3j-Symbol.html.
-	Arguments:
-	j1, j2, j3, m1, m2 and m3     All must be scalar half-integers
-	Check arguments against 'selection rules' (cited to Messiah 1962, pp. 1054-1056; Shore and Menzel 1968, p. 272)
-	Nullifying any of these means the symbol equals zero.
+	W3jS = wigner_3j(j1, j2, j3, m1, m2, m3)
+	Computes the Wigner 3j symbols of integer arguments with the Racah formula,
+	as Wigner3jSymbol, but for arrays of arguments at once (they are broadcast
+	against each other). The factorials are taken from a table, so no Python
+	arithmetic is done per symbol. Symbols that do not satisfy the selection
+	rules are zero.
 	"""
 
-	if abs(m1)<=abs(j1) and abs(m2)<=abs(j2) and abs(m3)<=abs(j3) and m1+m2+m3==0 and abs(j1-j2)<=j3 and j3<=(j1+j2) and np.remainder(j1+j2+j3,1)==0:
-
-		# Evaluate the symbol using the Racah formula (Equation 7):
+	j1, j2, j3, m1, m2, m3 = np.broadcast_arrays(*[np.asarray(x, dtype=np.int64) for x in (j1, j2, j3, m1, m2, m3)])
 
-		# Evalaute summation:
-		W3jS = 0
-		for t in np.arange(min([j1+j2-j3, j1-m1, j2+m2])+1):
-			if (j3-j2+t+m1>=0) and (j3-j1+t-m2>=0) and (j1+j2-j3-t>=0) and (j1-t-m1>=0) and (j2-t+m2>=0):
+	valid = ((np.abs(m1) <= j1) & (np.abs(m2) <= j2) & (np.abs(m3) <= j3) & (m1+m2+m3 == 0) 
+		  & (np.abs(j1-j2) <= j3) & (j3 <= j1+j2))
 
-				# Only include term in summation if all factorials have non-negative arguments
-				x = (np.math.factorial(t)
-				  * np.math.factorial(j3-j2+t+m1)
-				  * np.math.factorial(j3-j1+t-m2)
-				  * np.math.factorial(j1+j2-j3-t)
-				  * np.math.factorial(j1-t-m1)
-				  * np.math.factorial(j2-t+m2)
-				  )
+	W3jS = np.zeros(j1.shape)
+	if not np.any(valid):
+		return W3jS
 
-				W3jS = W3jS + (-1)**t/x
+	j1, j2, j3, m1, m2, m3 = [x[valid] for x in (j1, j2, j3, m1, m2, m3)]
+	factorial = _factorial_table(np.max(j1 + j2 + j3) + 1)
 
+	# Summation over t, for the range in which all factorials have non-negative arguments:
+	t_min = np.maximum(0, np.maximum(j2-j3-m1, j1-j3+m2))
+	t_max = np.minimum(j1+j2-j3, np.minimum(j1-m1, j2+m2))
+	t = t_min[:, None] + np.arange(np.max(t_max - t_min) + 1)[None, :]
+	in_range = t <= t_max[:, None]
+	t = np.where(in_range, t, t_min[:, None])
 
-		# Coefficients outside the summation:
-		W3jS = (W3jS
-			 * (-1)**(j1-j2-m3)
-			 * np.sqrt(float(np.math.factorial(j1+m1)*np.math.factorial(j1-m1)*np.math.factorial(j2+m2)*np.math.factorial(j2-m2)* np.math.factorial(j3+m3)*np.math.factorial(j3-m3)))
-			 * np.sqrt(float(np.math.factorial(j1 + j2 - j3)*np.math.factorial(j1 - j2 + j3)*np.math.factorial(-j1 + j2 + j3) / np.math.factorial(j1 + j2 + j3 + 1)))
-			 )
+	x = (factorial[t] 
+	  * factorial[(j3-j2+m1)[:, None] + t] 
+	  * factorial[(j3-j1-m2)[:, None] + t] 
+	  * factorial[(j1+j2-j3)[:, None] - t] 
+	  * factorial[(j1-m1)[:, None] - t] 
+	  * factorial[(j2+m2)[:, None] - t])
+	summation = np.sum(np.where(in_range, (-1.0)**t / x, 0.0), axis=1)
 
-	else:
-		W3jS = 0 # One of the 'Selection Rules' was nullified.
+	# Coefficients outside the summation:
+	W3jS[valid] = (summation
+		 * (-1.0)**(j1-j2-m3)
+		 * np.sqrt(factorial[j1+m1]*factorial[j1-m1]*factorial[j2+m2]*factorial[j2-m2]*factorial[j3+m3]*factorial[j3-m3])
+		 * np.sqrt(factorial[j1+j2-j3]*factorial[j1-j2+j3]*factorial[-j1+j2+j3] / factorial[j1+j2+j3+1])
+		 )
 
 	return W3jS
 
 
+def _factorial_table(n):
+	"""
+	Returns the factorials of 0..n as floats.
+	"""
+
+	return np.concatenate(([1.0], np.cumprod(np.arange(1, n+1, dtype=np.float64))))
+
+
+#@jit(nopython=True)
+def Wigner3jSymbol(j1, j2, j3, m1, m2, m3):
+	"""
+	W3jS = Wigner3j(j1, j2, j3, m1, m2, m3)
+	Computes the Wigner 3j symbol following the formulation given at
+	http://mathworld.wolfram.com/Wigner3j-Symbol.html.
+	Arguments:
+	j1, j2, j3, m1, m2 and m3     All must be scalar integers (see wigner_3j)
+	Check arguments against 'selection rules' (cited to Messiah 1962, pp. 1054-1056; Shore and Menzel 1968, p. 272)
+	Nullifying any of these means the symbol equals zero.
+	"""
+
+	return float(wigner_3j(j1, j2, j3, m1, m2, m3))
+
+
 #@jit(nopython=True)
 def get_rotation_matrix(a,b,c,Order):
     """
@@ -288,6 +438,9 @@ def get_rotation_matrix(a,b,c,Order):
     # Allocate R:
     R = np.zeros(((Order+1)**2, (Order+1)**2), dtype = np.complex128)
     
+    # Factorials (the indices below are integer valued floats):
+    factorial = _factorial_table(2*int(Order) + 1)
+    
     # Loop over SH order:
     for n in np.arange(Order + 1, dtype=float):
         for m1 in np.arange(-n, n + 1, dtype=float):
@@ -306,10 +459,10 @@ def get_rotation_matrix(a,b,c,Order):
                 
                 H = 0
                 for s in np.arange(max(0, -(m1+m2)), min(n-m1,n-m2) + 1):                
-                    H = H + (-1)**(n-s) * np.cos(b/2)**(2*s+m2+m1) * np.sin(b/2)**(2*n-2*s-m2-m1) / (np.math.factorial(s) * np.math.factorial(n-m1-s) * np.math.factorial(n-m2-s) * np.math.factorial(m1+m2+s))
+                    H = H + (-1)**(n-s) * np.cos(b/2)**(2*s+m2+m1) * np.sin(b/2)**(2*n-2*s-m2-m1) / (factorial[int(s)] * factorial[int(n-m1-s)] * factorial[int(n-m2-s)] * factorial[int(m1+m2+s)])
                     #print(H)
                     
-                H = H * ep1 * ep2 * np.sqrt(float(np.math.factorial(n+m2)*np.math.factorial(n-m2)*np.math.factorial(n+m1)*np.math.factorial(n-m1)))
+                H = H * ep1 * ep2 * np.sqrt(float(factorial[int(n+m2)]*factorial[int(n-m2)]*factorial[int(n+m1)]*factorial[int(n-m1)]))
                 #print(H)
                 # Evaluate Eq. 3.3.37:
                 R[int(sub2indSH(m2,n)), int(sub2indSH(m1,n))] = (-1)**m1 * np.exp(-1j*m1*a) * np.exp(-1j*m2*c) * H
@@ -375,86 +528,103 @@ def spherical_harmonic(n, m, alpha, sinbeta, cosbeta):
     return (y, dy_dbeta, dy_dalpha)
 
 
-#@jit(nopython=True)
-def spherical_harmonic_all (max_order, alpha, sinbeta, cosbeta):
+def spherical_harmonic_all (max_order, alpha, sinbeta, cosbeta, dtype=np.complex128):
     
     """
     (y, dy_dbeta, dy_dalpha) = spherical_harmonic_all(max_order, alpha, sinbeta, cosbeta)
     	
     Computes a Spherical Harmonic function and it's angular derivatives for
     all (m,n) up to the given maximum order. The algorithm is equivalent to that
-    implemented in SphericalHarmonic, but this version avoids repeated calls
-    to lpmv, since that is very time consuming.
+    implemented in SphericalHarmonic, but the normalized associated Legendre functions 
+    of all (m,n) are computed by recurrence for all points at once (see legendre_all),
+    instead of calling lpmv for every order.
     	
-    Arguments - these should all be scalars:
-    r is radius
+    Arguments:
     alpha is azimuth angle (angle in radians from the positive x axis, with
     rotation around the positive z axis according to the right-hand screw rule)
     beta is polar angle, but it is specified as two arrays of its cos and sin values. 
+    alpha, sinbeta and cosbeta can be scalars or arrays with the same number of elements (points).
     max_order is maximum Spherical Harmonic order and should be a non-negative real integer scalar
+    dtype is the type of the returned arrays (np.complex128 by default, or np.complex64)
     	
-    Returned data will be vectors of length (max_order+1)^2.
+    Returned data will be arrays with one row per point and (max_order+1)^2 columns.
     
     """
     
-    # alpha = np.array([[alpha]])
-    # cosbeta = np.array([[cosbeta]])
-    # sinbeta = np.array([[sinbeta]])
-
-    # Preallocate output arrays:
-    y =  np.zeros((np.size(alpha),(max_order+1)**2), np.complex128)
-    dy_dbeta = np.zeros((np.size(alpha),(max_order+1)**2), np.complex128)
-    dy_dalpha = np.zeros((np.size(alpha),(max_order+1)**2), np.complex128)
+    alpha = np.reshape(alpha, (-1,))
     
-    #% Loop over n and calculate spherical harmonic functions y_nm
-    for n in range(max_order+1):
+    p, dp_dbeta = legendre_all(max_order, sinbeta, cosbeta)
     
-        # Compute Legendre function and its derivatives for all m:
-        p_n = lpmv(range(0,n+1), n, cosbeta)
-        #shape_p_n = np.shape(p_n)
-        #p_n = p_n.reshape((shape_p_n[1], shape_p_n[0]))
-        
-        for m in range(-n, n+1):
-    
-            # Legendre function its derivatives for |m|:
-            p_nm = p_n[:, np.absolute(m)]
-            p_nm = p_nm.reshape((np.size(p_nm), ))
-
-            if n==0:
-                dPmn_dbeta = 0
-            elif m==0:
-                dPmn_dbeta = p_n[:,1]
-            elif abs(m)<n:
-                dPmn_dbeta = 0.5*p_n[:,abs(m)+1] - 0.5*(n+abs(m))*(n-abs(m)+1)*p_n[:,abs(m)-1];
-                dPmn_dbeta = dPmn_dbeta.reshape((np.size(dPmn_dbeta), ))
-            elif (abs(m)==1) and (n==1):
-                dPmn_dbeta = -cosbeta
-                dPmn_dbeta = dPmn_dbeta.reshape((np.size(dPmn_dbeta), ))
-            #elif sinbeta<=np.finfo(float).eps:
-                #dPmn_dbeta = 0
-            else:
-                dPmn_dbeta = -abs(m)*cosbeta.reshape((np.size(cosbeta), ))*p_nm/sinbeta.reshape((np.size(sinbeta), )) - (n+abs(m))*(n-abs(m)+1)*p_n[:,abs(m)-1]
-                dPmn_dbeta = dPmn_dbeta.reshape((np.size(dPmn_dbeta), ))
-            
-            #print (dPmn_dbeta)
-            #print (np.shape(dPmn_dbeta))
-            # Compute scaling term, including sign factor:
-            scaling_term = ((-1)**m) * np.sqrt((2 * n + 1) / (4 * np.pi * np.prod(np.float64(range(n-abs(m)+1, n+abs(m)+1)))))
-    
-            # Compute exponential term:
-            exp_term = np.exp(1j*m*alpha)
-            exp_term = exp_term.reshape((np.size(exp_term), ))
-            
-            # Put it all together:
-            i = sub2indSH(m,n)
-            #y[:,i] = np.multiply (exp_term, p_nm)
-            y[:,i] = scaling_term * exp_term * p_nm
-            dy_dbeta[:,i] = scaling_term * exp_term * dPmn_dbeta
-            dy_dalpha[:,i] = y[:,i] * 1j * m
+    # Order n and degree m of each column (ordered as sub2indSH):
+    n = np.repeat(np.arange(max_order+1), 2*np.arange(max_order+1)+1)
+    m = np.arange((max_order+1)**2) - n**2 - n
+    
+    # Columns of the Legendre functions of (|m|,n), with the sign factor of m:
+    i = n*(n+1)//2 + np.abs(m)
+    sign = (-1.0)**m
+    
+    # Exponential term of each m, computed once for all orders:
+    exp_term = np.exp(1j*np.outer(np.arange(-max_order, max_order+1), alpha))[m + max_order]
+    
+    y = ((sign[:, None] * p.T[i]) * exp_term).T.astype(dtype)
+    dy_dbeta = ((sign[:, None] * dp_dbeta.T[i]) * exp_term).T.astype(dtype)
+    dy_dalpha = y * (1j * m).astype(dtype)
             
     return y, dy_dbeta, dy_dalpha
 
 
+def legendre_all(max_order, sinbeta, cosbeta):
+    
+    """
+    (p, dp_dbeta) = legendre_all(max_order, sinbeta, cosbeta)
+    
+    Computes the normalized associated Legendre functions 
+    sqrt((2n+1)/(4pi) * (n-m)!/(n+m)!) * P_n^m(cosbeta) (including the Condon-Shortley phase, as lpmv)
+    and their derivatives with respect to beta, for all 0 <= m <= n <= max_order and all points at once.
+    The functions are computed with the usual stable recurrences: the sectoral ones (m = n) from 
+    the previous order, and the others with the three term recurrence in n, for all m at once.
+    
+    Arguments:
+    beta is polar angle, specified as two arrays of its cos and sin values (one element per point).
+    max_order is maximum order and should be a non-negative real integer scalar
+    
+    Returned data will be arrays with one row per point and (max_order+1)(max_order+2)/2 columns,
+    where (m,n) is in the column n(n+1)/2 + m.
+    """
+    
+    sinbeta = np.reshape(sinbeta, (-1,)).astype(np.float64)
+    cosbeta = np.reshape(cosbeta, (-1,)).astype(np.float64)
+    
+    # Computed as [column, point], so that each function is contiguous in memory:
+    p = np.zeros(((max_order+1)*(max_order+2)//2, np.size(cosbeta)))
+    dp_dbeta = np.zeros_like(p)
+    
+    p[0] = np.sqrt(1/(4*np.pi))
+    for n in range(1, max_order+1):
+        row = n*(n+1)//2
+        previous_row = (n-1)*n//2
+        
+        # Three term recurrence for m < n-1, all m at once:
+        if n > 1:
+            m = np.arange(n-1)
+            a = np.sqrt((4*n**2 - 1) / (n**2 - m**2))[:, None]
+            b = np.sqrt(((n-1)**2 - m**2) / (4*(n-1)**2 - 1))[:, None]
+            p[row:row+n-1] = a * (cosbeta*p[previous_row:previous_row+n-1] 
+                                  - b*p[(n-2)*(n-1)//2:(n-2)*(n-1)//2+n-1])
+        
+        # m = n-1 and m = n:
+        p[row+n-1] = np.sqrt(2*n + 1) * cosbeta * p[previous_row+n-1]
+        p[row+n] = -np.sqrt((2*n + 1) / (2*n)) * sinbeta * p[previous_row+n-1]
+        
+        # Derivatives, from the functions of the same order and m-1, m+1 (the function of m = n+1 is zero):
+        m = np.arange(1, n+1)
+        dp_dbeta[row] = np.sqrt(n*(n+1)) * p[row+1]
+        dp_dbeta[row+1:row+n+1] = -0.5*np.sqrt((n+m)*(n-m+1))[:, None] * p[row:row+n]
+        dp_dbeta[row+1:row+n] += 0.5*np.sqrt((n-m[:-1])*(n+m[:-1]+1))[:, None] * p[row+2:row+n+1]
+    
+    return p.T, dp_dbeta.T
+
+
 #@jit(nopython=True)
 def spherical_hankel_out (n, z):
     '''
@@ -469,6 +639,92 @@ def spherical_hankel_out (n, z):
     return h, dhdz
 
 
+def spherical_bessel_all(max_order, z):
+    '''
+    (j, dj_dz, y, dy_dz) = spherical_bessel_all(max_order, z)
+    
+    Computes the spherical Bessel functions of the first (j) and second (y) kind and their first
+    derivatives for all orders n = 0..max_order at once. y is computed by upward recurrence, which 
+    is stable for it, and j by downward (Miller) recurrence, normalized with the Wronskian 
+    j_1*y_0 - j_0*y_1 = 1/z^2. The derivatives follow from f_n' = f_{n-1} - (n+1)/z*f_n.
+    
+    Arguments:
+    max_order  maximum order - non-negative integer scalar
+    z          arguments - positive real scalar or array
+    
+    Returned quantities are arrays shaped as z with one more (last) dimension of max_order+1 elements.
+    '''
+    
+    shape = np.shape(z)
+    z = np.reshape(np.asarray(z, dtype=np.float64), (-1,))
+    N = max(max_order, 1)
+    
+    y = np.zeros((N+2, z.size))
+    y[0] = -np.cos(z)/z
+    y[1] = -np.cos(z)/z**2 - np.sin(z)/z
+    with np.errstate(over="ignore", invalid="ignore"):
+        for n in range(1, N+1):
+            y[n+1] = (2*n + 1)/z*y[n] - y[n-1]
+    
+    # Miller's algorithm, starting well above both max_order and z:
+    n_start = max(N, int(np.max(z))) + int(np.sqrt(40*max(N, int(np.max(z)), 1))) + 10
+    j = np.zeros((N+2, z.size))
+    j_next = np.zeros(z.size)
+    j_n = np.full(z.size, 1e-300)
+    for n in range(n_start, 0, -1):
+        j_previous = (2*n + 1)/z*j_n - j_next
+        j_next, j_n = j_n, j_previous
+        if n - 1 <= N + 1:
+            j[n-1] = j_n
+        
+        # Rescaled to avoid overflow (all stored orders are scaled together):
+        large = np.abs(j_n) > 1e250
+        if np.any(large):
+            j[:, large] *= 1e-250
+            j_n[large] *= 1e-250
+            j_next[large] *= 1e-250
+    
+    j *= 1/(z**2*(j[1]*y[0] - j[0]*y[1]))
+    
+    # Derivatives:
+    n = np.arange(1, max_order+1)[:, None]
+    dj_dz = np.zeros((max_order+1, z.size))
+    dy_dz = np.zeros((max_order+1, z.size))
+    dj_dz[0] = -j[1]
+    dy_dz[0] = -y[1]
+    with np.errstate(over="ignore", invalid="ignore"):
+        dj_dz[1:] = j[:max_order] - (n + 1)/z*j[1:max_order+1]
+        dy_dz[1:] = y[:max_order] - (n + 1)/z*y[1:max_order+1]
+    
+    return tuple(np.moveaxis(f[:max_order+1], 0, -1).reshape(shape + (max_order+1,)) for f in (j, dj_dz, y, dy_dz))
+
+
+def spherical_hankel_out_all(max_order, z):
+    '''
+    (h, dhdz) = spherical_hankel_out_all(max_order, z)
+    
+    Computes the spherical Hankel functions of the first kind (outgoing in this
+    paper's lingo) and their first derivatives for all orders n = 0..max_order at once
+    (see spherical_bessel_all). Returned quantities have one more (last) dimension than z.
+    '''
+    
+    j, dj_dz, y, dy_dz = spherical_bessel_all(max_order, z)
+    return (j + 1j*y, dj_dz + 1j*dy_dz)
+
+
+def spherical_hankel_in_all(max_order, z):
+    '''
+    (h, dhdz) = spherical_hankel_in_all(max_order, z)
+    
+    Computes the spherical Hankel functions of the second kind (incoming in this
+    paper's lingo) and their first derivatives for all orders n = 0..max_order at once
+    (see spherical_bessel_all). Returned quantities have one more (last) dimension than z.
+    '''
+    
+    j, dj_dz, y, dy_dz = spherical_bessel_all(max_order, z)
+    return (j - 1j*y, dj_dz - 1j*dy_dz)
+
+
 #@jit(nopython=True)
 def spherical_basis_out_all(k, Bnm, pos, nUV):
     '''
@@ -506,8 +762,9 @@ def spherical_basis_out_all(k, Bnm, pos, nUV):
     # Loop over m and n and evalute phi and dPhi/dn:
     phi = np.zeros((r.size,1), np.complex64)
     dphi_dn = np.zeros((r.size,1), np.complex64)
+    h, dh_dkr = spherical_hankel_out_all(Order, k*r)
     for n in range(Order + 1):
-        R, dR_dkr = spherical_hankel_out(n, k*r)
+        R, dR_dkr = h[..., n], dh_dkr[..., n]
         for m in range(-n, n + 1):
             i = sub2indSH(m,n)
             phi += Bnm[i,0] * R * y[0,i]
@@ -519,43 +776,37 @@ def spherical_basis_out_all(k, Bnm, pos, nUV):
 #@jit(nopython=True)
 def spherical_basis_out_p0_only(k, Bnm, pos):
     '''
-    phi = SphericalBasisOutAll(k, Bnm, x)
+    phi = spherical_basis_out_p0_only(k, Bnm, pos)
    	
-    Returns phi and dPhi/dn for a summation of outgoing Spherical Basis functions with
-   	coefficients Bnm. The algorithm is equivalent to that implemented in SphericalBasisOut,
-   	but this version avoids repeated call to lpmv, since that is very time consuming.
+    Returns phi for a summation of outgoing Spherical Basis functions with coefficients Bnm 
+    (without its normal derivative), at all positions at once.
    	
    	Arguments:
    	k     wavenumber - positive real scalar
    	Bnm   directivity coefficients - vector with a square number of elements
-   	x     evaluation positions - real-valued array with 3 columns
-   	nUV   unit vector defining direction in which to compute dPhi/dn - 1x3
+   	pos   evaluation positions - real-valued vector with 3 elements or array with 3 columns
    	
-    Returned quantities are vectors with the same number of elements as x has rows.
+    Returned quantity is an array of size [number of positions, 1].
     '''
     
-    # Convert cartesison coordinates x to spherical coordinates:
-    x = pos[0].reshape((1,1))
-    y = pos[1].reshape((1,1))
-    z = pos[2].reshape((1,1))
-    (r, alpha, sinbeta, cosbeta) = cart2sph(x,y,z)
+    # Convert cartesison coordinates to spherical coordinates:
+    pos = np.asarray(pos, dtype=np.float64).reshape((-1, 3))
+    (r, alpha, sinbeta, cosbeta) = cart2sph(pos[:,0], pos[:,1], pos[:,2])
 	
-    # Evaluate spherical harmonic functions and their derivatives:
-    #if (Bnm.ndim != 1):
-    #    raise IndexError('Bnm must be 1-dimensional')
-    
+    Bnm = np.asarray(Bnm).reshape(-1)
     Order = int(np.sqrt(Bnm.size)) - 1
-    y, dy_dbeta, dy_dalpha = spherical_harmonic_all(Order, alpha, sinbeta, cosbeta)
+    
+    # Evaluate all spherical harmonic functions and radial functions:
+    y = spherical_harmonic_all(Order, alpha, sinbeta, cosbeta)[0]
+    h = spherical_hankel_out_all(Order, k*r)[0]
 
-    # Loop over m and n and evalute phi and dPhi/dn:
-    phi = np.zeros((r.size,1), np.complex128)
-    for n in range(Order + 1):
-        R, dR_dkr = spherical_hankel_out(n, k*r)
-        for m in range(-n, n + 1):
-            i = sub2indSH(m,n)
-            phi += Bnm[i,0] * R * y[0,i]
+    # Sum over all (m, n) at once:
+    n = np.concatenate([np.full(2*order + 1, order) for order in range(Order + 1)])
+    m = np.concatenate([np.arange(-order, order + 1) for order in range(Order + 1)])
+    i = sub2indSH(m, n)
+    phi = np.sum(Bnm[i] * h[:, n] * y[:, i], axis=1)
 
-    return phi
+    return phi.reshape((-1, 1))
 
 
 #@jit(nopython=True)
@@ -690,6 +941,127 @@ def spherical_basis_in(n, m, k, pos, nUV):
     return (Phi, dPhi_dn)
 
 
+def spherical_basis_in_all(k, max_order, pos, nUV):
+    '''
+    (Phi, dPhi_dn) = spherical_basis_in_all(k, max_order, pos, nUV)
+    
+    Returns Phi and dPhi/dn of all incoming Spherical Basis functions up to max_order, at all
+    positions at once. The result is equivalent to calling SphericalBasisIn for every (m,n) and
+    every position, but the Legendre and Hankel functions are evaluated once per order for all
+    positions, instead of once per (m,n) and per position.
+    
+    Arguments:
+    k          wavenumber - positive real scalar
+    max_order  maximum Spherical Harmonic order - non-negative integer scalar
+    pos        evaluation positions - real-valued array with 3 columns
+    nUV        unit vectors defining the direction in which to compute dPhi/dn at each position - array with 3 columns
+    
+    Returned quantities are arrays with one row per position and (max_order+1)^2 columns, ordered as sub2indSH.
+    '''
+    
+    return _spherical_basis_all(k, max_order, pos, nUV, spherical_hankel_in_all)
+
+
+def spherical_basis_out_all_points(k, Bnm, pos, nUV):
+    '''
+    (phi, dphi_dn) = spherical_basis_out_all_points(k, Bnm, pos, nUV)
+    
+    Returns phi and dPhi/dn for a summation of outgoing Spherical Basis functions with coefficients Bnm, 
+    at all positions at once. The result is equivalent to calling SphericalBasisOutAll for every position.
+    
+    Arguments:
+    k     wavenumber - positive real scalar
+    Bnm   directivity coefficients - vector with a square number of elements
+    pos   evaluation positions - real-valued array with 3 columns
+    nUV   unit vectors defining the direction in which to compute dPhi/dn at each position - array with 3 columns
+    
+    Returned quantities are vectors with the same number of elements as pos has rows.
+    '''
+    
+    Bnm = np.asarray(Bnm).reshape(-1)
+    Order = int(np.sqrt(Bnm.size)) - 1
+    
+    Phi, dPhi_dn = _spherical_basis_all(k, Order, pos, nUV, spherical_hankel_out_all)
+    
+    return (Phi @ Bnm, dPhi_dn @ Bnm)
+
+
+def _spherical_basis_all(k, max_order, pos, nUV, hankel):
+    '''
+    Evaluates all Spherical Basis functions up to max_order (and their normal derivatives) at all positions, 
+    with the radial functions given by hankel (spherical_hankel_in_all or spherical_hankel_out_all).
+    '''
+    
+    return spherical_basis_from_tables(k, spherical_angular_tables(max_order, pos, nUV), hankel)
+
+
+def spherical_angular_tables(max_order, pos, nUV):
+    '''
+    tables = spherical_angular_tables(max_order, pos, nUV)
+    
+    Returns the parts of all Spherical Basis functions up to max_order that do not depend on the
+    wavenumber, at all positions: the spherical harmonics Y, their derivative along nUV divided by r
+    (dY_dn), the distances r and the radial component of nUV (nUVrUV). They can be computed once
+    and given to spherical_basis_from_tables for every frequency.
+    
+    Arguments:
+    max_order  maximum Spherical Harmonic order - non-negative integer scalar
+    pos        evaluation positions - real-valued array with 3 columns
+    nUV        unit vectors defining the direction in which to compute dPhi/dn at each position - array with 3 columns
+    
+    Returns a dictionary. Y and dY_dn have one row per position and (max_order+1)^2 columns, ordered as sub2indSH.
+    '''
+    
+    pos = np.asarray(pos, dtype=np.float64).reshape((-1, 3))
+    nUV = np.asarray(nUV, dtype=np.float64).reshape((-1, 3))
+    
+    # Column vectors, so that the spherical harmonics of all positions are computed at once:
+    x = pos[:,0].reshape((-1,1))
+    y = pos[:,1].reshape((-1,1))
+    z = pos[:,2].reshape((-1,1))
+    (r, alpha, sinbeta, cosbeta) = cart2sph(x,y,z)
+    
+    # dot products of nUV with unit vectors of spherical coordinate system (at x):
+    nUVrUV, nUValphaUV, nUVbetaUV = cart2sphUV(x,y,z,nUV.T.reshape((3,-1,1)))
+    
+    Y, dY_dbeta, dY_dalpha = spherical_harmonic_all(max_order, alpha, sinbeta, cosbeta)
+    
+    dY_dn = (nUVbetaUV * dY_dbeta + nUValphaUV * dY_dalpha / sinbeta) / r
+    
+    return {"max_order": max_order, "r": r[:,0], "nUVrUV": nUVrUV[:,0], "Y": Y, "dY_dn": dY_dn}
+
+
+def spherical_basis_from_tables(k, tables, hankel=spherical_hankel_in_all):
+    '''
+    (Phi, dPhi_dn) = spherical_basis_from_tables(k, tables, hankel)
+    
+    Returns Phi and dPhi/dn of all Spherical Basis functions from the angular tables given by
+    spherical_angular_tables, so only the radial functions are evaluated for the wavenumber k
+    (all orders at once).
+    
+    Arguments:
+    k       wavenumber - positive real scalar
+    tables  angular tables - dictionary returned by spherical_angular_tables
+    hankel  radial functions - spherical_hankel_in_all (default, incoming basis) or spherical_hankel_out_all
+    
+    Returned quantities are arrays shaped as tables["Y"].
+    '''
+    
+    max_order = tables["max_order"]
+    
+    # Order n of each column (ordered as sub2indSH):
+    n = np.repeat(np.arange(max_order+1), 2*np.arange(max_order+1)+1)
+    
+    R, dR_dkr = hankel(max_order, k*tables["r"])
+    R = R[:, n]
+    dR_dkr = dR_dkr[:, n]
+    
+    Phi = R * tables["Y"]
+    dPhi_dn = (tables["nUVrUV"] * k)[:,None] * dR_dkr * tables["Y"] + R * tables["dY_dn"]
+    
+    return (Phi, dPhi_dn)
+
+
 #@jit(nopython=True)
 def cart2sphUV(x,y,z,nUV):
     '''
@@ -0,0 +1,143 @@
+"""
+Append-only store of the results of a frequency sweep. Each simulated frequency is written to its own
+.npz record as soon as it is solved, so a checkpoint costs the same no matter how many frequencies
+were already simulated, and an interrupted run can be resumed from the frequencies that are on disk.
+Each record may carry a setup key (see Room._setup_keys()), so records of a different setup are not resumed.
+"""
+
+import os
+import queue
+import threading
+import numpy as np
+
+
+class ResultStore():
+    '''
+    Per-frequency result records of a room, kept in a folder.
+    Inputs:
+        path - folder of the records (it is created if it does not exist).
+
+    Records are written by a background thread, so the solver does not wait for the disk.
+    Call .close() to wait until all of them are written.
+    '''
+
+    def __init__(self, path):
+
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._error = None
+
+    def record_path(self, freq):
+        return os.path.join(self.path, "freq_%0.6f.npz" % freq)
+
+    def frequencies(self):
+        '''
+        Returns the sorted frequencies that have a record in the store.
+        '''
+
+        freqs = []
+        for name in os.listdir(self.path):
+            if name.startswith("freq_") and name.endswith(".npz") and not name.endswith("_tmp.npz"):
+                freqs.append(float(name[5:-4]))
+
+        return sorted(freqs)
+
+    def contains(self, freq, key=None):
+        '''
+        Returns True if there is a record of frequency freq. If key is given, the record must also have been
+        written with the same setup key.
+        '''
+
+        if os.path.exists(self.record_path(freq)) != True:
+            return False
+
+        if key is None:
+            return True
+
+        with np.load(self.record_path(freq), allow_pickle=True) as record:
+            return "setup_key" in record.files and str(record["setup_key"]) == key
+
+    def append(self, results, key=None):
+        '''
+        Queues the results of one frequency (as returned by Room._run_frequency()) to be written, together with
+        the setup key they were solved for.
+        '''
+
+        if self._error is not None:
+            raise self._error
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._writer, daemon=True)
+            self._thread.start()
+
+        self._queue.put((results, key))
+
+    def load(self, freq):
+        '''
+        Returns the results of one frequency in the same format they were appended.
+        '''
+
+        with np.load(self.record_path(freq), allow_pickle=True) as record:
+            results = {key: record[key] for key in record.files}
+
+        for key in results:
+            if results[key].dtype == object and results[key].ndim == 0:
+                results[key] = results[key].item()
+            elif key in ("boundary_pressure", "boundary_velocity", "incident_pressure", "scattered_pressure", "total_pressure"):
+                results[key] = list(results[key])
+
+        results.pop("setup_key", None)
+        results["freq"] = float(results["freq"])
+        results["mesh"] = str(results["mesh"])
+
+        return results
+
+    def close(self):
+        '''
+        Waits until all queued records are written.
+        '''
+
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            raise self._error
+
+    def _writer(self):
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            try:
+                self._write(*item)
+            except Exception as error:
+                self._error = error
+
+    def _write(self, results, key=None):
+
+        record = {}
+        if key is not None:
+            record["setup_key"] = np.asarray(key)
+        for key, value in results.items():
+            if key in ("boundary_pressure", "boundary_velocity", "incident_pressure", "scattered_pressure", "total_pressure"):
+                # Kept as object arrays, since binaural receivers give two values per item:
+                array = np.empty(len(value), dtype=object)
+                array[:] = [np.asarray(item) for item in value]
+                record[key] = array
+            elif isinstance(value, dict):
+                record[key] = np.array(value, dtype=object)
+            else:
+                record[key] = np.asarray(value)
+
+        # Written to a temporary file first, so an interrupted run never leaves a truncated record behind:
+        path = self.record_path(results["freq"])
+        tmp_path = path[:-4] + "_tmp.npz"
+        np.savez(tmp_path, **record)
+        os.replace(tmp_path, path)
@@ -0,0 +1,36 @@
+import numpy as np
+
+from sea import solvers
+
+
+def _frequency_problem(k, ndof=120, nrhs=2):
+    # Dense, well conditioned stand-in for the left-hand side of one frequency (neighbouring points couple the most):
+    rng = np.random.default_rng(0)
+    points = rng.uniform(0, 1, (ndof, 3))
+    distances = np.linalg.norm(points[:, None] - points[None, :], axis=2)
+    A = np.exp(1j*k*distances)/(1 + 20*distances)/ndof + np.eye(ndof)
+    B = rng.standard_normal((ndof, nrhs)) + 1j*rng.standard_normal((ndof, nrhs))
+    return A, B, points
+
+
+def test_recycled_gmres_with_preconditioner_over_two_frequencies():
+    state = {}
+    for k in (1.0, 1.1):
+        A, B, points = _frequency_problem(k)
+        M, info = solvers.build_preconditioner(A, "near field", points=points)
+
+        X, info = solvers.solve_multiple_rhs(A, B, method="recycled gmres", tol=1E-8, state=state, M=M)
+
+        assert np.linalg.norm(A @ X - B)/np.linalg.norm(B) < 1E-6
+        # The state keeps the solution of A X = B (not the preconditioned unknowns):
+        assert np.allclose(state["X"], X)
+
+
+def test_recycled_gmres_warm_start_without_preconditioner():
+    state = {}
+    A, B, points = _frequency_problem(1.0)
+    X, first = solvers.solve_multiple_rhs(A, B, method="recycled gmres", tol=1E-8, state=state)
+    X, second = solvers.solve_multiple_rhs(A, B, method="recycled gmres", tol=1E-8, state=state)
+
+    assert np.linalg.norm(A @ X - B)/np.linalg.norm(B) < 1E-6
+    assert second["iterations"] < first["iterations"]